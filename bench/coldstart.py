@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+'''
+Cold start benchmark of the serverless handler against bench/fakecloud.py.
+
+Every repetition starts a fresh interpreter, as a new function instance
+would, imports handler.py and invokes it twice: the first invocation is
+the cold one (imports, config, IAM token, TLS sessions), the second one
+reuses the warm process. Reported per invocation: time, API requests and
+IAM token exchanges, plus the module import time and peak memory.
+
+    python bench/coldstart.py --vms 100 --mode delete --repeat 5
+'''
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+from run import BASEDIR, FakeCloudProcess
+
+# Runs in the measured interpreter, API counters are read with the
+# already imported client, so the probe itself doesn't warm anything up
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import handler
+imported = time.perf_counter()
+event = json.loads(sys.argv[1])
+url = sys.argv[2]
+
+result = {'import': imported - started}
+for name in ('cold', 'warm'):
+    before = time.perf_counter()
+    response = handler.handler(event, None)
+    result[name] = time.perf_counter() - before
+    result[name + '_status'] = response['statusCode']
+
+    from common.session import get_client
+    result[name + '_stats'] = get_client().get(url + '/_stats', retry=False).json()
+    # The warm invocation starts from the same cloud state
+    get_client().post(url + '/_reset', retry=False)
+
+import resource
+result['memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+print(json.dumps(result))
+'''
+
+
+def probe(cloud, event, env):
+    cloud.post('/_reset')
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, json.dumps(event), cloud.url],
+        cwd=env['HOME'], env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+    ).stdout
+    result = json.loads(output.decode().strip().splitlines()[-1])
+
+    for name in ('cold', 'warm'):
+        stats = result.pop(f'{name}_stats')
+        result[f'{name}_requests'] = stats.get('total', 0)
+        result[f'{name}_iam'] = stats.get('POST iam', 0)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of the serverless handler')
+    parser.add_argument('--vms', type=int, default=10)
+    parser.add_argument('--mode', choices=('create', 'delete', 'full'), default='delete')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--op-latency', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--json', help='write results to a file')
+    args = parser.parse_args()
+
+    cloud = FakeCloudProcess(args.vms, op_latency=args.op_latency, latency=args.latency)
+    cloud.start()
+    home = tempfile.TemporaryDirectory(prefix='ya-tools-bench-')
+    env = dict(
+        os.environ, HOME=home.name, SERVERLESS='1', TOKEN='bench', INSTANCES='folder:f0',
+        LIFETIME='30', MODE=args.mode, API_ENDPOINT=cloud.url, PYTHONPATH=BASEDIR,
+        LOG_DIR=os.path.join(home.name, 'logs')
+    )
+
+    results = []
+    try:
+        for _ in range(args.repeat):
+            results.append(probe(cloud, {}, env))
+    finally:
+        cloud.stop()
+        home.cleanup()
+
+    print(f'{args.vms} VMs, mode {args.mode}, {args.repeat} runs (median)')
+    for name in ('import', 'cold', 'warm'):
+        print(f'  {name:<7} {statistics.median(x[name] for x in results):8.3f} s', end='')
+        if name != 'import':
+            print(f'  {statistics.median(x[name + "_requests"] for x in results):6.0f} requests'
+                  f'  {statistics.median(x[name + "_iam"] for x in results):3.0f} IAM exchanges', end='')
+        print()
+    print(f'  peak memory {statistics.median(x["memory"] for x in results):.1f} MB')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    sys.exit(0 if all(x['cold_status'] == x['warm_status'] == 200 for x in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
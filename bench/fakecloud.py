@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in for the Yandex Cloud APIs used by snaps.py and watchdog.py.
+
+Serves IAM, compute (instances, disks, snapshots) and operation APIs
+under one base URL, set it as [Network] endpoint in the config:
+
+    python bench/fakecloud.py --vms 100 --op-latency 0.5 --quota 15
+
+Operations finish after op_latency seconds, operations over the quota
+are rejected with 429. Control endpoints (not part of the cloud API):
+  GET /_stats -> request counters by method and API group, errors by status
+  GET /_status -> number of instances by status
+  POST /_reset -> restore the initial state and clear counters
+  POST /_preempt?count=N, POST /_preempt/{id} -> stop running instances
+  POST /_fail?count=N&status=503&retry_after=1 -> fail next N API requests
+'''
+
+import uuid
+import random
+import asyncio
+import argparse
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+GIB = 2 ** 30
+METADATA = 'yandex.cloud.compute.v1.{}Metadata'
+
+
+def timestamp(value=None):
+    return (value or datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class FakeCloud:
+
+    '''
+    In-memory cloud state.
+
+    Attributes:
+      :instances, disks, snapshots, operations: dicts by ID, API payloads
+      :stats: Counter of requests by "METHOD group"
+
+    Methods:
+      reset() -> create instances with disks and old snapshots
+      operation() -> return new operation dict or None over the quota
+      preempt() -> stop running instances, return their IDs
+    '''
+
+    def __init__(self, vms=10, folders=1, secondary=0, old_snaps=2, snap_age=400,
+                 op_latency=0.3, latency=0.0, quota=15, seed=0, sizes=(10, 20, 50, 100, 200), snapshot_rate=0):
+        self.vms = vms
+        self.folders = folders
+        self.secondary = secondary
+        self.old_snaps = old_snaps
+        self.snap_age = snap_age
+        self.op_latency = op_latency
+        self.latency = latency
+        self.quota = quota
+        self.sizes = sizes
+        self.snapshot_rate = snapshot_rate
+        self.random = random.Random(seed)
+        self.reset()
+
+    def reset(self):
+        self.instances = {}
+        self.disks = {}
+        self.snapshots = {}
+        self.operations = {}
+        self.stats = Counter()
+        self.fail = {}
+
+        for i in range(self.vms):
+            folder_id = f'f{i % self.folders}'
+            disk_ids = [f'disk{i}'] + [f'disk{i}-{x}' for x in range(self.secondary)]
+
+            for disk_id in disk_ids:
+                # Sizes vary, so long and short snapshot jobs are mixed
+                size = self.random.choice(self.sizes) * GIB
+                self.disks[disk_id] = {'id': disk_id, 'folderId': folder_id, 'size': str(size), 'typeId': 'network-hdd'}
+
+                for age in range(self.old_snaps):
+                    snapshot_id = f'snap-{disk_id}-{age}'
+                    created_at = datetime.utcnow() - timedelta(days=self.snap_age + age)
+                    self.snapshots[snapshot_id] = {
+                        'id': snapshot_id, 'folderId': folder_id, 'name': snapshot_id,
+                        'sourceDiskId': disk_id, 'createdAt': timestamp(created_at)
+                    }
+
+            self.instances[f'vm{i}'] = {
+                'id': f'vm{i}', 'folderId': folder_id, 'name': f'name{i}', 'status': 'RUNNING',
+                'labels': {'env': 'prod' if i % 2 == 0 else 'dev'},
+                'bootDisk': {'diskId': disk_ids[0]},
+                'secondaryDisks': [{'diskId': x} for x in disk_ids[1:]]
+            }
+
+    def active(self):
+        return sum(1 for x in self.operations.values() if not x['done'])
+
+    def operation(self, description, metadata, on_done, latency=None):
+        if self.active() >= self.quota:
+            return None
+
+        operation = {
+            'id': uuid.uuid4().hex, 'description': description, 'createdAt': timestamp(),
+            'done': False, 'metadata': metadata
+        }
+        self.operations[operation['id']] = operation
+
+        def finish():
+            operation['done'] = True
+            response = on_done()
+            if response is not None:
+                operation['response'] = response
+
+        asyncio.get_event_loop().call_later(self.op_latency if latency is None else latency, finish)
+        return operation
+
+    def preempt(self, count=1, instance_id=None):
+        running = [x for x in self.instances.values() if x['status'] == 'RUNNING']
+        if instance_id is not None:
+            running = [x for x in running if x['id'] == instance_id]
+
+        stopped = self.random.sample(running, min(count, len(running)))
+        for instance in stopped:
+            instance['status'] = 'STOPPED'
+
+        return [x['id'] for x in stopped]
+
+
+def error(code, message):
+    return web.json_response({'code': code, 'message': message}, status=code)
+
+
+def paged(request, items, key):
+    size = int(request.query.get('pageSize', 100))
+    token = request.query.get('pageToken')
+    items = sorted(items, key=lambda x: x['id'])
+
+    if token:
+        items = [x for x in items if x['id'] > token]
+
+    body = {key: items[:size]}
+    if len(items) > size:
+        body['nextPageToken'] = items[size - 1]['id']
+
+    return web.json_response(body)
+
+
+def request_group(path):
+    parts = path.strip('/').split('/')
+    if parts[0] in ('iam', 'operations') or parts[0].startswith('_'):
+        return parts[0]
+
+    # /compute/v1/<collection>/...
+    return parts[2].partition(':')[0] if len(parts) > 2 else parts[-1]
+
+
+def make_app(cloud):
+    routes = web.RouteTableDef()
+
+    @web.middleware
+    async def middleware(request, handler):
+        group = request_group(request.path)
+        if group.startswith('_'):
+            return await handler(request)
+
+        cloud.stats[f'{request.method} {group}'] += 1
+        cloud.stats['total'] += 1
+
+        if cloud.latency:
+            await asyncio.sleep(cloud.latency)
+
+        if cloud.fail.get('count', 0) > 0:
+            cloud.fail['count'] -= 1
+            cloud.stats['injected'] += 1
+            headers = {'Retry-After': cloud.fail['retry_after']} if cloud.fail.get('retry_after') else {}
+            return web.json_response({'code': cloud.fail['status'], 'message': 'Injected failure'},
+                                     status=cloud.fail['status'], headers=headers)
+
+        response = await handler(request)
+        if response.status != 200:
+            cloud.stats[f'status {response.status}'] += 1
+        return response
+
+    def quota_exceeded():
+        return error(429, 'Quota limit compute.operations.count exceeded')
+
+    @routes.post('/iam/v1/tokens')
+    async def iam_token(request):
+        expires_at = datetime.utcnow() + timedelta(hours=12)
+        return web.json_response({'iamToken': f't1.{uuid.uuid4().hex}', 'expiresAt': timestamp(expires_at)})
+
+    # Collection URLs of the models end with a slash
+    @routes.get('/compute/v1/instances{slash:/?}')
+    async def list_instances(request):
+        folder_id = request.query.get('folderId')
+        return paged(request, [x for x in cloud.instances.values() if x['folderId'] == folder_id], 'instances')
+
+    @routes.get('/compute/v1/instances/{instance_id}')
+    async def get_instance(request):
+        instance = cloud.instances.get(request.match_info['instance_id'])
+        return web.json_response(instance) if instance else error(404, 'Instance not found')
+
+    @routes.get('/compute/v1/instances/{instance_id}/operations')
+    async def instance_operations(request):
+        instance_id = request.match_info['instance_id']
+        items = [x for x in cloud.operations.values() if x['metadata'].get('instanceId') == instance_id]
+        return paged(request, items, 'operations')
+
+    @routes.post('/compute/v1/instances/{instance_id}:{action}')
+    async def instance_action(request):
+        instance = cloud.instances.get(request.match_info['instance_id'])
+        action = request.match_info['action']
+        transitions = {
+            'stop': ('RUNNING', 'STOPPING', 'STOPPED', 'Stop'),
+            'start': ('STOPPED', 'STARTING', 'RUNNING', 'Start'),
+            'restart': ('RUNNING', 'RESTARTING', 'RUNNING', 'Restart')
+        }
+
+        if not instance:
+            return error(404, 'Instance not found')
+        if action not in transitions:
+            return error(400, f'Unknown action {action}')
+
+        source, transient, target, name = transitions[action]
+        if instance['status'] != source:
+            return error(409, f'Instance is {instance["status"]}')
+
+        def done():
+            instance['status'] = target
+            return dict(instance)
+
+        metadata = {'@type': METADATA.format(f'{name}Instance'), 'instanceId': instance['id']}
+        operation = cloud.operation(f'{name} instance', metadata, done)
+        if operation is None:
+            return quota_exceeded()
+
+        instance['status'] = transient
+        return web.json_response(operation)
+
+    @routes.get('/compute/v1/disks{slash:/?}')
+    async def list_disks(request):
+        folder_id = request.query.get('folderId')
+        return paged(request, [x for x in cloud.disks.values() if x['folderId'] == folder_id], 'disks')
+
+    @routes.get('/compute/v1/disks/{disk_id}')
+    async def get_disk(request):
+        disk = cloud.disks.get(request.match_info['disk_id'])
+        return web.json_response(disk) if disk else error(404, 'Disk not found')
+
+    @routes.get('/compute/v1/snapshots{slash:/?}')
+    async def list_snapshots(request):
+        folder_id = request.query.get('folderId')
+        return paged(request, [x for x in cloud.snapshots.values() if x['folderId'] == folder_id], 'snapshots')
+
+    @routes.post('/compute/v1/snapshots{slash:/?}')
+    async def create_snapshot(request):
+        data = await request.json()
+        disk = cloud.disks.get(data.get('diskId'))
+        if not disk:
+            return error(404, 'Disk not found')
+
+        snapshot_id = uuid.uuid4().hex[:20]
+
+        def done():
+            cloud.snapshots[snapshot_id] = {
+                'id': snapshot_id, 'folderId': data['folderId'], 'name': data.get('name', snapshot_id),
+                'sourceDiskId': disk['id'], 'createdAt': timestamp()
+            }
+            return cloud.snapshots[snapshot_id]
+
+        metadata = {'@type': METADATA.format('CreateSnapshot'), 'snapshotId': snapshot_id, 'diskId': disk['id']}
+        # With a rate snapshots take time by disk size (GiB per second)
+        latency = cloud.op_latency + (int(disk['size']) / GIB / cloud.snapshot_rate if cloud.snapshot_rate else 0)
+        operation = cloud.operation('Create snapshot', metadata, done, latency)
+        return web.json_response(operation) if operation else quota_exceeded()
+
+    @routes.delete('/compute/v1/snapshots/{snapshot_id}')
+    async def delete_snapshot(request):
+        snapshot_id = request.match_info['snapshot_id']
+        if snapshot_id not in cloud.snapshots:
+            return error(404, 'Snapshot not found')
+
+        def done():
+            cloud.snapshots.pop(snapshot_id, None)
+
+        metadata = {'@type': METADATA.format('DeleteSnapshot'), 'snapshotId': snapshot_id}
+        operation = cloud.operation('Delete snapshot', metadata, done)
+        return web.json_response(operation) if operation else quota_exceeded()
+
+    @routes.get('/operations/{operation_id}')
+    async def get_operation(request):
+        operation = cloud.operations.get(request.match_info['operation_id'])
+        return web.json_response(operation) if operation else error(404, 'Operation not found')
+
+    @routes.get('/_stats')
+    async def stats(request):
+        return web.json_response(dict(cloud.stats, active=cloud.active()))
+
+    @routes.get('/_status')
+    async def status(request):
+        return web.json_response(Counter(x['status'] for x in cloud.instances.values()))
+
+    @routes.post('/_reset')
+    async def reset(request):
+        cloud.reset()
+        return web.json_response({})
+
+    @routes.post('/_preempt')
+    async def preempt_many(request):
+        return web.json_response(cloud.preempt(int(request.query.get('count', 1))))
+
+    @routes.post('/_preempt/{instance_id}')
+    async def preempt_one(request):
+        return web.json_response(cloud.preempt(instance_id=request.match_info['instance_id']))
+
+    @routes.post('/_fail')
+    async def fail(request):
+        cloud.fail = {
+            'count': int(request.query.get('count', 1)),
+            'status': int(request.query.get('status', 503)),
+            'retry_after': request.query.get('retry_after')
+        }
+        return web.json_response(cloud.fail)
+
+    app = web.Application(middlewares=[middleware])
+    app.add_routes(routes)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Yandex Cloud API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--vms', type=int, default=10, help='number of instances')
+    parser.add_argument('--folders', type=int, default=1, help='instances are spread over folders f0..fN-1')
+    parser.add_argument('--secondary', type=int, default=0, help='secondary disks per instance')
+    parser.add_argument('--old-snaps', type=int, default=2, help='expired snapshots per disk')
+    parser.add_argument('--snap-age', type=int, default=400, help='age of expired snapshots in days')
+    parser.add_argument('--op-latency', type=float, default=0.3, help='seconds before an operation is done')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--quota', type=int, default=15, help='operations in flight, more are rejected with 429')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 20, 50, 100, 200], help='disk sizes in GiB, picked at random')
+    parser.add_argument('--snapshot-rate', type=float, default=0, help='GiB per second of a snapshot, 0 means op-latency only')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    cloud = FakeCloud(
+        vms=args.vms, folders=args.folders, secondary=args.secondary, old_snaps=args.old_snaps,
+        snap_age=args.snap_age, op_latency=args.op_latency, latency=args.latency, quota=args.quota, seed=args.seed,
+        sizes=tuple(args.sizes), snapshot_rate=args.snapshot_rate
+    )
+    web.run_app(make_app(cloud), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+'''
+End-to-end benchmarks of snaps.py and watchdog.py against bench/fakecloud.py.
+
+Every case runs the script as a separate process with its own HOME
+(config in ~/.ya-tools/yndx.cfg points [Network] endpoint to the fake
+cloud), and reports wall time, API requests (total and rejected with
+429) and peak memory of the process. The fake cloud is reset before
+every case, so cases start from the same state.
+
+    python bench/run.py --vms 10 100 1000
+    python bench/run.py --vms 100 --cases create-async delete-async --json bench.json
+    python bench/run.py --vms 100 --baseline bench.json  # exit code 1 on regression
+
+Cases:
+  create, delete, full -> snaps.py -c, -d, -f (sync)
+  create-async, delete-async, full-async -> the same with --async
+  watchdog -> watchdog.py, a fraction of instances is preempted after
+    the first check and the time until all are running again is measured
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKECLOUD = os.path.join(BASEDIR, 'bench', 'fakecloud.py')
+
+SNAPS_CASES = {
+    'create': ['-c'],
+    'delete': ['-d'],
+    'full': ['-f'],
+    'create-async': ['-c', '--async'],
+    'delete-async': ['-d', '--async'],
+    'full-async': ['-f', '--async']
+}
+CASES = list(SNAPS_CASES) + ['watchdog']
+
+CONFIG = '''[Auth]
+OAuth_token = bench
+
+[Instances]
+IDs = {refs}
+
+[Snapshots]
+Lifetime = 30
+journal = no
+
+[Watchdog]
+targets = {refs}
+delay = {delay}
+
+[Network]
+endpoint = {endpoint}
+
+[Quota]
+operations = {quota}
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class FakeCloudProcess:
+
+    '''
+    bench/fakecloud.py running in a subprocess.
+
+    Methods:
+      start(), stop() -> run and terminate the server
+      get(), post() -> call a control endpoint, return decoded JSON
+    '''
+
+    def __init__(self, vms, folders=1, op_latency=0.3, latency=0.0, quota=15, sizes=None, snapshot_rate=0):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.args = [
+            sys.executable, FAKECLOUD, '--port', str(self.port), '--vms', str(vms), '--folders', str(folders),
+            '--op-latency', str(op_latency), '--latency', str(latency), '--quota', str(quota),
+            '--snapshot-rate', str(snapshot_rate)
+        ]
+        if sizes:
+            self.args += ['--sizes'] + [str(x) for x in sizes]
+        self.process = None
+
+    def start(self, timeout=10):
+        self.process = subprocess.Popen(self.args)
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            try:
+                return self.get('/_stats')
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+        raise RuntimeError(f'Fake cloud is not listening on {self.url}')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+    def get(self, path):
+        return requests.get(self.url + path).json()
+
+    def post(self, path):
+        return requests.post(self.url + path).json()
+
+
+def run_process(args, env, timeout, until=None):
+    '''
+    Run process, return (exit code, wall time, peak RSS in MB). until is
+    a function called in a thread, the process is interrupted once it
+    returns. The process is killed after timeout seconds.
+    '''
+    started = time.monotonic()
+    # Runs in the temporary HOME, nothing is written to the tree
+    process = subprocess.Popen(args, cwd=env['HOME'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    killer = threading.Timer(timeout, process.kill)
+    killer.start()
+
+    if until is not None:
+        def interrupt():
+            until()
+            process.send_signal(signal.SIGINT)
+        threading.Thread(target=interrupt, daemon=True).start()
+
+    # wait4 returns resource usage of this child only
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - started
+    killer.cancel()
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return process.returncode, elapsed, usage.ru_maxrss / scale
+
+
+class Bench:
+
+    '''
+    Runs benchmark cases for a number of VMs.
+
+    Methods:
+      run() -> return list of result dicts
+    '''
+
+    def __init__(self, vms, cases, folders=1, op_latency=0.3, latency=0.0, quota=15,
+                 preempt=0.1, watch_time=30, timeout=1800, sizes=None, snapshot_rate=0):
+        self.vms = vms
+        self.cases = cases
+        self.folders = folders
+        self.quota = quota
+        self.preempt = preempt
+        self.watch_time = watch_time
+        self.timeout = timeout
+        self.cloud = FakeCloudProcess(vms, folders, op_latency, latency, quota, sizes, snapshot_rate)
+        self.home = tempfile.TemporaryDirectory(prefix='ya-tools-bench-')
+
+    def write_config(self):
+        os.makedirs(os.path.join(self.home.name, '.ya-tools'), exist_ok=True)
+        refs = ' '.join(f'folder:f{x}' for x in range(self.folders))
+
+        with open(os.path.join(self.home.name, '.ya-tools', 'yndx.cfg'), 'w') as f:
+            f.write(CONFIG.format(refs=refs, delay=2, endpoint=self.cloud.url, quota=self.quota))
+
+    @property
+    def env(self):
+        return dict(os.environ, HOME=self.home.name, LOG_DIR=os.path.join(self.home.name, 'logs'))
+
+    def result(self, case, code, elapsed, memory, **extra):
+        stats = self.cloud.get('/_stats')
+        status = self.cloud.get('/_status')
+        return dict(
+            case=case, vms=self.vms, ok=code == 0 and set(status) == {'RUNNING'},
+            wall=round(elapsed, 2), requests=stats.get('total', 0),
+            rejected=stats.get('status 429', 0), memory=round(memory, 1), **extra
+        )
+
+    def run_snaps(self, case):
+        args = [sys.executable, os.path.join(BASEDIR, 'snaps.py')] + SNAPS_CASES[case]
+        code, elapsed, memory = run_process(args, self.env, self.timeout)
+        return self.result(case, code, elapsed, memory)
+
+    def run_watchdog(self):
+        recovery = {}
+
+        def scenario():
+            # Preempt after the first check, so the watchdog has seen the targets running
+            while not self.cloud.get('/_stats').get('GET instances'):
+                time.sleep(0.1)
+
+            started = time.monotonic()
+            stopped = self.cloud.post(f'/_preempt?count={max(int(self.vms * self.preempt), 1)}')
+
+            while time.monotonic() - started < self.watch_time:
+                if set(self.cloud.get('/_status')) == {'RUNNING'}:
+                    recovery['seconds'] = round(time.monotonic() - started, 2)
+                    break
+                time.sleep(0.1)
+
+            recovery['preempted'] = len(stopped)
+            time.sleep(max(self.watch_time - (time.monotonic() - started), 0))
+
+        args = [sys.executable, os.path.join(BASEDIR, 'watchdog.py')]
+        _, elapsed, memory = run_process(args, self.env, self.timeout, until=scenario)
+        # Stopped by the benchmark, the exit code doesn't matter
+        result = self.result('watchdog', 0, elapsed, memory, **recovery)
+        result['ok'] = result['ok'] and 'seconds' in recovery
+        return result
+
+    def run(self):
+        self.write_config()
+        self.cloud.start()
+        results = []
+
+        try:
+            for case in self.cases:
+                self.cloud.post('/_reset')
+                result = self.run_watchdog() if case == 'watchdog' else self.run_snaps(case)
+                print_result(result)
+                results.append(result)
+        finally:
+            self.cloud.stop()
+            self.home.cleanup()
+
+        return results
+
+
+def print_result(result):
+    extra = ''
+    if result['case'] == 'watchdog':
+        extra = f'  recovered {result.get("preempted", 0)} in {result.get("seconds", "-")} s'
+
+    print(
+        f'{result["case"]:<14} {result["vms"]:>6} VMs  {result["wall"]:>8.2f} s  {result["requests"]:>7} requests  '
+        f'{result["rejected"]:>5} x 429  {result["memory"]:>7.1f} MB  {"ok" if result["ok"] else "FAILED"}{extra}',
+        flush=True
+    )
+
+
+def regressions(results, baseline, tolerance):
+    '''Compare with results of a previous run, return descriptions of regressions.'''
+    previous = {(x['case'], x['vms']): x for x in baseline}
+    found = []
+
+    for result in results:
+        base = previous.get((result['case'], result['vms']))
+        if base is None:
+            continue
+
+        if not result['ok']:
+            found.append(f'{result["case"]} {result["vms"]} VMs failed')
+
+        for key in ('wall', 'requests', 'memory', 'seconds'):
+            if key in result and base.get(key) and result[key] > base[key] * (1 + tolerance):
+                found.append(f'{result["case"]} {result["vms"]} VMs: {key} {base[key]} -> {result[key]}')
+
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark snaps.py and watchdog.py against a local fake cloud')
+    parser.add_argument('--vms', type=int, nargs='+', default=[10, 100, 1000], help='numbers of instances')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--folders', type=int, default=1, help='instances are spread over folders')
+    parser.add_argument('--op-latency', type=float, default=0.3, help='seconds before an operation is done')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--quota', type=int, default=15, help='operations in flight allowed by the fake cloud')
+    parser.add_argument('--sizes', type=int, nargs='+', help='disk sizes in GiB picked at random, e.g. 20 20 20 2000 for a mixed fleet')
+    parser.add_argument('--snapshot-rate', type=float, default=0, help='GiB per second of a fake snapshot, 0 means op-latency only')
+    parser.add_argument('--preempt', type=float, default=0.1, help='fraction of instances preempted in the watchdog case')
+    parser.add_argument('--watch-time', type=float, default=30, help='seconds the watchdog runs')
+    parser.add_argument('--timeout', type=float, default=1800, help='seconds before a case is killed')
+    parser.add_argument('--json', help='write results to a file')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed growth against the baseline (fraction)')
+    args = parser.parse_args()
+
+    results = []
+    for vms in args.vms:
+        bench = Bench(
+            vms, args.cases, folders=args.folders, op_latency=args.op_latency, latency=args.latency,
+            quota=args.quota, preempt=args.preempt, watch_time=args.watch_time, timeout=args.timeout,
+            sizes=args.sizes, snapshot_rate=args.snapshot_rate
+        )
+        results += bench.run()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = [x for x in results if not x['ok']]
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f'Regression: {line}')
+        failed += found
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+import json
+import asyncio
+import logging
+
+from common.compute import (
+    BaseInstance, NEGATIVE_STATES, POSITIVE_STATES,
+    COMPUTE_URL, SNAP_URL, OPERATION_URL
+)
+from common.config import Config as config
+from common.decorators import async_retry
+from common.exceptions import QuotaError, ServerError, OperationError, OperationTimeout
+from common.operations import get_tracker
+from common.retries import retry_after
+from common.session import get_async_client, ASYNC_NETWORK_ERRORS as NETWORK_ERRORS
+from common.snapshots import parse_created_at
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncInstance(BaseInstance):
+
+    '''
+    Yandex Cloud Instance Model with non-blocking API calls.
+
+    Use "await AsyncInstance.create(instance_id)" to get a populated object.
+    Status is taken from the cached data, call refresh() to force a GET.
+
+    Attributes:
+      :folder_id: str
+      :name: str
+      :boot_disk: str
+      :secondary_disks: list
+      :disks: list
+      :snapshot_disks: list
+      :status: str
+
+    Operations rejected by quota (HTTP 429) raise QuotaError, failed
+    with HTTP 5xx raise ServerError, run them through OperationScheduler
+    to requeue automatically.
+
+    Methods (coroutines):
+      get_data() -> refresh and return instance data as dict
+      refresh() -> alias for get_data()
+      iter_snapshots() -> async generator of disk snapshots, page by page
+      get_all_snapshots() -> return list of snapshots
+      get_old_snapshots() -> async generator of snapshots older than lifetime or not kept by retention policy
+      start() -> return operation id as str
+      stop() -> return operation id as str
+      restart() -> return operation id as str
+      create_snapshot() -> return operation id as str
+      delete_snapshot() -> return operation id as str
+      operation_complete() -> wait for operation, return operation dict if succeeded
+      operations_complete() -> wait for several operations polled together
+      pending_operations() -> return running operations of the instance
+    '''
+
+    def __init__(self, instance_id, instance_data=None, token_provider=None, client=None, snapshot_index=None, cache_ttl=None, all_disks=None, journal=None):
+        super().__init__(
+            instance_id, token_provider=token_provider, snapshot_index=snapshot_index,
+            cache_ttl=cache_ttl, all_disks=all_disks, journal=journal
+        )
+        self.client = client or get_async_client()
+
+        if instance_data is not None:
+            self.set_data(instance_data)
+
+    @classmethod
+    async def create(cls, instance_id, **kwargs):
+        instance = cls(instance_id, **kwargs)
+        await instance.get_data()
+        return instance
+
+    @classmethod
+    def from_instance(cls, instance, **kwargs):
+        kwargs.setdefault('snapshot_index', instance.snapshot_index)
+        kwargs.setdefault('all_disks', instance.all_disks)
+        kwargs.setdefault('journal', instance.journal)
+        return cls(instance.instance_id, instance_data=instance.instance_data, **kwargs)
+
+    async def headers(self):
+        iam_token = await self.token_provider.async_get()
+        return self.make_headers(iam_token)
+
+    @property
+    def status(self):
+        if self.instance_data is None:
+            return 'NON-EXISTENT'
+
+        return self.instance_data.get('status')
+
+    @async_retry(NETWORK_ERRORS)
+    async def get_data(self):
+        r = await self.client.get(COMPUTE_URL + self.instance_id, headers=await self.headers())
+        res = json.loads(r.text)
+
+        if r.status_code == 404:
+            logger.warning(f'Instance with ID {self.instance_id} not exist')
+        elif r.status_code != 200:
+            logger.error(f'{r.status_code} Error in get_data: {res["message"]}')
+        else:
+            self.set_data(res)
+            return res
+
+    async def refresh(self):
+        return await self.get_data()
+
+    async def ensure_fresh(self):
+        if self.expired:
+            await self.refresh()
+
+    @async_retry(NETWORK_ERRORS)
+    async def list_snapshots_page(self, page_token=None, page_size=None, name_filter=None):
+        params = self.snapshots_params(page_token, page_size, name_filter)
+        r = await self.client.get(SNAP_URL, headers=await self.headers(), params=params)
+        res = json.loads(r.text)
+
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in get_all_snapshots: {res["message"]}')
+            return [], None
+
+        return res.get('snapshots') or [], res.get('nextPageToken')
+
+    async def iter_folder_snapshots(self, page_size=None, name_filter=None):
+        page_token = None
+
+        while True:
+            snapshots, page_token = await self.list_snapshots_page(page_token, page_size, name_filter)
+            for snapshot in snapshots:
+                yield snapshot
+
+            if not page_token:
+                break
+
+    async def iter_snapshots(self, disk_id=None, page_size=None, name_filter=None):
+        if self.instance_data is None:
+            logger.warning(f"Can't find snapshots for non-existent instance {self.instance_id}")
+            return
+
+        disk_id = self.boot_disk if disk_id is None else disk_id
+
+        if self.snapshot_index is not None:
+            await self.snapshot_index.async_ensure(self.folder_id, self.iter_folder_snapshots)
+            for snapshot in self.snapshot_index.snapshots(self.folder_id, disk_id):
+                yield snapshot
+            return
+
+        async for snapshot in self.iter_folder_snapshots(page_size, name_filter):
+            if snapshot['sourceDiskId'] == disk_id:
+                yield snapshot
+
+    async def get_all_snapshots(self):
+        if self.instance_data is None:
+            logger.warning(f"Can't find snapshots for non-existent instance {self.instance_id}")
+            return
+
+        return [x async for x in self.iter_snapshots()]
+
+    async def get_old_snapshots(self, policy=None):
+        cutoff = self.lifetime_cutoff()
+        disks = self.snapshot_disks
+
+        if not disks:
+            return
+
+        if self.snapshot_index is not None or policy is not None:
+            index = self.folder_index()
+            await index.async_ensure(self.folder_id, self.iter_folder_snapshots)
+            for disk_id in disks:
+                for snapshot in self.expired_snapshots(index.entries(self.folder_id, disk_id), cutoff, policy):
+                    yield snapshot
+            return
+
+        async for snapshot in self.iter_folder_snapshots():
+            if snapshot['sourceDiskId'] in disks and parse_created_at(snapshot) <= cutoff:
+                yield snapshot
+
+    @async_retry(NETWORK_ERRORS)
+    async def operation_status(self, operation_id):
+        r = await self.client.get(OPERATION_URL + operation_id, headers=await self.headers())
+        res = json.loads(r.text)
+
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in operation_status: {res["message"]}')
+        else:
+            return res
+
+    async def operation_complete(self, operation_id, timeout=None):
+        if not operation_id:
+            return
+
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+
+        try:
+            operation = await get_tracker().wait(operation_id, fetch=self.operation_status, timeout=timeout)
+        except OperationError as err:
+            logger.error(f'Operation {operation_id} failed: {err}')
+            self.operation_finished(operation_id, err.operation)
+            return
+        except OperationTimeout as err:
+            logger.warning(f'{err} on instance {self.name}')
+            self.operation_finished(operation_id, None)
+            return
+
+        self.operation_finished(operation_id, operation)
+
+        elapsed = loop.time() - started
+        logger.info(f'Operation {operation.get("description")} with ID {operation_id} completed in {elapsed:.1f} seconds')
+        return operation
+
+    async def operations_complete(self, operation_ids, timeout=None):
+        operations = await asyncio.gather(*[self.operation_complete(x, timeout) for x in operation_ids])
+        return dict(zip(operation_ids, operations))
+
+    @async_retry(NETWORK_ERRORS)
+    async def pending_operations(self, page_size=None):
+        # The most recent operations are enough, running ones are among them
+        params = {'pageSize': page_size or config.page_size}
+        url = COMPUTE_URL + f'{self.instance_id}/operations'
+        r = await self.client.get(url, headers=await self.headers(), params=params)
+        res = json.loads(r.text)
+
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in pending_operations: {res.get("message")}')
+            return []
+
+        return [x for x in res.get('operations') or [] if not x.get('done')]
+
+    async def _action(self, action):
+        url = COMPUTE_URL + f'{self.instance_id}:{action}'
+        r = await self.client.post(url, headers=await self.headers())
+        res = json.loads(r.text)
+
+        if r.status_code == 429:
+            raise QuotaError(res.get('message'), retry_after(r.headers))
+        elif r.status_code >= 500:
+            raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
+        elif r.status_code == 409:
+            # Another operation is running on the instance
+            logger.warning(f'Instance {self.name} is busy, {action}_vm rejected: {res.get("message")}')
+        elif r.status_code != 200:
+            logger.error(f'{r.status_code} Error in {action}_vm: {res["message"]}')
+        else:
+            # Return operation ID
+            return res.get('id')
+
+    @async_retry(NETWORK_ERRORS)
+    async def start(self):
+        await self.ensure_fresh()
+
+        if self.status not in POSITIVE_STATES:
+            operation_id = await self._action('start')
+            if operation_id:
+                logger.info(f'Starting instance {self.name} ({self.instance_id})')
+                self.operation_started('start', operation_id)
+            return operation_id
+
+        logger.warning(f'Instance {self.name} has an invalid state for this operation.')
+
+    @async_retry(NETWORK_ERRORS)
+    async def restart(self):
+        await self.ensure_fresh()
+
+        if self.status not in NEGATIVE_STATES:
+            operation_id = await self._action('restart')
+            if operation_id:
+                logger.info(f'Restarting instance {self.name} ({self.instance_id})')
+                self.operation_started('restart', operation_id)
+            return operation_id
+
+        logger.warning(f'Instance {self.name} has an invalid state for this operation.')
+
+    @async_retry(NETWORK_ERRORS)
+    async def stop(self):
+        await self.ensure_fresh()
+
+        if self.status not in NEGATIVE_STATES:
+            operation_id = await self._action('stop')
+            if operation_id:
+                logger.info(f'Stopping instance {self.name} ({self.instance_id})')
+                self.operation_started('stop', operation_id)
+            return operation_id
+
+        elif self.status == 'STOPPED':
+            logger.info(f'Instance {self.name} already stopped.')
+        else:
+            logger.warning(f'Instance {self.name} has an invalid state for this operation.')
+
+    @async_retry(NETWORK_ERRORS)
+    async def create_snapshot(self, disk_id=None):
+        disk_id = self.boot_disk if disk_id is None else disk_id
+        data = {
+            'folderId': self.folder_id,
+            'diskId': disk_id,
+            'name': self.snapshot_name(disk_id)
+        }
+        r = await self.client.post(SNAP_URL, json=data, headers=await self.headers())
+        res = json.loads(r.text)
+
+        if r.status_code == 429:
+            raise QuotaError(res.get('message'), retry_after(r.headers))
+
+        elif r.status_code >= 500:
+            raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
+
+        elif r.status_code != 200:
+            logger.error(f'{r.status_code} Error in create_snapshot: {res["message"]}')
+
+        else:
+            logger.info(f'Starting create snapshot for disk {disk_id} on {self.name}')
+            self.operation_started('snapshot', res.get('id'), disk=disk_id)
+            # Return operation ID
+            return res.get('id')
+
+    @async_retry(NETWORK_ERRORS)
+    async def delete_snapshot(self, data=None, snapshot_id=None):
+        if not data and not snapshot_id:
+            logger.error('dict data or snapshot_id required')
+            return
+
+        snapshot = data.get('id') if snapshot_id is None else snapshot_id
+        snapshot_name = data.get('name') if snapshot_id is None else snapshot_id
+
+        r = await self.client.delete(SNAP_URL + snapshot, headers=await self.headers())
+        res = json.loads(r.text)
+
+        if r.status_code == 429:
+            raise QuotaError(res.get('message'), retry_after(r.headers))
+        elif r.status_code >= 500:
+            raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
+        elif r.status_code != 200:
+            logger.error(f'{r.status_code} Error in delete_snapshot: {res.get("message")}')
+        else:
+            logger.info(f'Starting delete snapshot {snapshot_name}')
+            self.operation_started('delete', res.get('id'), snapshot=snapshot)
+            if data and self.snapshot_index is not None:
+                self.snapshot_index.discard(data)
+            # Return operation ID
+            return res.get('id')
@@ -0,0 +1,155 @@
+import time
+import random
+import asyncio
+import logging
+
+from collections import deque
+from functools import partial
+
+from common.config import Config as config
+from common.decorators import human_time
+from common.exceptions import RetryableError
+from common.operations import wait_operations
+from common.trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class DeleteStats:
+
+    '''
+    Results of a bulk deletion.
+
+    Attributes:
+      :deleted: int
+      :failed: list of (instance, snapshot)
+      :requeued: int, requests rejected with 429 or 5xx and sent again
+
+    Methods:
+      add() -> count an operation result
+      summary() -> log throughput
+    '''
+
+    def __init__(self, total=0):
+        self.total = total
+        self.deleted = 0
+        self.failed = []
+        self.requeued = 0
+        self.started = time.monotonic()
+
+    def add(self, instance, snapshot, operation):
+        if operation and not operation.get('error'):
+            self.deleted += 1
+        else:
+            self.failed.append((instance, snapshot))
+
+    def failed_instances(self):
+        return {instance.instance_id for instance, _ in self.failed}
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.deleted / elapsed if elapsed else 0
+        requeued = f', requeued {self.requeued}' if self.requeued else ''
+        logger.info(
+            f'Deleted {self.deleted} of {self.total} snapshots in {human_time(int(elapsed), 2) or "0 seconds"} '
+            f'({rate:.1f} per second), failed {len(self.failed)}{requeued}'
+        )
+
+
+def delete_snapshots(items, limit, retry_delay=5, max_delay=60, max_requeue=10):
+    '''
+    Delete (instance, snapshot) pairs with sync Instance objects.
+
+    Up to limit deletes are sent at once and their operations are polled
+    together, then the next batch is sent. Requests rejected with 429 or
+    5xx are requeued to a later batch with full-jitter backoff, honoring
+    Retry-After.
+    '''
+    stats = DeleteStats(len(items))
+    queue = deque((instance, snapshot, 0) for instance, snapshot in items)
+    backoff = 0
+    hint = None
+
+    while queue:
+        batch = []
+        rejected = []
+        started = time.monotonic()
+
+        while queue and len(batch) < limit:
+            instance, snapshot, attempt = queue.popleft()
+            try:
+                with TRACER.track(instance.name, 'delete'):
+                    operation_id = instance.delete_snapshot(data=snapshot)
+            except RetryableError as err:
+                logger.warning(f'Delete operation rejected: {err}')
+                hint = err.retry_after
+                if attempt < max_requeue:
+                    with TRACER.track(instance.name, 'delete'):
+                        TRACER.instant('retry', 'retry', kind='delete')
+                    rejected.append((instance, snapshot, attempt + 1))
+                    stats.requeued += 1
+                else:
+                    stats.add(instance, snapshot, None)
+                # Quota is exhausted, the rest waits for the next batch
+                break
+
+            if operation_id:
+                batch.append((instance, snapshot, operation_id))
+            else:
+                stats.add(instance, snapshot, None)
+
+        if batch:
+            result = wait_operations(
+                [x[2] for x in batch],
+                batch[0][0].operation_status,
+                timeout=config.operation_timeout,
+                min_interval=config.poll_min_interval,
+                max_interval=config.poll_max_interval
+            )
+            for instance, snapshot, operation_id in batch:
+                instance.operation_finished(operation_id, result.get(operation_id))
+                stats.add(instance, snapshot, result.get(operation_id))
+            backoff = 0
+
+            # Deletes of an instance span from the batch start to its operations done
+            for instance in {x[0] for x in batch}:
+                with TRACER.track(instance.name, 'delete'):
+                    TRACER.complete('delete', 'delete', started, snapshots=sum(x[0] is instance for x in batch))
+
+        if rejected:
+            queue.extendleft(reversed(rejected))
+            if not batch:
+                pause = max(random.uniform(0, min(retry_delay * 2 ** backoff, max_delay)), hint or 0)
+                logger.info(f'Requeue {len(rejected)} delete operations in {pause:.1f} seconds')
+                with TRACER.span('delete requeue', 'sleep'):
+                    time.sleep(pause)
+                backoff += 1
+                hint = None
+
+    stats.summary()
+    return stats
+
+
+async def async_delete_snapshots(items, scheduler):
+    '''
+    Delete (instance, snapshot) pairs with AsyncInstance objects.
+
+    Every delete is a scheduler job: the number of deletes in flight is
+    limited by the scheduler, operations are polled together by the shared
+    tracker, and a new delete is sent as soon as a slot is free.
+    '''
+    stats = DeleteStats(len(items))
+
+    def requeued():
+        stats.requeued += 1
+
+    async def delete(instance, snapshot):
+        submit = partial(instance.delete_snapshot, data=snapshot)
+        with TRACER.track(instance.name, 'delete'), TRACER.span('delete', 'delete', snapshot=snapshot['id']):
+            operation = await scheduler.run('delete', submit, instance.operation_complete, requeued=requeued)
+        stats.add(instance, snapshot, operation)
+
+    await asyncio.gather(*[delete(instance, snapshot) for instance, snapshot in items])
+
+    stats.summary()
+    return stats
@@ -1,87 +1,157 @@
 import json
 import time
-import asyncio
 import logging
-import requests
 
-from datetime import datetime
-from requests.exceptions import ConnectionError, Timeout
+from datetime import datetime, timedelta
 
 from common.config import Config as config
 from common.decorators import retry
+from common.exceptions import QuotaError, ServerError
+from common.metrics import OPERATION_DURATION
+from common.iam import get_token_provider
+from common.session import get_client, NETWORK_ERRORS
+from common.operations import wait_operations
+from common.retries import retry_after
+from common.snapshots import SnapshotIndex, parse_created_at
 
 logger = logging.getLogger(__name__)
 
 NEGATIVE_STATES = ['STOPPED', 'STOPPING', 'ERROR', 'CRASHED']
 POSITIVE_STATES = ['RUNNING', 'PROVISIONING', 'CREATING']
 
-IAM_URL = 'https://iam.api.cloud.yandex.net/iam/v1/tokens'
-SNAP_URL = 'https://compute.api.cloud.yandex.net/compute/v1/snapshots/'
-COMPUTE_URL = 'https://compute.api.cloud.yandex.net/compute/v1/instances/'
-DISK_URL = 'https://compute.api.cloud.yandex.net/compute/v1/disks/'
-OPERATION_URL = 'https://operation.api.cloud.yandex.net/operations/'
+# Instance status while an action is running and after it is done
+TRANSITION_STATES = {'start': 'STARTING', 'stop': 'STOPPING', 'restart': 'RESTARTING'}
+EXPECTED_STATES = {'start': 'RUNNING', 'stop': 'STOPPED', 'restart': 'RUNNING'}
 
+SNAP_URL = f'{config.compute_endpoint}/compute/v1/snapshots/'
+COMPUTE_URL = f'{config.compute_endpoint}/compute/v1/instances/'
+DISK_URL = f'{config.compute_endpoint}/compute/v1/disks/'
+OPERATION_URL = f'{config.operation_endpoint}/operations/'
 
-class Instance:
+
+class BaseInstance:
 
     '''
-    Yandex Cloud Instance Model.
+    Common attributes for sync and async Instance models.
+    Values are read from instance_data, subclasses are responsible for fetching it.
 
-    Attributes:
-      :folder_id: str
-      :name: str
-      :boot_disk: str
-      :secondary_disks: list
-      :status: str
+    Fetched data is considered fresh for cache_ttl seconds. Results of
+    start/stop/restart operations update the cached status in place,
+    so no extra GET is needed to learn the new state.
 
-    Methods:
-      get_all_snapshots() -> return list of snapshots id
-      get_old_snapshots() -> return list of old snapshots id
-      start() -> return operation id as str
-      stop() -> return operation id as str
-      create_snapshot() -> return operation id as str
-      delete_snapshot() -> return operaion id as str 
+    Operations are recorded in the journal (RunJournal) if one is given.
     '''
 
-    def __init__(self, instance_id):
-        self.iam_token = self.get_iam(config.oauth_token)
+    def __init__(self, instance_id, token_provider=None, snapshot_index=None, cache_ttl=None, all_disks=None, journal=None):
+        self.token_provider = token_provider or get_token_provider()
+        self.snapshot_index = snapshot_index
+        self.journal = journal
+        self.all_disks = config.all_disks if all_disks is None else all_disks
         self.instance_id = instance_id
         self.lifetime = int(config.lifetime)
-        self.headers = {
-            'Authorization': f'Bearer {self.iam_token}',
-            'content-type': 'application/json'
-        }
-        self.instance_data = self.get_data()
+        self.cache_ttl = config.cache_ttl if cache_ttl is None else cache_ttl
+        self.instance_data = None
+        self.fetched_at = None
+        self.pending_states = {}
+        self.operation_times = {}
 
-    @retry((ConnectionError, Timeout))
-    def get_iam(self, token):
-        r = requests.post(IAM_URL, json={'yandexPassportOauthToken': token})
-        data = json.loads(r.text)
+    def set_data(self, data):
+        self.instance_data = data
+        self.fetched_at = time.monotonic()
 
-        if r.status_code != 200:
-            logger.error(f'{r.status_code} Error in get_iam: {data["message"]}')
-            quit()
+    @property
+    def expired(self):
+        return self.fetched_at is None or time.monotonic() - self.fetched_at > self.cache_ttl
 
-        else:
-            iam_token = data.get('iamToken')
-            return iam_token
+    def invalidate(self):
+        self.fetched_at = None
+
+    def set_status(self, status):
+        if self.instance_data is not None:
+            self.instance_data['status'] = status
+            self.fetched_at = time.monotonic()
+
+    def operation_started(self, action, operation_id, **details):
+        self.operation_times[operation_id] = (action, time.monotonic())
+
+        if action in TRANSITION_STATES:
+            self.set_status(TRANSITION_STATES[action])
+            self.pending_states[operation_id] = EXPECTED_STATES[action]
+
+        if self.journal is not None:
+            self.journal.operation(self.instance_id, action, operation_id, **details)
+
+    def operation_finished(self, operation_id, operation):
+        expected = self.pending_states.pop(operation_id, None)
+        action = None
+
+        if operation_id in self.operation_times:
+            action, started = self.operation_times.pop(operation_id)
+            result = 'unknown' if not operation else 'error' if operation.get('error') else 'ok'
+            OPERATION_DURATION.observe(time.monotonic() - started, type=action, result=result)
+
+        if self.journal is not None:
+            self.journal.finished(operation_id, operation)
+
+        if not operation or operation.get('error'):
+            # Unknown outcome, next status read goes to the API
+            self.invalidate()
+            return
+
+        response = operation.get('response') or {}
+        if action == 'snapshot' and response.get('sourceDiskId') and self.snapshot_index is not None:
+            # An index kept between runs sees the new snapshot without listing the folder again
+            self.snapshot_index.add(response)
+        elif response.get('id') == self.instance_id and response.get('status'):
+            self.set_data(response)
+        elif expected:
+            self.set_status(expected)
 
     def call_time(self):
         current_time = datetime.now()
         raw_time = current_time.strftime('%d-%m-%Y-%H-%M-%S')
         return raw_time
 
-    @retry((ConnectionError, Timeout))
-    def get_data(self):
-        r = requests.get(COMPUTE_URL + self.instance_id, headers=self.headers)
-        res = json.loads(r.text)
+    def make_headers(self, iam_token):
+        return {
+            'Authorization': f'Bearer {iam_token}',
+            'content-type': 'application/json'
+        }
 
-        if r.status_code == 404:
-            logger.warning(f'Instance with ID {self.instance_id} not exist')
-        elif r.status_code != 200:
-            logger.error(f'{r.status_code} Error in get_data: {res["message"]}')
-        else:
-            return res
+    def snapshots_params(self, page_token=None, page_size=None, name_filter=None):
+        # The API filters snapshots only by name, source disk is checked on our side
+        params = {
+            'folderId': self.folder_id,
+            'pageSize': page_size or config.page_size
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        if name_filter:
+            params['filter'] = name_filter
+
+        return params
+
+    def lifetime_cutoff(self):
+        # Snapshots created at or before this moment are older than lifetime
+        return datetime.utcnow() - timedelta(days=self.lifetime)
+
+    def folder_index(self):
+        # Retention policies need sorted snapshots, without a shared index one is built per call
+        return self.snapshot_index if self.snapshot_index is not None else SnapshotIndex()
+
+    def expired_snapshots(self, entries, cutoff, policy=None):
+        # Entries are (created_at, snapshot) sorted oldest first
+        if policy is not None:
+            for _, snapshot, reasons in policy.plan(entries):
+                if not reasons:
+                    yield snapshot
+            return
+
+        for created_at, snapshot in entries:
+            # The rest are newer
+            if created_at > cutoff:
+                break
+            yield snapshot
 
     @property
     def folder_id(self):
@@ -117,12 +187,26 @@ class Instance:
         return disks
 
     @property
-    def status(self):
+    def disks(self):
         if self.instance_data is None:
-            return 'NON-EXISTENT'
+            return []
+
+        return [self.boot_disk] + self.secondary_disks
+
+    @property
+    def snapshot_disks(self):
+        # Disks covered by snapshots and retention: boot disk only or all of them
+        if self.all_disks:
+            return self.disks
+
+        return self.disks[:1]
+
+    def snapshot_name(self, disk_id):
+        if disk_id == self.boot_disk:
+            return f'{self.name}-{self.call_time()}'
 
-        status = self.get_data().get('status')
-        return status
+        # Several disks are snapshotted in the same second, names must differ
+        return f'{self.name}-{disk_id}-{self.call_time()}'
 
     def __repr__(self):
         data = {
@@ -144,109 +228,198 @@ class Instance:
         except (TypeError, AttributeError):
             logger.info(f'Instance with ID {self.instance_id} not found.')
 
-    @retry((ConnectionError, Timeout))
-    def get_all_snapshots(self):
-        try:
-            r = requests.get(SNAP_URL, headers=self.headers, json={'folderId': self.folder_id})
-            res = json.loads(r.text)
 
-            if r.status_code != 200:
-                logger.error(f'{r.status_code} Error in get_all_snapshots: {res["message"]}')
+class Instance(BaseInstance):
 
-            else:
-                result = []
-                snapshots = res.get('snapshots')
+    '''
+    Yandex Cloud Instance Model.
+
+    Attributes:
+      :folder_id: str
+      :name: str
+      :boot_disk: str
+      :secondary_disks: list
+      :disks: list
+      :snapshot_disks: list
+      :status: str
+
+    Methods:
+      iter_snapshots() -> yield snapshots of the disk page by page
+      get_all_snapshots() -> return list of snapshots
+      get_old_snapshots() -> yield snapshots older than lifetime or not kept by retention policy
+      start() -> return operation id as str, raise QuotaError or ServerError if rejected
+      stop() -> return operation id as str, raise QuotaError or ServerError if rejected
+      create_snapshot() -> return operation id as str, raise QuotaError or ServerError if rejected
+      delete_snapshot() -> return operaion id as str, raise QuotaError or ServerError if rejected
+      operation_complete() -> wait for operation, return operation dict if succeeded
+      operations_complete() -> wait for several operations polled together
+    '''
+
+    def __init__(self, instance_id, instance_data=None, token_provider=None, client=None, snapshot_index=None, cache_ttl=None, all_disks=None, journal=None):
+        super().__init__(
+            instance_id, token_provider=token_provider, snapshot_index=snapshot_index,
+            cache_ttl=cache_ttl, all_disks=all_disks, journal=journal
+        )
+        self.client = client or get_client()
+
+        # Data from a folder listing saves a GET per instance
+        if instance_data is None:
+            self.get_data()
+        else:
+            self.set_data(instance_data)
+
+    @property
+    def iam_token(self):
+        return self.token_provider.get()
+
+    @property
+    def headers(self):
+        return self.make_headers(self.iam_token)
+
+    @retry(NETWORK_ERRORS)
+    def get_data(self):
+        r = self.client.get(COMPUTE_URL + self.instance_id, headers=self.headers)
+        res = json.loads(r.text)
+
+        if r.status_code == 404:
+            logger.warning(f'Instance with ID {self.instance_id} not exist')
+        elif r.status_code != 200:
+            logger.error(f'{r.status_code} Error in get_data: {res["message"]}')
+        else:
+            self.set_data(res)
+            return res
+
+    def refresh(self):
+        return self.get_data()
+
+    @property
+    def status(self):
+        if self.instance_data is None:
+            return 'NON-EXISTENT'
+
+        if self.expired:
+            self.refresh()
+
+        return self.instance_data.get('status')
+
+    @retry(NETWORK_ERRORS)
+    def list_snapshots_page(self, page_token=None, page_size=None, name_filter=None):
+        params = self.snapshots_params(page_token, page_size, name_filter)
+        r = self.client.get(SNAP_URL, headers=self.headers, params=params)
+        res = json.loads(r.text)
+
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in get_all_snapshots: {res["message"]}')
+            return [], None
 
-                for snapshot in snapshots:
-                    if snapshot['sourceDiskId'] == self.boot_disk:
-                        result.append(snapshot)
+        return res.get('snapshots') or [], res.get('nextPageToken')
 
-                return result
+    def iter_folder_snapshots(self, page_size=None, name_filter=None):
+        page_token = None
 
-        except TypeError:
-            logger.info(f'Snapshots for {self.name} not found.')
-        except AttributeError:
+        while True:
+            snapshots, page_token = self.list_snapshots_page(page_token, page_size, name_filter)
+            yield from snapshots
+
+            if not page_token:
+                break
+
+    def iter_snapshots(self, disk_id=None, page_size=None, name_filter=None):
+        if self.instance_data is None:
             logger.warning(f"Can't find snapshots for non-existent instance {self.instance_id}")
+            return
 
-    def get_old_snapshots(self):
-        result = []
-        all_snapshots = self.get_all_snapshots()
-    
-        if all_snapshots:
-            for snapshot in all_snapshots:
-                created_at = datetime.strptime(snapshot['createdAt'], '%Y-%m-%dT%H:%M:%Sz')
-                today = datetime.utcnow()
-                age = int((today - created_at).total_seconds()) // 86400
+        disk_id = self.boot_disk if disk_id is None else disk_id
 
-                if age >= self.lifetime:
-                    result.append(snapshot)
+        if self.snapshot_index is not None:
+            self.snapshot_index.ensure(self.folder_id, self.iter_folder_snapshots)
+            yield from self.snapshot_index.snapshots(self.folder_id, disk_id)
+            return
 
-            return result
+        for snapshot in self.iter_folder_snapshots(page_size, name_filter):
+            if snapshot['sourceDiskId'] == disk_id:
+                yield snapshot
+
+    def get_all_snapshots(self):
+        if self.instance_data is None:
+            logger.warning(f"Can't find snapshots for non-existent instance {self.instance_id}")
+            return
+
+        return list(self.iter_snapshots())
+
+    def get_old_snapshots(self, policy=None):
+        '''Snapshots older than lifetime, or not kept by RetentionPolicy if given.'''
+        cutoff = self.lifetime_cutoff()
+        disks = self.snapshot_disks
+
+        if (self.snapshot_index is not None or policy is not None) and disks:
+            index = self.folder_index()
+            index.ensure(self.folder_id, self.iter_folder_snapshots)
+            for disk_id in disks:
+                yield from self.expired_snapshots(index.entries(self.folder_id, disk_id), cutoff, policy)
+            return
 
-    @retry((ConnectionError, Timeout))
+        for snapshot in self.iter_folder_snapshots() if disks else []:
+            if snapshot['sourceDiskId'] in disks and parse_created_at(snapshot) <= cutoff:
+                yield snapshot
+
+    @retry(NETWORK_ERRORS)
     def operation_status(self, operation_id):
+        # Network errors and an open circuit go to the retry decorator, a failed
+        # poll after the retries is skipped by wait_operations()
+        r = self.client.get(OPERATION_URL + operation_id, headers=self.headers)
+
         try:
-            r = requests.get(OPERATION_URL + operation_id, headers=self.headers)
             res = json.loads(r.text)
+        except ValueError:
+            logger.error(f'{r.status_code} Error in operation_status: response is not JSON')
+            return
 
-            if r.status_code != 200:
-                logger.error(f'{r.status_code} Error in operation_status: {res["message"]}')
-
-            else:
-                return res
-
-        except requests.exceptions.ConnectionError:
-            logger.warning('Connection error. Please check your network connection')
-        except Exception as err:
-            logger.error(f'Error in operation_status: {err}')
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in operation_status: {res.get("message")}')
+        else:
+            return res
 
-    async def async_operation_complete(self, operation_id):
-        if operation_id:
-            timeout = 0
-            while True:
-                operation = self.operation_status(operation_id)
-                await asyncio.sleep(2)
-                timeout += 2
-
-                if operation.get('done') is True:
-                    msg = f'Operation {operation.get("description")} with ID {operation_id} completed'
-                    logger.info(msg)
-                    return msg
-
-                elif timeout == 600:
-                    msg = f'Operation {operation.get("description")} with {operation_id} running too long.'
-                    logger.warning(msg)
-                    return msg
-
-    def operation_complete(self, operation_id):
+    def operations_complete(self, operation_ids, timeout=None):
+        started = time.monotonic()
+        result = wait_operations(
+            operation_ids,
+            self.operation_status,
+            timeout=timeout or config.operation_timeout,
+            min_interval=config.poll_min_interval,
+            max_interval=config.poll_max_interval
+        )
+        elapsed = time.monotonic() - started
+
+        for operation_id, operation in result.items():
+            self.operation_finished(operation_id, operation)
+            if operation and not operation.get('error'):
+                logger.info(f'Operation {operation.get("description")} with ID {operation_id} completed in {elapsed:.1f} seconds')
+
+        return result
+
+    def operation_complete(self, operation_id, timeout=None):
         if operation_id:
-            timeout = 0
-            while True:
-                operation = self.operation_status(operation_id)
-                time.sleep(2)
-                timeout += 2
-
-                if operation.get('done') is True:
-                    msg = f'Operation {operation.get("description")} with ID {operation_id} completed'
-                    logger.info(msg)
-                    return msg
-
-                elif timeout == 600:
-                    msg = f'Operation {operation.get("description")} with {operation_id} running too long.'
-                    logger.warning(msg)
-                    return msg
-
-    @retry((ConnectionError, Timeout))
+            operation = self.operations_complete([operation_id], timeout).get(operation_id)
+            if operation and not operation.get('error'):
+                return operation
+
+    @retry(NETWORK_ERRORS)
     def start(self):
         if self.status not in POSITIVE_STATES:
-            r = requests.post(COMPUTE_URL + f'{self.instance_id}:start', headers=self.headers)
+            r = self.client.post(COMPUTE_URL + f'{self.instance_id}:start', headers=self.headers)
             res = json.loads(r.text)
 
-            if r.status_code != 200:
+            if r.status_code == 429:
+                raise QuotaError(res.get('message'), retry_after(r.headers))
+            elif r.status_code >= 500:
+                raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
+            elif r.status_code != 200:
                 logger.error(f'{r.status_code} Error in start_vm: {res["message"]}')
 
             else:
                 logger.info(f'Starting instance {self.name} ({self.instance_id})')
+                self.operation_started('start', res.get('id'))
                 # Return operation ID
                 return res.get('id')
 
@@ -254,17 +427,22 @@ class Instance:
             logger.warning(f'Instance {self.name} has an invalid state for this operation.')
 
 
-    @retry((ConnectionError, Timeout))
+    @retry(NETWORK_ERRORS)
     def restart(self):
         if self.status not in NEGATIVE_STATES:
-            r = requests.post(COMPUTE_URL + f'{self.instance_id}:restart', headers=self.headers)
+            r = self.client.post(COMPUTE_URL + f'{self.instance_id}:restart', headers=self.headers)
             res = json.loads(r.text)
 
-            if r.status_code != 200:
+            if r.status_code == 429:
+                raise QuotaError(res.get('message'), retry_after(r.headers))
+            elif r.status_code >= 500:
+                raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
+            elif r.status_code != 200:
                 logger.error(f'{r.status_code} Error in restart_vm: {res["message"]}')
 
             else:
                 logger.info(f'Restarting instance {self.name} ({self.instance_id})')
+                self.operation_started('restart', res.get('id'))
                 # Return operation ID
                 return res.get('id')
 
@@ -272,16 +450,21 @@ class Instance:
             logger.warning(f'Instance {self.name} has an invalid state for this operation.')
 
 
-    @retry((ConnectionError, Timeout))
+    @retry(NETWORK_ERRORS)
     def stop(self):
         if self.status not in NEGATIVE_STATES:
-            r = requests.post(COMPUTE_URL + f'{self.instance_id}:stop', headers=self.headers)
+            r = self.client.post(COMPUTE_URL + f'{self.instance_id}:stop', headers=self.headers)
             res = json.loads(r.text)
 
-            if r.status_code != 200:
+            if r.status_code == 429:
+                raise QuotaError(res.get('message'), retry_after(r.headers))
+            elif r.status_code >= 500:
+                raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
+            elif r.status_code != 200:
                 logger.error(f'{r.status_code} Error in stop_vm: {res["message"]}')
             else:
                 logger.info(f'Stopping instance {self.name} ({self.instance_id})')
+                self.operation_started('stop', res.get('id'))
                 # Return operation ID
                 return res.get('id')
 
@@ -290,29 +473,32 @@ class Instance:
         else:
             logger.warning(f'Instance {self.name} has an invalid state for this operation.')
 
-    @retry((ConnectionError, Timeout))
+    @retry(NETWORK_ERRORS)
     def create_snapshot(self, disk_id=None):
+        disk_id = self.boot_disk if disk_id is None else disk_id
         data = {
             'folderId': self.folder_id,
-            'diskId': self.boot_disk if disk_id is None else disk_id,
-            'name': f'{self.name}-{self.call_time()}'
+            'diskId': disk_id,
+            'name': self.snapshot_name(disk_id)
         }
-        r = requests.post(SNAP_URL, json=data, headers=self.headers)
+        r = self.client.post(SNAP_URL, json=data, headers=self.headers)
         res = json.loads(r.text)
 
+        # Rejected requests are requeued by the caller
         if r.status_code == 429:
-            logger.warning(f'Snapshot NOT CREATED for instance {self.name}. Error: {res["message"]}')
-            logger.error(f'QUOTA ERROR: {res["message"]}')
-
+            raise QuotaError(res.get('message'), retry_after(r.headers))
+        elif r.status_code >= 500:
+            raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
         elif r.status_code != 200:
             logger.error(f'{r.status_code} Error in create_snapshot: {res["message"]}')
 
         else:
-            logger.info(f'Starting create snapshot for boot-disk {self.boot_disk} on {self.name}')
+            logger.info(f'Starting create snapshot for disk {disk_id} on {self.name}')
+            self.operation_started('snapshot', res.get('id'), disk=disk_id)
             # Return operation ID
             return res.get('id')
 
-    @retry((ConnectionError, Timeout))
+    @retry(NETWORK_ERRORS)
     def delete_snapshot(self, data=None, snapshot_id=None):
         if not data and not snapshot_id:
             logging.error('dict data or snapshot_id required')
@@ -321,12 +507,20 @@ class Instance:
         snapshot = data.get('id') if snapshot_id is None else snapshot_id
         snapshot_name = data.get('name') if snapshot_id is None else snapshot_id
 
-        r = requests.delete(SNAP_URL + snapshot, headers=self.headers)
+        r = self.client.delete(SNAP_URL + snapshot, headers=self.headers)
         res = json.loads(r.text)
 
-        if r.status_code != 200:
+        # Bulk deletion requeues rejected requests
+        if r.status_code == 429:
+            raise QuotaError(res.get('message'), retry_after(r.headers))
+        elif r.status_code >= 500:
+            raise ServerError(f'{r.status_code} {res.get("message")}', retry_after(r.headers))
+        elif r.status_code != 200:
             logger.error(f'{r.status_code} Error in delete_snapshot: {res.get("message")}')
         else:
             logger.info(f'Starting delete snapshot {snapshot_name}')
+            self.operation_started('delete', res.get('id'), snapshot=snapshot)
+            if data and self.snapshot_index is not None:
+                self.snapshot_index.discard(data)
             # Return operation ID
             return res.get('id')
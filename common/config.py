@@ -7,15 +7,115 @@ from os import getenv
 
 logger = logging.getLogger(__name__)
 
-SERVERLESS = False  # later
+# Set by handler.py: configuration comes from env, nothing is read from files
+SERVERLESS = getenv('SERVERLESS', '').lower() in ('1', 'yes', 'true', 'on')
+
+RETENTION_KEYS = ('last', 'days', 'daily', 'weekly', 'monthly')
+
+DEFAULT_ENDPOINTS = {
+    'iam': 'https://iam.api.cloud.yandex.net',
+    'compute': 'https://compute.api.cloud.yandex.net',
+    'operation': 'https://operation.api.cloud.yandex.net'
+}
+
+
+def api_endpoint(name, endpoint=None):
+    '''Base URL of an API, endpoint replaces the cloud hosts of all APIs.'''
+    return endpoint.rstrip('/') if endpoint else DEFAULT_ENDPOINTS[name]
+
+
+def parse_retention(value):
+    '''Parse policy from "daily=7,weekly=4" string.'''
+    policy = {}
+    for item in filter(None, (value or '').split(',')):
+        key, _, count = item.partition('=')
+        if key.strip() in RETENTION_KEYS:
+            policy[key.strip()] = int(count)
+
+    return policy
+
+
+def parse_rates(value):
+    '''Parse snapshot rates by disk type from "network-ssd=200,network-hdd=80" string.'''
+    rates = {}
+    for item in filter(None, (value or '').replace(' ', ',').split(',')):
+        disk_type, _, rate = item.partition('=')
+        rates[disk_type.strip()] = float(rate)
+
+    return rates
+
+
+def retention_sections(parser):
+    '''[Retention] is the default policy (None key), [Retention <ref>] sections override it.'''
+    policies = {}
+    for section in parser.sections():
+        if section == 'Retention' or section.startswith('Retention '):
+            ref = section[len('Retention'):].strip() or None
+            policies[ref] = {
+                key: parser.getint(section, key)
+                for key in RETENTION_KEYS if parser.has_option(section, key)
+            }
+
+    return policies
+
+
+def schedule_sections(parser):
+    '''[Schedule] is the default schedule (None key), [Schedule <ref>] sections are groups.'''
+    schedules = {}
+    for section in parser.sections():
+        if section == 'Schedule' or section.startswith('Schedule '):
+            ref = section[len('Schedule'):].strip() or None
+            schedules[ref] = {
+                key: parser.get(section, key)
+                for key in ('cron', 'mode') if parser.has_option(section, key)
+            }
+
+    return schedules
 
 
 class Config:
 
     if SERVERLESS:
         oauth_token = getenv('TOKEN')
-        lifetime = getenv('LIFETIME')
-        instances_list = getenv('INSTANCES').split(',')
+        lifetime = getenv('LIFETIME', 365)
+        instances_list = [x for x in getenv('INSTANCES', '').split(',') if x]
+        folders_list = [x for x in getenv('FOLDERS', '').split(',') if x]
+        iam_cache = False
+        pool_size = int(getenv('POOL_SIZE', 10))
+        connect_timeout = float(getenv('CONNECT_TIMEOUT', 5))
+        read_timeout = float(getenv('READ_TIMEOUT', 30))
+        iam_endpoint = api_endpoint('iam', getenv('API_ENDPOINT'))
+        compute_endpoint = api_endpoint('compute', getenv('API_ENDPOINT'))
+        operation_endpoint = api_endpoint('operation', getenv('API_ENDPOINT'))
+        retry_tries = int(getenv('RETRY_TRIES', 4))
+        retry_delay = float(getenv('RETRY_DELAY', 1))
+        retry_max_delay = float(getenv('RETRY_MAX_DELAY', 30))
+        retry_deadline = float(getenv('RETRY_DEADLINE', 120))
+        retry_statuses = [int(x) for x in getenv('RETRY_STATUSES', '429 502 503 504').split()]
+        breaker_threshold = int(getenv('BREAKER_THRESHOLD', 5))
+        breaker_reset_timeout = float(getenv('BREAKER_RESET_TIMEOUT', 30))
+        max_operations = int(getenv('MAX_OPERATIONS', 15))
+        page_size = int(getenv('PAGE_SIZE', 100))
+        all_disks = getenv('ALL_DISKS', '').lower() in ('1', 'yes', 'true', 'on')
+        journal = False
+        retention = {None: parse_retention(getenv('RETENTION'))}
+        cache_ttl = float(getenv('CACHE_TTL', 10))
+        resolve_interval = int(getenv('RESOLVE_INTERVAL', 300))
+        operation_timeout = int(getenv('OPERATION_TIMEOUT', 600))
+        poll_min_interval = float(getenv('POLL_MIN_INTERVAL', 1))
+        poll_max_interval = float(getenv('POLL_MAX_INTERVAL', 10))
+        operation_limits = {}
+        metrics_textfile = ''
+        schedules = {}
+        index_ttl = 0
+        plan_order = getenv('PLAN_ORDER', 'yes').lower() in ('1', 'yes', 'true', 'on')
+        plan_stop_time = float(getenv('PLAN_STOP_TIME', 30))
+        plan_start_time = float(getenv('PLAN_START_TIME', 30))
+        plan_snapshot_time = float(getenv('PLAN_SNAPSHOT_TIME', 10))
+        plan_snapshot_rate = float(getenv('PLAN_SNAPSHOT_RATE', 100))
+        plan_snapshot_rates = parse_rates(getenv('PLAN_SNAPSHOT_RATES'))
+        trace_file = getenv('TRACE_FILE', '')
+        trace_top = int(getenv('TRACE_TOP', 10))
 
     else:
         try:
@@ -33,19 +133,123 @@ class Config:
                 logger.error('OAuth_token is empty. Please add oAuth-token to ~/.ya-tools/yndx.cfg')
                 quit()
 
+            # Persist IAM token in ~/.ya-tools/iam.json to reuse it between runs
+            iam_cache = config.getboolean('Auth', 'IAM_cache', fallback=False)
+
             lifetime = config.get('Snapshots', 'Lifetime')
             if not lifetime:
                 logger.warning('Snapshot lifetime is empty. Using default value: 365 days')
                 lifetime = 365
 
+            # Snapshot secondary disks too, not only the boot disk
+            all_disks = config.getboolean('Snapshots', 'all_disks', fallback=False)
+
+            # Record operations of a run in ~/.ya-tools/snaps.journal for --resume
+            journal = config.getboolean('Snapshots', 'journal', fallback=True)
+
+            # GFS retention policies, Lifetime is used without them
+            retention = retention_sections(config)
+
+            # Cron schedules of snaps.py --daemon, the snapshot index kept
+            # between daemon runs is listed again after index_ttl seconds
+            schedules = schedule_sections(config)
+            index_ttl = config.getint('Schedule', 'index_ttl', fallback=3600)
+
+            # Snapshots per page when listing a folder (API maximum is 1000)
+            page_size = config.getint('Snapshots', 'page_size', fallback=100)
+
             watchdog_delay = config.get('Watchdog', 'delay')
             if not watchdog_delay:
                 logger.warning('Watchdog delay is empty. Using default delay: 10 seconds')
                 watchdog_delay = 10
 
             instances_list = config.get('Instances', 'IDs').split(' ')
+            folders_list = config.get('Instances', 'folders', fallback='').split()
             targets_list = config.get('Watchdog', 'targets').split(' ')
 
+            # Seconds between re-resolving label selectors and folder scopes of targets
+            resolve_interval = config.getint('Watchdog', 'resolve_interval', fallback=300)
+
+            # Poll every fast_delay seconds for fast_period seconds after a stop or start,
+            # intervals vary by jitter (fraction), crash looping instances wait backoff..max_backoff seconds
+            watchdog_fast_delay = config.getfloat('Watchdog', 'fast_delay', fallback=2)
+            watchdog_fast_period = config.getint('Watchdog', 'fast_period', fallback=120)
+            watchdog_jitter = config.getfloat('Watchdog', 'jitter', fallback=0.1)
+            watchdog_backoff = config.getint('Watchdog', 'backoff', fallback=30)
+            watchdog_max_backoff = config.getint('Watchdog', 'max_backoff', fallback=1800)
+
+            # Watchdog replicas sharing a lease store split targets into shards,
+            # a shard of a dead replica is taken over after lease_ttl seconds.
+            # store is sqlite:///path/leases.db (or a path), empty means one replica
+            shard_store = config.get('Sharding', 'store', fallback='')
+            shard_replica = config.get('Sharding', 'replica', fallback='')
+            shard_count = config.getint('Sharding', 'shards', fallback=256)
+            shard_lease_ttl = config.getfloat('Sharding', 'lease_ttl', fallback=10)
+            shard_heartbeat = config.getfloat('Sharding', 'heartbeat', fallback=3)
+
+            # Seconds during which fetched instance data is reused without a GET
+            cache_ttl = config.getfloat('Instances', 'cache_ttl', fallback=10)
+
+            # HTTP keep-alive pool size (per API host) and request timeouts in seconds
+            pool_size = config.getint('Network', 'pool_size', fallback=10)
+            connect_timeout = config.getfloat('Network', 'connect_timeout', fallback=5)
+            read_timeout = config.getfloat('Network', 'read_timeout', fallback=30)
+
+            # One base URL for all APIs instead of the cloud hosts: a proxy or bench/fakecloud.py
+            endpoint = config.get('Network', 'endpoint', fallback='')
+            iam_endpoint = api_endpoint('iam', endpoint)
+            compute_endpoint = api_endpoint('compute', endpoint)
+            operation_endpoint = api_endpoint('operation', endpoint)
+
+            # Retries of failed requests: full-jitter backoff from delay up to max_delay seconds,
+            # at most tries attempts within deadline seconds (0 means no deadline)
+            retry_tries = config.getint('Retry', 'tries', fallback=4)
+            retry_delay = config.getfloat('Retry', 'delay', fallback=1)
+            retry_max_delay = config.getfloat('Retry', 'max_delay', fallback=30)
+            retry_deadline = config.getfloat('Retry', 'deadline', fallback=120)
+            retry_statuses = [int(x) for x in config.get('Retry', 'statuses', fallback='429 502 503 504').split()]
+
+            # Requests to an endpoint fail fast for reset_timeout seconds
+            # after breaker_threshold failures in a row (0 disables it)
+            breaker_threshold = config.getint('Retry', 'breaker_threshold', fallback=5)
+            breaker_reset_timeout = config.getfloat('Retry', 'breaker_reset_timeout', fallback=30)
+
+            # Active operations in flight: total and per operation type (0 means no own limit)
+            max_operations = config.getint('Quota', 'operations', fallback=15)
+            operation_limits = {
+                'stop': config.getint('Quota', 'stop', fallback=0),
+                'start': config.getint('Quota', 'start', fallback=0),
+                'snapshot': config.getint('Quota', 'snapshot', fallback=0),
+                'delete': config.getint('Quota', 'delete', fallback=0)
+            }
+
+            # Watchdog serves /metrics on host:port (0 disables it), snapshotter
+            # writes metrics to textfile after a run (empty disables it)
+            metrics_host = config.get('Metrics', 'host', fallback='127.0.0.1')
+            metrics_port = config.getint('Metrics', 'port', fallback=0)
+            metrics_textfile = config.get('Metrics', 'textfile', fallback='')
+
+            # Async runs start the longest jobs first (order = no keeps config order),
+            # durations are estimated from stop and start times in seconds and snapshot
+            # time: snapshot_time seconds plus disk size at snapshot_rate MB per second,
+            # snapshot_rates overrides it by disk type (network-ssd=200,network-hdd=80)
+            plan_order = config.getboolean('Planner', 'order', fallback=True)
+            plan_stop_time = config.getfloat('Planner', 'stop_time', fallback=30)
+            plan_start_time = config.getfloat('Planner', 'start_time', fallback=30)
+            plan_snapshot_time = config.getfloat('Planner', 'snapshot_time', fallback=10)
+            plan_snapshot_rate = config.getfloat('Planner', 'snapshot_rate', fallback=100)
+            plan_snapshot_rates = parse_rates(config.get('Planner', 'snapshot_rates', fallback=''))
+
+            # Snapshotter writes a timeline of every run to file (strftime patterns
+            # are filled with the run start, empty disables it) and logs top slowest instances
+            trace_file = os.path.expanduser(config.get('Trace', 'file', fallback=''))
+            trace_top = config.getint('Trace', 'top', fallback=10)
+
+            # Operation deadline and polling interval bounds in seconds
+            operation_timeout = config.getint('Operations', 'timeout', fallback=600)
+            poll_min_interval = config.getfloat('Operations', 'poll_min_interval', fallback=1)
+            poll_max_interval = config.getfloat('Operations', 'poll_max_interval', fallback=10)
+
             logger.info(f'Config loaded')
 
         except (FileNotFoundError, ValueError, configparser.NoSectionError):
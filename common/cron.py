@@ -0,0 +1,192 @@
+import logging
+
+from datetime import timedelta
+
+from common.config import Config as config
+from common.discovery import match_ref
+
+logger = logging.getLogger(__name__)
+
+MODES = ('create', 'delete', 'full')
+MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *'
+}
+MONTHS = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+WEEKDAYS = ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat')
+
+
+def parse_value(value, low, names):
+    value = value.lower()
+    if names and value in names:
+        return names.index(value) + low
+
+    return int(value)
+
+
+def parse_field(field, low, high, names=None):
+    '''Parse cron field: *, N, N-M, lists and /step, month and weekday names.'''
+    values = set()
+
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (parse_value(x, low, names) for x in part.split('-', 1))
+        else:
+            start = parse_value(part, low, names)
+            # N/step runs from N to the end of the range
+            end = high if step > 1 else start
+
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(f'Invalid cron field "{field}"')
+
+        values.update(range(start, end + 1, step))
+
+    return values
+
+
+class CronExpression:
+
+    '''
+    Five-field cron expression in local time: minute hour day month weekday.
+
+    Fields take *, numbers, ranges (1-5), lists (1,15), steps (*/10, 0-30/5)
+    and names of months and weekdays (jan, mon). Weekday 0 and 7 is Sunday.
+    @hourly, @daily, @weekly, @monthly and @yearly are accepted too. As in
+    cron, when both day and weekday are restricted a day matching either
+    of them matches.
+
+    Methods:
+      match() -> True if datetime matches the expression
+      next_after() -> return next matching datetime after the given one
+    '''
+
+    def __init__(self, expression):
+        self.expression = expression.strip()
+        fields = MACROS.get(self.expression.lower(), self.expression).split()
+
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression "{expression}" must have 5 fields')
+
+        self.minutes = parse_field(fields[0], 0, 59)
+        self.hours = parse_field(fields[1], 0, 23)
+        self.days = parse_field(fields[2], 1, 31)
+        self.months = parse_field(fields[3], 1, 12, MONTHS)
+        self.weekdays = {x % 7 for x in parse_field(fields[4], 0, 7, WEEKDAYS)}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def match_day(self, value):
+        day = value.day in self.days
+        weekday = value.isoweekday() % 7 in self.weekdays
+
+        if self.any_day or self.any_weekday:
+            return day and weekday
+
+        return day or weekday
+
+    def match(self, value):
+        return (
+            value.month in self.months and self.match_day(value)
+            and value.hour in self.hours and value.minute in self.minutes
+        )
+
+    def next_after(self, value):
+        value = value.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Feb 29 on a given weekday may take years, nothing takes longer
+        limit = value + timedelta(days=366 * 8)
+
+        while value < limit:
+            if value.month not in self.months:
+                month = value.replace(day=1, hour=0, minute=0)
+                value = (month + timedelta(days=32)).replace(day=1)
+            elif not self.match_day(value):
+                value = value.replace(hour=0, minute=0) + timedelta(days=1)
+            elif value.hour not in self.hours:
+                value = value.replace(minute=0) + timedelta(hours=1)
+            elif value.minute not in self.minutes:
+                value += timedelta(minutes=1)
+            else:
+                return value
+
+        raise ValueError(f'Cron expression "{self.expression}" never matches')
+
+    def __str__(self):
+        return self.expression
+
+
+class ScheduleGroup:
+
+    '''
+    Instances snapshotted on one cron schedule.
+
+    Attributes:
+      :ref: config entry of the group, None for the default schedule
+      :cron: CronExpression
+      :mode: create, delete or full
+    '''
+
+    def __init__(self, ref, cron, mode='full'):
+        if mode not in MODES:
+            raise ValueError(f'Unknown mode "{mode}" of schedule {ref or "default"}, use one of {", ".join(MODES)}')
+
+        self.ref = ref
+        self.cron = CronExpression(cron)
+        self.mode = mode
+
+    @property
+    def name(self):
+        return self.ref or 'default'
+
+    def __str__(self):
+        return f'{self.name} ({self.cron}, {self.mode})'
+
+
+class Schedules:
+
+    '''
+    Schedules from [Schedule] config sections.
+
+    [Schedule] is the default schedule, [Schedule <ref>] sections are
+    groups of instances matched by ref: instance ID, name, label selector
+    or folder scope, the same entries as in [Instances]. The mode missing
+    in a group is taken from the default section. The first matching
+    group wins, instances without a group and without a default schedule
+    are not snapshotted by the daemon.
+
+    Methods:
+      get() -> return ScheduleGroup for instance data or None
+    '''
+
+    def __init__(self, default=None, groups=None):
+        self.default = default
+        self.groups = groups or []
+
+    @classmethod
+    def from_config(cls):
+        sections = dict(config.schedules)
+        default = sections.pop(None, {})
+        mode = default.get('mode') or 'full'
+
+        groups = [ScheduleGroup(ref, x['cron'], x.get('mode') or mode) for ref, x in sections.items()]
+        return cls(ScheduleGroup(None, default['cron'], mode) if default.get('cron') else None, groups)
+
+    @property
+    def all(self):
+        return self.groups + ([self.default] if self.default else [])
+
+    def get(self, data):
+        for group in self.groups:
+            if data and match_ref(group.ref, data):
+                return group
+
+        return self.default
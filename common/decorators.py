@@ -1,29 +1,74 @@
 import time
+import asyncio
 import logging
 import threading
 from functools import wraps
 
+from common.metrics import RETRIES
+from common.retries import RetryPolicy
+from common.trace import TRACER
+
 logger = logging.getLogger(__name__)
 
 
-def retry(exceptions, tries=4, delay=5, backoff=2, logs=True):
+def retry(exceptions, policy=None, logs=True):
+    '''
+    Call again on exceptions with full-jitter backoff of the retry policy
+    (default from [Retry] config section) until tries or deadline are out.
+    A retry_after attribute of the exception is honored.
+    '''
     def retry_decorator(func):
         @wraps(func)
         def func_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
+            current = policy or RetryPolicy.from_config()
+            started = time.monotonic()
+            attempt = 0
+            while True:
                 try:
                     return func(*args, **kwargs)
                 except exceptions as e:
-                    msg = 'Network problems. Retrying in {} seconds...'.format(mdelay)
+                    pause = current.pause(attempt, started, getattr(e, 'retry_after', None))
+                    if pause is None:
+                        raise
+                    RETRIES.inc(function=func.__name__)
+                    msg = 'Network problems ({}). Retrying in {:.1f} seconds...'.format(e.__class__.__name__, pause)
+                    if logs:
+                        logger.warning(msg)
+                    else:
+                        print(msg)
+                    TRACER.instant('retry', 'retry', function=func.__name__, error=e.__class__.__name__)
+                    with TRACER.span(f'retry {func.__name__}', 'sleep'):
+                        time.sleep(pause)
+                    attempt += 1
+        return func_retry
+    return retry_decorator
+
+
+def async_retry(exceptions, policy=None, logs=True):
+    '''Coroutine version of retry(), pauses don't block the loop.'''
+    def retry_decorator(func):
+        @wraps(func)
+        async def func_retry(*args, **kwargs):
+            current = policy or RetryPolicy.from_config()
+            started = time.monotonic()
+            attempt = 0
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except exceptions as e:
+                    pause = current.pause(attempt, started, getattr(e, 'retry_after', None))
+                    if pause is None:
+                        raise
+                    RETRIES.inc(function=func.__name__)
+                    msg = 'Network problems ({}). Retrying in {:.1f} seconds...'.format(e.__class__.__name__, pause)
                     if logs:
                         logger.warning(msg)
                     else:
                         print(msg)
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            return func(*args, **kwargs)
+                    TRACER.instant('retry', 'retry', function=func.__name__, error=e.__class__.__name__)
+                    with TRACER.span(f'retry {func.__name__}', 'sleep'):
+                        await asyncio.sleep(pause)
+                    attempt += 1
         return func_retry
     return retry_decorator
 
@@ -0,0 +1,331 @@
+import json
+import time
+import logging
+
+from common.compute import Instance, COMPUTE_URL
+from common.config import Config as config
+from common.decorators import retry, async_retry
+from common.iam import get_token_provider
+from common.session import get_client, get_async_client, NETWORK_ERRORS, ASYNC_NETWORK_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+def parse_selector(selector):
+    '''
+    Parse comma separated label terms: key=value, key!=value,
+    key=* (label exists) and key!=* (label is absent).
+    '''
+    terms = []
+    for term in selector.split(','):
+        if '!=' in term:
+            key, _, value = term.partition('!=')
+            terms.append((key.strip(), '!=', value.strip()))
+        else:
+            key, _, value = term.partition('=')
+            terms.append((key.strip(), '=', value.strip()))
+
+    return terms
+
+
+def parse_ref(ref):
+    '''
+    Config entry is one of:
+      instance ID or name -> ('ref', ref)
+      folder:<folder_id> -> ('folder', (folder_id, None)), all instances of the folder
+      [folder:<folder_id>/]<label selector> -> ('selector', (folder_id, terms))
+    '''
+    folder_id = None
+
+    if ref.startswith('folder:'):
+        folder_id, _, ref = ref[len('folder:'):].partition('/')
+        if not ref:
+            return 'folder', (folder_id, None)
+
+    if '=' in ref:
+        return 'selector', (folder_id, parse_selector(ref))
+
+    return 'ref', ref
+
+
+def match_terms(terms, labels):
+    for key, op, value in terms:
+        if value == '*':
+            matched = key in labels
+        else:
+            matched = labels.get(key) == value
+
+        if matched != (op == '='):
+            return False
+
+    return True
+
+
+def is_matched(ref, instances, keys):
+    # keys is a set of known IDs and names, other entries need a scan
+    if parse_ref(ref)[0] == 'ref':
+        return ref in keys
+
+    return any(match_ref(ref, data) for data in instances.values())
+
+
+def match_ref(ref, data):
+    kind, value = parse_ref(ref)
+
+    if kind == 'ref':
+        return value in (data.get('id'), data.get('name'))
+
+    folder_id, terms = value
+    if folder_id and data.get('folderId') != folder_id:
+        return False
+
+    return terms is None or match_terms(terms, data.get('labels') or {})
+
+
+class InstanceLister:
+
+    '''
+    Lists instances of folders with pagination.
+
+    Methods:
+      list_page() -> return (instances, next_page_token)
+      list_folder() -> yield instance dicts of the folder
+      get() -> return instance dict by ID or None
+    '''
+
+    def __init__(self, token_provider=None, client=None, page_size=None):
+        self.token_provider = token_provider or get_token_provider()
+        self.client = client or get_client()
+        self.page_size = page_size or config.page_size
+
+    @property
+    def headers(self):
+        return {'Authorization': f'Bearer {self.token_provider.get()}'}
+
+    @retry(NETWORK_ERRORS)
+    def list_page(self, folder_id, page_token=None):
+        params = {'folderId': folder_id, 'pageSize': self.page_size}
+        if page_token:
+            params['pageToken'] = page_token
+
+        r = self.client.get(COMPUTE_URL.rstrip('/'), headers=self.headers, params=params)
+        res = json.loads(r.text)
+
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in list_instances: {res.get("message")}')
+            return [], None
+
+        return res.get('instances') or [], res.get('nextPageToken')
+
+    def list_folder(self, folder_id):
+        page_token = None
+
+        while True:
+            instances, page_token = self.list_page(folder_id, page_token)
+            yield from instances
+
+            if not page_token:
+                break
+
+    @retry(NETWORK_ERRORS)
+    def get(self, instance_id):
+        r = self.client.get(COMPUTE_URL + instance_id, headers=self.headers)
+        res = json.loads(r.text)
+
+        if r.status_code == 200:
+            return res
+        elif r.status_code != 404:
+            logger.error(f'{r.status_code} Error in get_data: {res.get("message")}')
+
+
+class AsyncInstanceLister:
+
+    '''
+    Lists instances of folders with pagination, non-blocking.
+
+    Methods (coroutines):
+      list_page() -> return (instances, next_page_token)
+      list_folder() -> async generator of instance dicts of the folder
+    '''
+
+    def __init__(self, token_provider=None, client=None, page_size=None):
+        self.token_provider = token_provider or get_token_provider()
+        self.client = client or get_async_client()
+        self.page_size = page_size or config.page_size
+
+    async def headers(self):
+        return {'Authorization': f'Bearer {await self.token_provider.async_get()}'}
+
+    @async_retry(ASYNC_NETWORK_ERRORS)
+    async def list_page(self, folder_id, page_token=None):
+        params = {'folderId': folder_id, 'pageSize': self.page_size}
+        if page_token:
+            params['pageToken'] = page_token
+
+        r = await self.client.get(COMPUTE_URL.rstrip('/'), headers=await self.headers(), params=params)
+        res = json.loads(r.text)
+
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in list_instances: {res.get("message")}')
+            return [], None
+
+        return res.get('instances') or [], res.get('nextPageToken')
+
+    async def list_folder(self, folder_id):
+        page_token = None
+
+        while True:
+            instances, page_token = await self.list_page(folder_id, page_token)
+            for data in instances:
+                yield data
+
+            if not page_token:
+                break
+
+
+class TargetSet:
+
+    '''
+    Instances matched by config entries: IDs, names, label selectors
+    and folder scopes.
+
+    resolve() lists every required folder once. refresh() is cheap to call
+    on every tick: it does nothing until interval seconds have passed, then
+    re-lists only folders that selectors or folder scopes depend on, since
+    instances referenced by ID or name can't join or leave the set. Other
+    folders are listed again when given, to get current instance data.
+
+    Attributes:
+      :targets: list of instance dicts in config order
+      :ids: list of instance IDs
+
+    Methods:
+      resolve() -> resolve all entries, return targets
+      refresh() -> re-resolve if interval elapsed, return (added, removed) instance dicts
+    '''
+
+    def __init__(self, refs, folders=None, interval=300, lister=None):
+        self.refs = [x for x in refs if x]
+        self.folders = [x for x in folders or [] if x]
+        self.interval = interval
+        self.lister = lister or InstanceLister()
+        self.instances = {}
+        self.listed = set()
+        self.fetched = set()
+        self.targets = []
+        self.resolved_at = None
+
+    @property
+    def ids(self):
+        return [x['id'] for x in self.targets]
+
+    def scoped_folders(self):
+        folders = []
+        for ref in self.refs:
+            kind, value = parse_ref(ref)
+            if kind != 'ref' and value[0]:
+                folders.append(value[0])
+
+        return folders
+
+    def dynamic_folders(self):
+        kinds = [parse_ref(x) for x in self.refs]
+
+        # Unscoped selectors may match in any folder we know about
+        if any(kind == 'selector' and not value[0] for kind, value in kinds):
+            return set(self.listed)
+
+        return set(self.scoped_folders())
+
+    def list_folder(self, folder_id):
+        current = {data['id']: data for data in self.lister.list_folder(folder_id)}
+
+        for instance_id, data in list(self.instances.items()):
+            if data.get('folderId') == folder_id and instance_id not in current:
+                del self.instances[instance_id]
+
+        self.instances.update(current)
+        self.listed.add(folder_id)
+
+    def match(self):
+        result = []
+        seen = set()
+
+        for ref in self.refs:
+            for data in self.instances.values():
+                if data['id'] not in seen and match_ref(ref, data):
+                    seen.add(data['id'])
+                    result.append(data)
+
+        return result
+
+    def resolve(self):
+        pending = self.folders + self.scoped_folders()
+
+        while True:
+            while pending:
+                folder_id = pending.pop(0)
+                if folder_id not in self.listed:
+                    self.list_folder(folder_id)
+
+            keys = set(self.instances) | {x.get('name') for x in self.instances.values()}
+            unmatched = [x for x in self.refs if not is_matched(x, self.instances, keys)]
+
+            # Selectors are matched only by listing, other entries may be IDs in unknown folders
+            candidates = [x for x in unmatched if parse_ref(x)[0] == 'ref' and x not in self.fetched]
+            if not candidates:
+                break
+
+            ref = candidates[0]
+            self.fetched.add(ref)
+            data = self.lister.get(ref)
+
+            if data is not None:
+                self.instances[data['id']] = data
+                pending.append(data['folderId'])
+
+        for ref in unmatched:
+            logger.warning(f'Instance {ref} not found')
+
+        self.targets = self.match()
+        self.resolved_at = time.monotonic()
+        return self.targets
+
+    def refresh(self, force=False, folders=()):
+        if self.resolved_at is None:
+            return self.resolve(), []
+
+        if not force and time.monotonic() - self.resolved_at < self.interval:
+            return [], []
+
+        before = {x['id']: x for x in self.targets}
+        for folder_id in self.dynamic_folders() | set(folders):
+            self.list_folder(folder_id)
+
+        self.targets = self.match()
+        self.resolved_at = time.monotonic()
+
+        after = {x['id']: x for x in self.targets}
+        added = [x for key, x in after.items() if key not in before]
+        removed = [x for key, x in before.items() if key not in after]
+
+        for data in added:
+            logger.info(f'Instance {data.get("name")} ({data["id"]}) added to targets')
+        for data in removed:
+            logger.info(f'Instance {data.get("name")} ({data["id"]}) removed from targets')
+
+        return added, removed
+
+
+def resolve_data(refs, folders=None, lister=None):
+    '''Return list of instance dicts matched by config entries, in config order.'''
+    return TargetSet(refs, folders=folders, lister=lister).resolve()
+
+
+def resolve_instances(refs, folders=None, cls=Instance, lister=None, **kwargs):
+    '''Return populated instance objects (cls) for config entries.'''
+    folders = config.folders_list if folders is None else folders
+    return [
+        cls(data['id'], instance_data=data, **kwargs)
+        for data in resolve_data(refs, folders=folders, lister=lister)
+    ]
@@ -0,0 +1,60 @@
+class RetryableError(Exception):
+
+    '''
+    Base for rejected requests that may succeed if sent again later,
+    retry_after is the Retry-After hint of the server in seconds.
+    '''
+
+    def __init__(self, message=None, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QuotaError(RetryableError):
+
+    '''Raised when the cloud rejects an operation with HTTP 429 (quota exceeded).'''
+
+
+class ServerError(RetryableError):
+
+    '''Raised when the cloud fails an operation request with HTTP 5xx.'''
+
+
+class AuthError(Exception):
+
+    '''Raised when the OAuth token is rejected by the IAM token exchange.'''
+
+
+class CircuitOpenError(Exception):
+
+    '''Raised without sending a request while the endpoint circuit breaker is open.'''
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f'Endpoint {endpoint} is unavailable, requests are paused for {retry_after:.0f} seconds')
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class OperationError(Exception):
+
+    '''Raised when a finished operation has an error payload.'''
+
+    def __init__(self, operation):
+        error = operation.get('error') or {}
+        super().__init__(f'{error.get("code")}: {error.get("message")}')
+        self.operation = operation
+
+
+class OperationTimeout(Exception):
+
+    '''Raised when an operation is not done before its deadline.'''
+
+    def __init__(self, operation_id, operation=None):
+        super().__init__(f'Operation {operation_id} running too long')
+        self.operation_id = operation_id
+        self.operation = operation
+
+
+class LeaseStoreError(Exception):
+
+    '''Raised when the lease store of watchdog replicas can't be read or written.'''
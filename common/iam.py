@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import pathlib
+import threading
+
+from datetime import datetime, timezone
+
+from common.config import Config as config
+from common.decorators import retry
+from common.exceptions import AuthError
+from common.session import get_client, NETWORK_ERRORS
+
+logger = logging.getLogger(__name__)
+
+IAM_URL = f'{config.iam_endpoint}/iam/v1/tokens'
+IAM_CACHE_FILE = pathlib.Path.home().joinpath('.ya-tools/iam.json')
+DEFAULT_TOKEN_LIFETIME = 12 * 3600
+REFRESH_MARGIN = 3600
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def parse_expires_at(value):
+    '''Convert IAM expiresAt (RFC3339, up to nanoseconds) to unix timestamp.'''
+    if not value:
+        return time.time() + DEFAULT_TOKEN_LIFETIME
+
+    raw = value.rstrip('Zz').split('.')[0]
+    expires_at = datetime.strptime(raw, '%Y-%m-%dT%H:%M:%S')
+    return expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+class TokenProvider:
+
+    '''
+    Process-wide IAM token cache.
+
+    The token is exchanged once and refreshed only when less than
+    refresh_margin seconds are left before expiry. Safe to share between
+    threads; coroutines should use async_get() to avoid blocking the loop.
+    The cache file is keyed by the OAuth token and the IAM endpoint, so a
+    token of a fake cloud is never sent to the real one.
+
+    Methods:
+      get() -> return valid iam token as str
+      async_get() -> awaitable version of get()
+      invalidate() -> drop cached token, next get() makes a new exchange
+      refresh() -> exchange again in place of a token rejected with 401
+    '''
+
+    def __init__(self, oauth_token, cache_file=None, refresh_margin=REFRESH_MARGIN):
+        self.oauth_token = oauth_token
+        self.cache_file = pathlib.Path(cache_file) if cache_file else None
+        self.refresh_margin = refresh_margin
+        self._fingerprint = hashlib.sha256(f'{IAM_URL}\n{oauth_token}'.encode()).hexdigest()
+        self._lock = threading.Lock()
+        self._token = None
+        self._previous = None
+        self._expires_at = 0
+
+        if self.cache_file:
+            self._load()
+
+    def _fresh(self):
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin
+
+    def get(self):
+        if self._fresh():
+            return self._token
+
+        with self._lock:
+            # Another thread may have refreshed the token while we waited
+            if not self._fresh():
+                self._token, self._expires_at = self._exchange()
+                if self.cache_file:
+                    self._dump()
+
+        return self._token
+
+    async def async_get(self):
+        if self._fresh():
+            return self._token
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.get)
+
+    def invalidate(self):
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+
+    def refresh(self, token):
+        '''
+        Replace token rejected with 401 (revoked, or cached for another
+        endpoint), return the new token or None if the token isn't ours.
+        Requests rejected at once with the same token share one exchange.
+        '''
+        with self._lock:
+            if token == self._token:
+                logger.warning('IAM token was rejected, exchanging a new one')
+                self._previous = token
+                self._token, self._expires_at = self._exchange()
+                if self.cache_file:
+                    self._dump()
+            elif token != self._previous:
+                return None
+
+        return self._token
+
+    @retry(NETWORK_ERRORS)
+    def _exchange(self):
+        r = get_client().post(IAM_URL, retry=True, json={'yandexPassportOauthToken': self.oauth_token})
+        try:
+            data = json.loads(r.text)
+        except ValueError:
+            data = {}
+
+        if r.status_code != 200:
+            raise AuthError(f'{r.status_code} Error in get_iam: {data.get("message")}')
+
+        logger.debug('IAM token exchanged')
+        return data.get('iamToken'), parse_expires_at(data.get('expiresAt'))
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get('fingerprint') != self._fingerprint:
+            return
+
+        self._token = data.get('iamToken')
+        self._expires_at = data.get('expiresAt', 0)
+
+    def _dump(self):
+        data = {
+            'fingerprint': self._fingerprint,
+            'iamToken': self._token,
+            'expiresAt': self._expires_at
+        }
+        tmp_file = self.cache_file.with_suffix('.tmp')
+
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as err:
+            logger.warning(f'Unable to save IAM token cache: {err}')
+
+
+def refresh_token(token):
+    '''Return a new IAM token in place of one rejected with 401, None if no provider issued it.'''
+    with _providers_lock:
+        providers = list(_providers.values())
+
+    for provider in providers:
+        new_token = provider.refresh(token)
+        if new_token is not None:
+            return new_token
+
+
+def get_token_provider(oauth_token=None):
+    '''Return shared TokenProvider for OAuth token (default from config).'''
+    oauth_token = config.oauth_token if oauth_token is None else oauth_token
+
+    with _providers_lock:
+        provider = _providers.get(oauth_token)
+        if provider is None:
+            cache_file = IAM_CACHE_FILE if config.iam_cache else None
+            provider = TokenProvider(oauth_token, cache_file=cache_file)
+            _providers[oauth_token] = provider
+
+    return provider
@@ -0,0 +1,229 @@
+import os
+import json
+import fcntl
+import uuid
+import pathlib
+import logging
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = pathlib.Path.home().joinpath('.ya-tools/snaps.journal')
+LOCK_FILE = pathlib.Path.home().joinpath('.ya-tools/snaps.lock')
+
+
+class RunJournal:
+
+    '''
+    Append-only journal of a snapshot run, one JSON event per line.
+
+    Events:
+      run -> new run started with mode (create, delete or full)
+      operation -> operation sent: instance, kind (stop, start, snapshot, delete), ID and details
+      finished -> operation done, ok is false if it ended with an error
+      instance -> all work of the mode is done for the instance
+      end -> run completed and no instance is left stopped
+
+    An operation without a finished event is in flight, or its outcome is
+    unknown (timeout, killed process), resume re-attaches to it. The file
+    keeps only the current run: begin() truncates it. An operation sent
+    right before the process was killed may miss its event, it's found
+    again on the next run since its instance is still stopped.
+
+    Without a path the journal keeps the state in memory only.
+
+    Methods:
+      begin() -> start a new run
+      resume() -> load the last unfinished run, return its mode or None
+      operation() -> record a sent operation
+      finished() -> record an operation result
+      instance_done() -> record that the instance is done for a stage
+      end() -> mark the run completed
+      pending() -> return {instance_id: [operation ids]} in flight
+      stopped() -> True if the run stopped the instance and didn't start it yet
+      stopped_at() -> return UTC datetime of the stop request of a stopped instance
+      snapshotted() -> True if the disk snapshot is already created in this run
+      done() -> True if the instance is done for a stage
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.reset()
+
+    def reset(self, run_id=None, mode=None):
+        self.run_id = run_id
+        self.mode = mode
+        self.operations = {}
+        self.results = {}
+        self.completed = set()
+        self.ended = False
+
+    def write(self, event, **data):
+        data = dict(data, event=event, run=self.run_id, time=datetime.utcnow().isoformat())
+        self.apply(data)
+
+        if not self.path:
+            return
+
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(data) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def apply(self, data):
+        event = data['event']
+
+        if event == 'run':
+            self.reset(data.get('run', self.run_id), data['mode'])
+        elif event == 'operation':
+            self.operations[data['id']] = data
+        elif event == 'finished':
+            self.results[data['id']] = data['ok']
+        elif event == 'instance':
+            self.completed.add((data['instance'], data['stage']))
+        elif event == 'end':
+            self.ended = True
+
+    def read(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    self.apply(json.loads(line))
+                except (ValueError, KeyError):
+                    # Last line may be cut if the process was killed while writing
+                    logger.warning(f'Skipped corrupted journal line in {self.path}')
+
+    def begin(self, mode):
+        self.read()
+        if self.run_id and not self.ended:
+            logger.warning(f'Previous run {self.run_id} was not finished and is discarded, use --resume to continue a run')
+
+        if self.path:
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            open(self.path, 'w').close()
+            os.chmod(self.path, 0o600)
+
+        self.run_id = uuid.uuid4().hex
+        self.write('run', mode=mode)
+
+    def resume(self):
+        self.read()
+        if not self.run_id or self.ended:
+            return
+
+        logger.info(f'Resuming run {self.run_id} ({self.mode}), {len(self.operations)} operations in journal')
+        return self.mode
+
+    def operation(self, instance_id, kind, operation_id, **details):
+        if operation_id:
+            self.write('operation', instance=instance_id, kind=kind, id=operation_id, **details)
+
+    def finished(self, operation_id, operation):
+        # No result means unknown outcome, the operation stays in flight
+        if operation_id in self.operations and operation is not None:
+            self.write('finished', id=operation_id, ok=not operation.get('error'))
+
+    def instance_done(self, instance_id, stage):
+        self.write('instance', instance=instance_id, stage=stage)
+
+    def end(self):
+        stopped = {x['instance'] for x in self.operations.values() if self.stopped(x['instance'])}
+        if stopped:
+            logger.warning(f'Run {self.run_id} left {len(stopped)} instances stopped, use --resume to start them')
+            return
+
+        self.write('end')
+
+    def pending(self):
+        result = {}
+        for operation_id, data in self.operations.items():
+            if operation_id not in self.results:
+                result.setdefault(data['instance'], []).append(operation_id)
+
+        return result
+
+    def last_ok(self, instance_id, kinds):
+        # Kind of the last successful operation of kinds on the instance
+        last = None
+        for operation_id, data in self.operations.items():
+            if data['instance'] == instance_id and data['kind'] in kinds and self.results.get(operation_id):
+                last = data['kind']
+
+        return last
+
+    def stopped(self, instance_id):
+        return self.last_ok(instance_id, ('stop', 'start')) == 'stop'
+
+    def stopped_at(self, instance_id):
+        # Downtime of a resumed run counts from the stop sent by the interrupted one
+        if not self.stopped(instance_id):
+            return None
+
+        stops = [
+            data for operation_id, data in self.operations.items()
+            if data['instance'] == instance_id and data['kind'] == 'stop' and self.results.get(operation_id)
+        ]
+        if stops and stops[-1].get('time'):
+            return datetime.fromisoformat(stops[-1]['time'])
+
+    def snapshotted(self, instance_id, disk_id):
+        return any(
+            data['instance'] == instance_id and data['kind'] == 'snapshot'
+            and data.get('disk') == disk_id and self.results.get(operation_id)
+            for operation_id, data in self.operations.items()
+        )
+
+    def done(self, instance_id, stage):
+        return (instance_id, stage) in self.completed
+
+
+class RunLock:
+
+    '''
+    Exclusive lock of a snapshotter run, shared by all processes of the
+    user: a daemon run and a run started by cron or by hand never work on
+    the same instances and the same journal at once. The lock is flock()
+    on a file, so it's released by the OS when the process dies.
+
+    Without a path the lock is always acquired.
+
+    Methods:
+      acquire() -> take the lock without waiting, True if taken
+      release() -> release the lock
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        if not self.path:
+            return True
+
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'a')
+
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
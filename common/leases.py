@@ -0,0 +1,286 @@
+import os
+import time
+import bisect
+import socket
+import sqlite3
+import hashlib
+import logging
+import pathlib
+
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse
+
+from common.config import Config as config
+from common.exceptions import LeaseStoreError
+from common.metrics import WATCHDOG_SHARDS
+
+logger = logging.getLogger(__name__)
+
+
+def stable_hash(value):
+    # hash() is salted per process, replicas must agree on the placement
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+
+    '''
+    Consistent hash ring of replicas with virtual nodes: when a replica
+    joins or leaves, only the keys of its own arcs change owner.
+
+    Methods:
+      get() -> return replica owning a key, None without replicas
+    '''
+
+    def __init__(self, nodes, vnodes=64):
+        self.ring = sorted((stable_hash(f'{node}#{i}'), node) for node in nodes for i in range(vnodes))
+        self.keys = [x[0] for x in self.ring]
+
+    def get(self, key):
+        if not self.ring:
+            return None
+
+        return self.ring[bisect.bisect(self.keys, stable_hash(key)) % len(self.ring)][1]
+
+
+class LeaseStore(ABC):
+
+    '''
+    Shared state of watchdog replicas: heartbeats of live replicas and
+    leases on shards. Expiry times are unix time, so replicas on different
+    hosts need synchronized clocks (NTP is enough for TTLs of seconds).
+
+    Backends implement all the methods below (a backend missing one can't
+    be instantiated), raise LeaseStoreError when the store is unavailable
+    and are registered in STORES by URL scheme.
+
+    Methods:
+      heartbeat() -> mark replica alive for ttl seconds
+      members() -> return sorted IDs of live replicas
+      acquire() -> take or renew leases on shards for ttl seconds, return shards held
+      release() -> drop leases on shards held by the replica
+      leave() -> drop heartbeat and all leases of the replica
+    '''
+
+    @abstractmethod
+    def heartbeat(self, replica_id, ttl):
+        ...
+
+    @abstractmethod
+    def members(self):
+        ...
+
+    @abstractmethod
+    def acquire(self, shards, replica_id, ttl):
+        ...
+
+    @abstractmethod
+    def release(self, shards, replica_id):
+        ...
+
+    @abstractmethod
+    def leave(self, replica_id):
+        ...
+
+
+class Transaction:
+
+    '''
+    Write transaction taken at BEGIN, so read-then-write can't interleave.
+    SQLite errors are raised as LeaseStoreError.
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, statement):
+        try:
+            self.connection.execute(statement)
+        except sqlite3.Error as err:
+            raise LeaseStoreError(f'Lease store failed: {err}') from err
+
+    def __enter__(self):
+        self.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute('COMMIT')
+            return
+
+        if self.connection.in_transaction:
+            self.execute('ROLLBACK')
+        if isinstance(exc, sqlite3.Error):
+            raise LeaseStoreError(f'Lease store failed: {exc}') from exc
+
+
+class SQLiteLeaseStore(LeaseStore):
+
+    '''
+    Lease store in an SQLite file, for replicas on one host or sharing a
+    local file system (e.g. tests and benchmarks). Every call is a short
+    transaction, writers wait for each other up to timeout seconds.
+    '''
+
+    def __init__(self, path, timeout=5):
+        self.path = str(path)
+        pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        # Readers don't block the writer, heartbeats of replicas don't wait for fsync
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS members (replica TEXT PRIMARY KEY, expires REAL NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS leases (shard INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def heartbeat(self, replica_id, ttl):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT INTO members (replica, expires) VALUES (?, ?) '
+                'ON CONFLICT (replica) DO UPDATE SET expires = excluded.expires',
+                (replica_id, time.time() + ttl)
+            )
+
+    def members(self):
+        with self.transaction() as db:
+            rows = db.execute('SELECT replica FROM members WHERE expires > ? ORDER BY replica', (time.time(),))
+            return [x[0] for x in rows]
+
+    def acquire(self, shards, replica_id, ttl):
+        now = time.time()
+        with self.transaction() as db:
+            # Taken only if free, expired or already ours
+            db.executemany(
+                'INSERT INTO leases (shard, owner, expires) VALUES (?, ?, ?) '
+                'ON CONFLICT (shard) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+                'WHERE leases.owner = excluded.owner OR leases.expires <= ?',
+                [(shard, replica_id, now + ttl, now) for shard in shards]
+            )
+            rows = db.execute('SELECT shard FROM leases WHERE owner = ?', (replica_id,))
+            return {x[0] for x in rows} & set(shards)
+
+    def release(self, shards, replica_id):
+        with self.transaction() as db:
+            db.executemany('DELETE FROM leases WHERE shard = ? AND owner = ?', [(x, replica_id) for x in shards])
+
+    def leave(self, replica_id):
+        with self.transaction() as db:
+            db.execute('DELETE FROM leases WHERE owner = ?', (replica_id,))
+            db.execute('DELETE FROM members WHERE replica = ?', (replica_id,))
+
+
+# URL scheme -> LeaseStore class taking the URL path
+STORES = {
+    'sqlite': SQLiteLeaseStore
+}
+
+
+def get_lease_store(url):
+    '''Return LeaseStore for a URL (sqlite:///path/leases.db), a plain path is an SQLite file.'''
+    parsed = urlparse(url)
+    if parsed.scheme not in STORES:
+        return SQLiteLeaseStore(os.path.expanduser(url))
+
+    return STORES[parsed.scheme](os.path.expanduser(parsed.netloc + parsed.path))
+
+
+class ShardMember:
+
+    '''
+    Membership of a watchdog replica in a sharded group.
+
+    Targets are split into a fixed number of shards by a stable hash of
+    the instance ID, shards are placed on live replicas by a consistent
+    hash ring. A replica watches a shard only while it holds the shard's
+    lease, so two replicas never start instances of one shard at once
+    while their views of the group differ. sync() is called every
+    heartbeat seconds: it renews the heartbeat, releases shards that moved
+    to other replicas and takes or renews leases of its own. A shard of
+    a dead replica is taken over once its lease expires, within ttl plus
+    heartbeat seconds; a replica leaving on shutdown hands its shards
+    over on the next sync of the others.
+
+    Attributes:
+      :replica_id: ID of this replica
+      :owned: set of shards whose leases are held
+
+    Methods:
+      shard() -> return shard of an instance ID
+      owns() -> True if the instance ID belongs to an owned shard
+      sync() -> heartbeat and rebalance, return (acquired, released) shards
+      rebalance() -> same, raises LeaseStoreError
+      leave() -> release all shards and leave the group
+    '''
+
+    def __init__(self, store, replica_id=None, shards=256, ttl=10, heartbeat=3):
+        self.store = store
+        self.replica_id = replica_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.shards = shards
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.owned = set()
+        self.members = []
+        self.synced_at = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            get_lease_store(config.shard_store), replica_id=config.shard_replica or None, shards=config.shard_count,
+            ttl=config.shard_lease_ttl, heartbeat=config.shard_heartbeat
+        )
+
+    def shard(self, instance_id):
+        return stable_hash(instance_id) % self.shards
+
+    def owns(self, instance_id):
+        return self.shard(instance_id) in self.owned
+
+    def sync(self):
+        try:
+            return self.rebalance()
+        except LeaseStoreError as err:
+            logger.error(f'Replica {self.replica_id} failed to renew leases: {err}')
+
+        # Leases not renewed for ttl seconds may be held by other replicas now
+        if self.synced_at is None or time.monotonic() - self.synced_at >= self.ttl:
+            released, self.owned = self.owned, set()
+            WATCHDOG_SHARDS.set(0, replica=self.replica_id)
+            return set(), released
+
+        return set(), set()
+
+    def rebalance(self):
+        started = time.monotonic()
+        self.store.heartbeat(self.replica_id, self.ttl)
+        members = self.store.members()
+        if members != self.members:
+            logger.info(f'Watchdog replicas: {", ".join(members)}')
+            self.members = members
+
+        ring = HashRing(members)
+        wanted = {x for x in range(self.shards) if ring.get(f'shard-{x}') == self.replica_id}
+
+        if self.owned - wanted:
+            self.store.release(self.owned - wanted, self.replica_id)
+
+        # A lease not renewed in time may be lost to another replica
+        owned = self.store.acquire(wanted, self.replica_id, self.ttl) if wanted else set()
+        acquired, released = owned - self.owned, self.owned - owned
+        self.owned = owned
+        self.synced_at = started
+        WATCHDOG_SHARDS.set(len(owned), replica=self.replica_id)
+
+        if acquired or released:
+            logger.info(f'Replica {self.replica_id} holds {len(owned)} of {self.shards} shards '
+                        f'(+{len(acquired)}, -{len(released)}, waiting for {len(wanted - owned)})')
+
+        return acquired, released
+
+    def leave(self):
+        self.store.leave(self.replica_id)
+        self.owned = set()
+        logger.info(f'Replica {self.replica_id} left the watchdog group')
@@ -0,0 +1,201 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+
+from urllib.parse import urlparse
+from aiohttp import web
+
+from common.trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast API call to a long snapshot operation
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+OPERATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+
+    '''
+    Base of metrics with labels, values are kept per label values tuple.
+    '''
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        # Label values are strings, so keys of mixed values (200 and 'error') stay sortable
+        return tuple(str(labels.get(x, '')) for x in self.labels)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            lines += [f'{name}{labels} {value!r}' for name, labels, value in self.samples()]
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            # Buckets are cumulative: a value is counted in every bucket with bound >= value
+            counts = [x + (value <= bound) for x, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for bound, value in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', format_labels(self.labels + ('le',), key + (f'{bound:g}',)), value
+            yield f'{self.name}_bucket', format_labels(self.labels + ('le',), key + ('+Inf',)), count
+            yield f'{self.name}_sum', format_labels(self.labels, key), total
+            yield f'{self.name}_count', format_labels(self.labels, key), count
+
+
+class Registry:
+
+    '''
+    Metrics of the process in Prometheus text format.
+
+    Methods:
+      counter(), gauge(), histogram() -> register a metric
+      render() -> return text exposition of all metrics
+      write() -> atomically write metrics to a file (node_exporter textfile collector)
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        return '\n'.join(x.render() for x in self.metrics) + '\n'
+
+    def write(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+API_REQUESTS = REGISTRY.counter('yc_api_requests_total', 'Yandex Cloud API requests', ('endpoint', 'method', 'status'))
+API_LATENCY = REGISTRY.histogram('yc_api_request_duration_seconds', 'Yandex Cloud API request latency', ('endpoint', 'method'))
+RETRIES = REGISTRY.counter('yc_retries_total', 'Calls retried after a network error', ('function',))
+API_RETRIES = REGISTRY.counter('yc_api_retries_total', 'API requests sent again after a retryable status', ('endpoint', 'status'))
+CIRCUIT_OPEN = REGISTRY.gauge('yc_circuit_open', 'Circuit breaker of the endpoint is open', ('endpoint',))
+OPERATION_DURATION = REGISTRY.histogram(
+    'yc_operation_duration_seconds', 'Cloud operations from request to observed completion',
+    ('type', 'result'), OPERATION_BUCKETS
+)
+DOWNTIME = REGISTRY.gauge('yc_instance_downtime_seconds', 'Instance downtime of the last snapshot run', ('instance',))
+WATCHDOG_STARTS = REGISTRY.counter('yc_watchdog_starts_total', 'Instances started by watchdog', ('instance', 'result'))
+WATCHDOG_PREEMPTIONS = REGISTRY.counter('yc_watchdog_stops_total', 'Target instances found stopped', ('instance',))
+WATCHDOG_SHARDS = REGISTRY.gauge('yc_watchdog_shards', 'Target shards held by the watchdog replica', ('replica',))
+RUN_DURATION = REGISTRY.gauge('yc_run_duration_seconds', 'Duration of the last snapshotter run', ('mode',))
+RUN_TIMESTAMP = REGISTRY.gauge('yc_run_timestamp_seconds', 'Unix time of the last snapshotter run end', ('mode',))
+
+
+def endpoint(url):
+    '''API group of request URL: iam, compute, disks, snapshots or operations.'''
+    parsed = urlparse(url)
+    path = parsed.path
+
+    if '/iam/' in path:
+        return 'iam'
+    elif parsed.netloc.startswith('operation.') or path.startswith('/operations'):
+        return 'operations'
+
+    for name in ('snapshots', 'disks'):
+        if f'/{name}' in path:
+            return name
+
+    return 'compute'
+
+
+def observe_request(method, url, status, started):
+    name = endpoint(url)
+    API_REQUESTS.inc(endpoint=name, method=method, status=status)
+    API_LATENCY.observe(time.monotonic() - started, endpoint=name, method=method)
+    TRACER.complete(f'{method} {name}', 'api', started, status=status)
+
+
+async def start_server(host, port):
+    '''Serve /metrics on the running loop, return aiohttp AppRunner.'''
+    async def metrics(request):
+        return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f'Metrics are served on http://{host}:{port}/metrics')
+    return runner
@@ -0,0 +1,221 @@
+import time
+import asyncio
+import logging
+
+from common.config import Config as config
+from common.exceptions import OperationError, OperationTimeout
+from common.trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+_trackers = {}
+
+
+class PollState:
+
+    '''
+    Polling schedule of one operation: interval grows from min to max.
+    Polls are traced on the lane of the task that started tracking.
+    '''
+
+    def __init__(self, operation_id, fetch, deadline, min_interval, max_interval, backoff):
+        self.operation_id = operation_id
+        self.fetch = fetch
+        self.deadline = deadline
+        self.interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.next_poll = None
+        self.operation = None
+        self.lane = TRACER.current()
+
+    def schedule(self, now):
+        self.next_poll = min(now + self.interval, self.deadline)
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+
+
+def check_operation(operation):
+    '''Return True if operation is done, raise OperationError if it failed.'''
+    if not operation or operation.get('done') is not True:
+        return False
+
+    if operation.get('error'):
+        raise OperationError(operation)
+
+    return True
+
+
+class OperationTracker:
+
+    '''
+    Waits for many cloud operations with a single polling loop.
+
+    Every tracked operation has its own deadline and polling interval,
+    which starts at min_interval and grows by backoff up to max_interval:
+    short operations are noticed quickly, long ones do not waste requests.
+    All operations due at the same moment are polled concurrently.
+
+    Methods:
+      track() -> return asyncio.Future resolved with the operation dict
+      wait() -> coroutine, return the operation dict when it is done
+    '''
+
+    def __init__(self, fetch=None, timeout=600, min_interval=1, max_interval=10, backoff=1.5):
+        self.fetch = fetch
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._pending = {}
+        self._wakeup = None
+        self._runner = None
+
+    @classmethod
+    def from_config(cls, fetch=None):
+        return cls(
+            fetch=fetch,
+            timeout=config.operation_timeout,
+            min_interval=config.poll_min_interval,
+            max_interval=config.poll_max_interval
+        )
+
+    def track(self, operation_id, fetch=None, timeout=None, callback=None):
+        '''
+        Start tracking operation. fetch is a coroutine function that
+        returns the operation dict, callback is called with the future.
+        '''
+        loop = asyncio.get_event_loop()
+        fetch = fetch or self.fetch
+        deadline = loop.time() + (timeout or self.timeout)
+
+        state = PollState(operation_id, fetch, deadline, self.min_interval, self.max_interval, self.backoff)
+        state.schedule(loop.time())
+        future = loop.create_future()
+
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        self._pending.setdefault(operation_id, []).append((state, future))
+
+        if self._runner is None or self._runner.done():
+            self._wakeup = asyncio.Event()
+            self._runner = asyncio.ensure_future(self._run())
+        else:
+            self._wakeup.set()
+
+        return future
+
+    async def wait(self, operation_id, fetch=None, timeout=None):
+        with TRACER.span('wait operation', 'wait', operation=operation_id):
+            return await self.track(operation_id, fetch=fetch, timeout=timeout)
+
+    async def _poll(self, state, future):
+        try:
+            with TRACER.use(state.lane):
+                state.operation = await state.fetch(state.operation_id)
+            if check_operation(state.operation):
+                future.set_result(state.operation)
+        except OperationError as err:
+            future.set_exception(err)
+        except Exception as err:
+            logger.warning(f'Unable to get status of operation {state.operation_id}: {err}')
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+
+        while self._pending:
+            now = loop.time()
+            due = []
+
+            for operation_id, waiters in list(self._pending.items()):
+                alive = [(s, f) for s, f in waiters if not f.done()]
+                for state, future in alive:
+                    if state.next_poll <= now:
+                        due.append((state, future))
+                if alive:
+                    self._pending[operation_id] = alive
+                else:
+                    del self._pending[operation_id]
+
+            await asyncio.gather(*[self._poll(state, future) for state, future in due])
+
+            now = loop.time()
+            for state, future in due:
+                if future.done():
+                    continue
+                if now >= state.deadline:
+                    future.set_exception(OperationTimeout(state.operation_id, state.operation))
+                else:
+                    state.schedule(now)
+
+            next_polls = [s.next_poll for w in self._pending.values() for s, f in w if not f.done()]
+            if not next_polls:
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(min(next_polls) - loop.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+
+def get_tracker():
+    '''Return OperationTracker shared by all coroutines of the running loop.'''
+    loop = asyncio.get_event_loop()
+    tracker = _trackers.get(loop)
+
+    if tracker is None:
+        _trackers.clear()
+        tracker = _trackers[loop] = OperationTracker.from_config()
+
+    return tracker
+
+
+def wait_operations(operation_ids, fetch, timeout=600, min_interval=1, max_interval=10, backoff=1.5):
+    '''
+    Blocking version of OperationTracker for sync code.
+    Return dict of operation id -> operation dict (None if not finished in time).
+    Failed operations are logged and returned as is.
+    '''
+    now = time.monotonic()
+    states = {
+        x: PollState(x, fetch, now + timeout, min_interval, max_interval, backoff)
+        for x in operation_ids if x
+    }
+    for state in states.values():
+        state.schedule(now)
+
+    result = {}
+    started = now
+    while states:
+        with TRACER.span('poll sleep', 'sleep'):
+            time.sleep(max(min(s.next_poll for s in states.values()) - time.monotonic(), 0))
+        now = time.monotonic()
+
+        for operation_id, state in list(states.items()):
+            if state.next_poll > now:
+                continue
+
+            try:
+                state.operation = fetch(operation_id)
+            except Exception as err:
+                # Polled again on schedule until the deadline, as the tracker does
+                logger.warning(f'Unable to get status of operation {operation_id}: {err}')
+            try:
+                done = check_operation(state.operation)
+            except OperationError as err:
+                logger.error(f'Operation {operation_id} failed: {err}')
+                done = True
+
+            if done:
+                result[operation_id] = state.operation
+                del states[operation_id]
+            elif time.monotonic() >= state.deadline:
+                logger.warning(f'Operation {operation_id} running too long.')
+                result[operation_id] = None
+                del states[operation_id]
+            else:
+                state.schedule(time.monotonic())
+
+    TRACER.complete('wait operations', 'wait', started, operations=len(result))
+    return result
@@ -0,0 +1,268 @@
+import json
+import heapq
+import logging
+import itertools
+
+from common.config import Config as config
+from common.decorators import retry
+from common.iam import get_token_provider
+from common.session import get_client, NETWORK_ERRORS
+from common.compute import DISK_URL, NEGATIVE_STATES
+
+logger = logging.getLogger(__name__)
+
+MB = 10 ** 6
+
+
+class DiskLister:
+
+    '''
+    Lists disks of folders with pagination, one request per page
+    instead of a GET per disk.
+
+    Methods:
+      list_page() -> return (disks, next_page_token)
+      list_folder() -> yield disk dicts of the folder
+      get() -> return disk dict by ID or None
+    '''
+
+    def __init__(self, token_provider=None, client=None, page_size=None):
+        self.token_provider = token_provider or get_token_provider()
+        self.client = client or get_client()
+        self.page_size = page_size or config.page_size
+
+    @property
+    def headers(self):
+        return {'Authorization': f'Bearer {self.token_provider.get()}'}
+
+    @retry(NETWORK_ERRORS)
+    def list_page(self, folder_id, page_token=None):
+        params = {'folderId': folder_id, 'pageSize': self.page_size}
+        if page_token:
+            params['pageToken'] = page_token
+
+        r = self.client.get(DISK_URL.rstrip('/'), headers=self.headers, params=params)
+        res = json.loads(r.text)
+
+        if r.status_code != 200:
+            logger.error(f'{r.status_code} Error in list_disks: {res.get("message")}')
+            return [], None
+
+        return res.get('disks') or [], res.get('nextPageToken')
+
+    def list_folder(self, folder_id):
+        page_token = None
+
+        while True:
+            disks, page_token = self.list_page(folder_id, page_token)
+            yield from disks
+
+            if not page_token:
+                break
+
+    @retry(NETWORK_ERRORS)
+    def get(self, disk_id):
+        r = self.client.get(DISK_URL + disk_id, headers=self.headers)
+        res = json.loads(r.text)
+
+        if r.status_code == 200:
+            return res
+        elif r.status_code != 404:
+            logger.error(f'{r.status_code} Error in get_disk: {res.get("message")}')
+
+
+def disks_metadata(instances, lister=None):
+    '''Return {disk_id: disk dict} for snapshot disks of instances, every folder is listed once.'''
+    lister = lister or DiskLister()
+    instances = [vm for vm in instances if vm.instance_data]
+    wanted = {disk_id for vm in instances for disk_id in vm.snapshot_disks}
+    disks = {}
+
+    for folder_id in {vm.folder_id for vm in instances}:
+        for data in lister.list_folder(folder_id):
+            if data['id'] in wanted:
+                disks[data['id']] = data
+
+    # Disks outside of the instance folder
+    for disk_id in wanted - set(disks):
+        data = lister.get(disk_id)
+        if data is not None:
+            disks[disk_id] = data
+
+    return disks
+
+
+class Job:
+
+    '''
+    Snapshot job of an instance: stop, snapshots of its disks, start.
+
+    Attributes:
+      :vm: Instance object
+      :stop_time, start_time: estimated seconds, 0 if the instance isn't running
+      :snapshots: list of (disk dict, estimated seconds)
+      :begin, end: seconds from the run start, set by RunPlanner.simulate()
+    '''
+
+    def __init__(self, vm, stop_time, start_time, snapshots):
+        self.vm = vm
+        self.stop_time = stop_time
+        self.start_time = start_time
+        self.snapshots = snapshots
+        self.begin = 0
+        self.end = 0
+
+    @property
+    def duration(self):
+        # Disks of an instance are snapshotted in parallel
+        return self.stop_time + max((x[1] for x in self.snapshots), default=0) + self.start_time
+
+    @property
+    def work(self):
+        return self.stop_time + sum(x[1] for x in self.snapshots) + self.start_time
+
+
+class RunPlanner:
+
+    '''
+    Plans the create stage of a run from disk sizes and types.
+
+    A snapshot is estimated at snapshot_time seconds plus the disk size at
+    snapshot_rate MB per second (rates overrides it by disk type). Jobs
+    are simulated the way an async run executes them: every operation
+    holds one of max_operations slots (and one of the limit of its kind),
+    a freed slot goes to the ready operation of the highest ranked job.
+    Ordering jobs longest first keeps a 2 TB disk from being started last
+    and stretching the run long after the short jobs are done.
+
+    Methods:
+      estimate() -> return estimated seconds of a disk snapshot
+      jobs() -> return Job list for instances, in the given order
+      simulate() -> set begin and end of jobs in order of rank, return makespan
+      sequential() -> return estimated seconds of a sequential run
+      plan() -> return (jobs longest first, makespan, makespan in the given order)
+    '''
+
+    def __init__(self, stop_time=30, start_time=30, snapshot_time=10, snapshot_rate=100, rates=None,
+                 max_operations=15, limits=None, lister=None):
+        self.stop_time = stop_time
+        self.start_time = start_time
+        self.snapshot_time = snapshot_time
+        self.snapshot_rate = snapshot_rate
+        self.rates = rates or {}
+        self.max_operations = max_operations
+        self.limits = limits or {}
+        self.lister = lister
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            stop_time=config.plan_stop_time, start_time=config.plan_start_time,
+            snapshot_time=config.plan_snapshot_time, snapshot_rate=config.plan_snapshot_rate,
+            rates=config.plan_snapshot_rates, max_operations=config.max_operations, limits=config.operation_limits
+        )
+
+    def limit(self, kind):
+        return min(self.limits.get(kind) or self.max_operations, self.max_operations)
+
+    def estimate(self, disk):
+        rate = self.rates.get(disk.get('typeId'), self.snapshot_rate)
+        return self.snapshot_time + int(disk.get('size') or 0) / MB / rate
+
+    def jobs(self, instances, disks=None):
+        instances = [vm for vm in instances if vm.instance_data]
+        disks = disks_metadata(instances, self.lister) if disks is None else disks
+        result = []
+
+        for vm in instances:
+            # Status from the listing: vm.status would send a GET per instance once the cache expires
+            running = vm.instance_data.get('status') not in NEGATIVE_STATES
+            snapshots = [
+                (disks.get(disk_id) or {'id': disk_id}, self.estimate(disks.get(disk_id) or {}))
+                for disk_id in vm.snapshot_disks
+            ]
+            result.append(Job(vm, self.stop_time if running else 0, self.start_time if running else 0, snapshots))
+
+        return result
+
+    def simulate(self, jobs):
+        kinds = ('stop', 'snapshot', 'start')
+        ready = {kind: [] for kind in kinds}
+        busy = dict.fromkeys(kinds, 0)
+        left = {}
+        running = []
+        counter = itertools.count()
+        now = 0
+
+        def push(kind, rank, seconds):
+            heapq.heappush(ready[kind], (rank, next(counter), seconds))
+
+        def next_stage(rank, kind):
+            job = jobs[rank]
+            if kind == 'stop':
+                for _, seconds in job.snapshots:
+                    push('snapshot', rank, seconds)
+                left[rank] = len(job.snapshots)
+                if job.snapshots:
+                    return
+
+            if kind != 'start' and job.start_time:
+                push('start', rank, job.start_time)
+            else:
+                job.end = now
+
+        for rank, job in enumerate(jobs):
+            job.begin = job.end = None
+            if job.stop_time:
+                push('stop', rank, job.stop_time)
+            else:
+                next_stage(rank, 'stop')
+
+        while True:
+            while sum(busy.values()) < self.max_operations:
+                heads = [(ready[kind][0], kind) for kind in kinds if ready[kind] and busy[kind] < self.limit(kind)]
+                if not heads:
+                    break
+
+                (rank, _, seconds), kind = min(heads)
+                heapq.heappop(ready[kind])
+                busy[kind] += 1
+                if jobs[rank].begin is None:
+                    jobs[rank].begin = now
+                heapq.heappush(running, (now + seconds, next(counter), rank, kind))
+
+            if not running:
+                break
+
+            now, _, rank, kind = heapq.heappop(running)
+            busy[kind] -= 1
+
+            if kind == 'snapshot':
+                left[rank] -= 1
+                if not left[rank]:
+                    next_stage(rank, kind)
+            else:
+                next_stage(rank, kind)
+
+        for job in jobs:
+            job.begin = job.end if job.begin is None else job.begin
+
+        return max((job.end for job in jobs), default=0)
+
+    def sequential(self, jobs):
+        # snaps.py without --async: one instance at a time, disks in batches of max_operations
+        total = 0
+        for job in jobs:
+            seconds = [x[1] for x in job.snapshots]
+            batches = [seconds[i:i + self.max_operations] for i in range(0, len(seconds), self.max_operations)]
+            total += job.stop_time + sum(max(x) for x in batches) + job.start_time
+
+        return total
+
+    def plan(self, instances):
+        jobs = self.jobs(instances)
+        given = self.simulate(jobs)
+
+        # Longest processing time first, instances with more disks win ties
+        ordered = sorted(jobs, key=lambda x: (x.duration, x.work), reverse=True)
+        return ordered, self.simulate(ordered), given
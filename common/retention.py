@@ -0,0 +1,124 @@
+import logging
+
+from datetime import datetime, timedelta
+
+from common.config import Config as config
+from common.discovery import match_ref
+
+logger = logging.getLogger(__name__)
+
+# Periods of grandfather-father-son rotation, from the shortest
+PERIODS = ('daily', 'weekly', 'monthly')
+
+
+def period_key(period, created_at):
+    if period == 'daily':
+        return created_at.date()
+    elif period == 'weekly':
+        return created_at.isocalendar()[:2]
+
+    return created_at.year, created_at.month
+
+
+class RetentionPolicy:
+
+    '''
+    Grandfather-father-son retention policy for snapshots of a disk.
+
+    A snapshot is kept if any rule keeps it:
+      last -> one of the newest N snapshots
+      days -> created in the last N days
+      daily, weekly, monthly -> the newest snapshot of a day, ISO week or
+        month, for the newest N days, weeks or months that have snapshots
+
+    Without days and periods the policy keeps snapshots for Lifetime days,
+    the same as the plain lifetime cleanup.
+
+    Methods:
+      plan() -> yield (created_at, snapshot, reasons), reasons is empty for snapshots to delete
+    '''
+
+    def __init__(self, last=0, days=None, daily=0, weekly=0, monthly=0):
+        self.last = last
+        self.days = days
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+
+    @classmethod
+    def from_dict(cls, data, lifetime=None):
+        data = dict(data)
+        if data.get('days') is None and not any(data.get(x) for x in PERIODS):
+            data['days'] = int(config.lifetime) if lifetime is None else lifetime
+
+        return cls(**data)
+
+    def plan(self, entries, now=None):
+        '''
+        entries are (created_at, snapshot) sorted oldest first, as kept by
+        SnapshotIndex. They are walked once, newest first: the first snapshot
+        seen in a period is the newest one of that period.
+        '''
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(days=self.days) if self.days is not None else None
+        limits = {x: getattr(self, x) for x in PERIODS}
+        counts = dict.fromkeys(PERIODS, 0)
+        last_keys = {}
+
+        for position, (created_at, snapshot) in enumerate(reversed(entries)):
+            reasons = []
+
+            if position < self.last:
+                reasons.append('last')
+            if cutoff is not None and created_at > cutoff:
+                reasons.append('days')
+
+            for period in PERIODS:
+                if counts[period] >= limits[period]:
+                    continue
+
+                key = period_key(period, created_at)
+                if key != last_keys.get(period):
+                    last_keys[period] = key
+                    counts[period] += 1
+                    reasons.append(period)
+
+            yield created_at, snapshot, reasons
+
+    def __str__(self):
+        rules = [('last', self.last), ('days', self.days)] + [(x, getattr(self, x)) for x in PERIODS]
+        return ' '.join(f'{key}={value}' for key, value in rules if value)
+
+
+class RetentionPolicies:
+
+    '''
+    Retention policies from [Retention] config sections.
+
+    [Retention] is the default policy, [Retention <ref>] sections override
+    it for instances matched by ref: instance ID, name, label selector or
+    folder scope, the same entries as in [Instances]. Options missing in an
+    override are taken from the default section. The first matching
+    section wins.
+
+    Methods:
+      get() -> return RetentionPolicy for instance data
+    '''
+
+    def __init__(self, default=None, overrides=None):
+        self.default = default or RetentionPolicy.from_dict({})
+        self.overrides = overrides or []
+
+    @classmethod
+    def from_config(cls):
+        sections = dict(config.retention)
+        default = sections.pop(None, {})
+        overrides = [(ref, RetentionPolicy.from_dict(dict(default, **x))) for ref, x in sections.items()]
+        return cls(RetentionPolicy.from_dict(default), overrides)
+
+    def get(self, data):
+        for ref, policy in self.overrides:
+            if data and match_ref(ref, data):
+                return policy
+
+        return self.default
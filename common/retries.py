@@ -0,0 +1,178 @@
+import time
+import random
+import logging
+import threading
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from common.config import Config as config
+from common.exceptions import CircuitOpenError
+from common.metrics import CIRCUIT_OPEN
+
+logger = logging.getLogger(__name__)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def parse_retry_after(value):
+    '''Seconds to wait from Retry-After header: delta-seconds or HTTP date.'''
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def retry_after(headers):
+    return parse_retry_after((headers or {}).get('Retry-After'))
+
+
+class RetryPolicy:
+
+    '''
+    Full-jitter exponential backoff limited by tries and a total deadline.
+
+    A pause before attempt N is a random value between 0 and
+    min(max_delay, delay * 2 ** N), so clients failed at the same moment
+    don't come back in step. A Retry-After hint of the server is used
+    instead when it is longer. Nothing is retried once the next pause
+    would end after the deadline (seconds since the first attempt).
+
+    Attributes:
+      :statuses: HTTP statuses retried by the API clients
+      :methods: HTTP methods retried on those statuses without an explicit retry=True
+
+    Methods:
+      backoff() -> return jittered pause before attempt
+      pause() -> return pause before attempt or None when out of tries or time
+    '''
+
+    def __init__(self, tries=4, delay=1, max_delay=30, deadline=120,
+                 statuses=(429, 502, 503, 504), methods=('GET',)):
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.statuses = tuple(statuses)
+        self.methods = tuple(methods)
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            tries=config.retry_tries,
+            delay=config.retry_delay,
+            max_delay=config.retry_max_delay,
+            deadline=config.retry_deadline,
+            statuses=config.retry_statuses
+        )
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt))
+
+    def remaining(self, started):
+        if not self.deadline:
+            return None
+        return self.deadline - (time.monotonic() - started)
+
+    def pause(self, attempt, started, hint=None):
+        '''
+        attempt is a number of the failed attempt from 0, started is
+        monotonic time of the first one, hint is Retry-After in seconds.
+        '''
+        if attempt + 1 >= self.tries:
+            return None
+
+        pause = max(self.backoff(attempt), hint or 0)
+        remaining = self.remaining(started)
+        if remaining is not None and pause >= remaining:
+            return None
+
+        return pause
+
+
+class CircuitBreaker:
+
+    '''
+    Fails requests to an unhealthy endpoint fast instead of piling them up.
+
+    After threshold failures in a row (network errors or HTTP 5xx) the
+    circuit opens: requests raise CircuitOpenError without being sent for
+    reset_timeout seconds. Then one trial request is let through
+    (half-open), its success closes the circuit and its failure keeps it
+    open.
+
+    Methods:
+      check() -> raise CircuitOpenError while open
+      success(), failure() -> record result of a request
+    '''
+
+    def __init__(self, name, threshold=5, reset_timeout=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        if not self.threshold:
+            return
+
+        with self.lock:
+            if self.opened_at is None:
+                return
+
+            left = self.opened_at + self.reset_timeout - time.monotonic()
+            if left > 0:
+                raise CircuitOpenError(self.name, left)
+
+            # Half-open: this request is the trial one, others fail fast
+            # until it succeeds or for another reset_timeout
+            self.opened_at = time.monotonic()
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f'Endpoint {self.name} recovered, circuit closed')
+                CIRCUIT_OPEN.set(0, endpoint=self.name)
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        if not self.threshold:
+            return
+
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.threshold:
+                return
+
+            if self.opened_at is None:
+                logger.warning(f'Endpoint {self.name} failed {self.failures} times in a row, circuit open for {self.reset_timeout} seconds')
+                CIRCUIT_OPEN.set(1, endpoint=self.name)
+            self.opened_at = time.monotonic()
+
+
+def get_breaker(name):
+    '''Return process-wide CircuitBreaker of an endpoint, shared by sync and async clients.'''
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, config.breaker_threshold, config.breaker_reset_timeout)
+            _breakers[name] = breaker
+
+    return breaker
@@ -0,0 +1,152 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import contextlib
+
+from common.config import Config as config
+from common.exceptions import RetryableError
+from common.trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+
+class PrioritySemaphore:
+
+    '''
+    asyncio semaphore that gives a released slot to the waiter with the
+    lowest priority value, waiters of the same priority are served in
+    arrival order.
+
+    Methods:
+      acquire() -> wait for a slot (coroutine)
+      release() -> free the slot
+      hold() -> async context manager holding a slot
+    '''
+
+    def __init__(self, value):
+        self.value = value
+        self._waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority=0):
+        if self.value > 0 and not self._waiters:
+            self.value -= 1
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot was already handed over, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.value += 1
+
+    @contextlib.asynccontextmanager
+    async def hold(self, priority=0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class OperationScheduler:
+
+    '''
+    Limits the number of cloud operations in flight.
+
+    A slot is held from the moment an operation is submitted until it is
+    done, so the active-operations quota of the cloud is never exceeded by
+    this process. Operations rejected with 429 or 5xx (RetryableError)
+    are requeued with full-jitter backoff, or after Retry-After if the
+    server asked for a longer pause. A free slot goes to the waiting
+    operation with the lowest priority value (the planned order of jobs),
+    operations of the same priority are served first come, first served.
+
+    Methods:
+      limit() -> return max operations in flight for a kind
+      pause() -> return seconds before a requeued attempt
+      run() -> submit operation, wait for it and return the wait() result
+    '''
+
+    def __init__(self, max_operations=15, limits=None, retry_delay=5, max_delay=60, max_requeue=10):
+        self.max_operations = max_operations
+        self.limits = limits or {}
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.max_requeue = max_requeue
+        self._global = None
+        self._semaphores = {}
+
+    @classmethod
+    def from_config(cls):
+        return cls(max_operations=config.max_operations, limits=config.operation_limits)
+
+    def limit(self, kind):
+        return min(self.limits.get(kind) or self.max_operations, self.max_operations)
+
+    def pause(self, attempt, hint=None):
+        # Full jitter, requeued operations of a burst don't come back in step
+        return max(random.uniform(0, min(self.retry_delay * 2 ** attempt, self.max_delay)), hint or 0)
+
+    def _semaphore(self, kind):
+        # Semaphores are created lazily inside the running loop
+        if self._global is None:
+            self._global = PrioritySemaphore(self.max_operations)
+
+        if kind not in self._semaphores:
+            self._semaphores[kind] = PrioritySemaphore(self.limit(kind))
+
+        return self._semaphores[kind]
+
+    async def run(self, kind, submit, wait, priority=0, requeued=None):
+        '''
+        Run operation of a given kind (stop, start, snapshot, delete).
+        submit is a coroutine function that returns operation id,
+        wait is a coroutine function that takes operation id,
+        requeued is called every time a rejected operation is requeued.
+        '''
+        kind_semaphore = self._semaphore(kind)
+
+        for attempt in range(self.max_requeue + 1):
+            queued = time.monotonic()
+            async with kind_semaphore.hold(priority), self._global.hold(priority):
+                TRACER.complete(f'{kind} queued', 'queue', queued, attempt=attempt)
+                try:
+                    operation_id = await submit()
+                except RetryableError as err:
+                    logger.warning(f'{kind.capitalize()} operation rejected: {err}')
+                    hint = err.retry_after
+                else:
+                    if not operation_id:
+                        return
+                    return await wait(operation_id)
+
+            if attempt == self.max_requeue:
+                break
+            if requeued is not None:
+                requeued()
+
+            # Sleep outside of the slot, so other operations can proceed
+            pause = self.pause(attempt, hint)
+            logger.info(f'Requeue {kind} operation in {pause:.1f} seconds')
+            TRACER.instant('retry', 'retry', kind=kind)
+            with TRACER.span(f'{kind} requeue', 'sleep'):
+                await asyncio.sleep(pause)
+
+        logger.error(f'{kind.capitalize()} operation was rejected {self.max_requeue + 1} times, giving up')
@@ -0,0 +1,295 @@
+import time
+import asyncio
+import logging
+import threading
+import aiohttp
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from common.config import Config as config
+from common.exceptions import CircuitOpenError
+from common.metrics import API_RETRIES, endpoint, observe_request
+from common.retries import RetryPolicy, get_breaker, retry_after
+from common.trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_client_lock = threading.Lock()
+_async_client = None
+
+# Failures of a request worth sending it again, also counted by circuit breakers
+NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout, CircuitOpenError)
+ASYNC_NETWORK_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError, CircuitOpenError)
+
+
+def reauthorize(kwargs):
+    '''
+    Return request kwargs with a new IAM token in place of the bearer
+    token rejected with 401, None if the request has no token of ours.
+    '''
+    # common.iam sends the token exchange through this module
+    from common.iam import refresh_token
+
+    authorization = (kwargs.get('headers') or {}).get('Authorization', '')
+    if not authorization.startswith('Bearer '):
+        return None
+
+    token = refresh_token(authorization[len('Bearer '):])
+    if token is None:
+        return None
+
+    return dict(kwargs, headers=dict(kwargs['headers'], Authorization=f'Bearer {token}'))
+
+
+class ApiClient:
+
+    '''
+    Shared HTTP client for Yandex Cloud APIs.
+
+    One requests.Session with keep-alive connections, a separate pool is
+    kept per host (iam, compute, operation), so polling and batch calls
+    reuse already established TLS connections.
+
+    Reads answered with a retryable status (429, 503..) are sent again
+    with the backoff of the retry policy, Retry-After is honored. The read
+    timeout of a retry is cut to the time left before the deadline.
+    Requests to an endpoint with an open circuit breaker raise
+    CircuitOpenError without being sent. A request rejected with 401 is
+    sent once more with a newly exchanged IAM token.
+
+    Methods:
+      request() -> return requests.Response
+      get(), post(), delete() -> shortcuts for request()
+    '''
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=30, policy=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.policy = policy or RetryPolicy()
+        self.session = requests.Session()
+
+        # pool_connections is a number of per-host pools to keep,
+        # pool_maxsize is a number of keep-alive connections in each pool
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, retry=None, **kwargs):
+        '''
+        retry=None retries reads (policy methods) only, pass True for
+        idempotent writes and False to send a request once.
+        '''
+        retry = method in self.policy.methods if retry is None else retry
+        breaker = get_breaker(endpoint(url))
+        started = time.monotonic()
+        attempt = 0
+        reauthorized = None
+
+        while True:
+            remaining = self.policy.remaining(started)
+            read_timeout = self.read_timeout if remaining is None else max(min(self.read_timeout, remaining), 1)
+            r = self._send(breaker, method, url, timeout=(self.connect_timeout, read_timeout), **kwargs)
+
+            if r.status_code == 401 and not reauthorized:
+                reauthorized = reauthorize(kwargs)
+                if reauthorized:
+                    kwargs = reauthorized
+                    continue
+
+            if not retry or r.status_code not in self.policy.statuses:
+                return r
+
+            pause = self.policy.pause(attempt, started, retry_after(r.headers))
+            if pause is None:
+                return r
+
+            API_RETRIES.inc(endpoint=breaker.name, status=r.status_code)
+            logger.warning(f'{r.status_code} from {breaker.name} API. Retrying in {pause:.1f} seconds...')
+            TRACER.instant('retry', 'retry', endpoint=breaker.name, status=r.status_code)
+            with TRACER.span(f'retry {breaker.name}', 'sleep'):
+                time.sleep(pause)
+            attempt += 1
+
+    def _send(self, breaker, method, url, **kwargs):
+        breaker.check()
+        started = time.monotonic()
+
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except Exception as err:
+            observe_request(method, url, 'error', started)
+            if isinstance(err, NETWORK_ERRORS):
+                breaker.failure()
+            raise
+
+        observe_request(method, url, r.status_code, started)
+        if r.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_client():
+    '''Return process-wide ApiClient configured from [Network] section.'''
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ApiClient(
+                    pool_size=config.pool_size,
+                    connect_timeout=config.connect_timeout,
+                    read_timeout=config.read_timeout,
+                    policy=RetryPolicy.from_config()
+                )
+
+    return _client
+
+
+class AsyncResponse:
+
+    '''
+    Body of aiohttp response read in full, so it can outlive the connection.
+    Mirrors the requests.Response attributes used by the models.
+    '''
+
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+
+class AsyncApiClient:
+
+    '''
+    Shared aiohttp client for Yandex Cloud APIs.
+
+    The aiohttp session is bound to the event loop, so it is created lazily
+    on first request and recreated if the running loop changes. Retries,
+    circuit breakers and the new token on 401 work the same way as in
+    ApiClient, pauses and token exchanges don't block the loop.
+
+    Methods:
+      request() -> return AsyncResponse
+      get(), post(), delete() -> shortcuts for request()
+      close() -> close session and keep-alive connections
+    '''
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=30, policy=None):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.policy = policy or RetryPolicy()
+        self._session = None
+        self._loop = None
+
+    @property
+    def session(self):
+        loop = asyncio.get_event_loop()
+
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+
+        return self._session
+
+    async def request(self, method, url, retry=None, **kwargs):
+        retry = method in self.policy.methods if retry is None else retry
+        breaker = get_breaker(endpoint(url))
+        started = time.monotonic()
+        attempt = 0
+        reauthorized = None
+
+        while True:
+            remaining = self.policy.remaining(started)
+            timeout = self.timeout if remaining is None else aiohttp.ClientTimeout(
+                total=max(remaining, 1), sock_connect=self.connect_timeout, sock_read=self.read_timeout
+            )
+            r = await self._send(breaker, method, url, timeout=timeout, **kwargs)
+
+            if r.status_code == 401 and not reauthorized:
+                # The token exchange blocks, it runs in a thread
+                reauthorized = await asyncio.get_event_loop().run_in_executor(None, reauthorize, kwargs)
+                if reauthorized:
+                    kwargs = reauthorized
+                    continue
+
+            if not retry or r.status_code not in self.policy.statuses:
+                return r
+
+            pause = self.policy.pause(attempt, started, retry_after(r.headers))
+            if pause is None:
+                return r
+
+            API_RETRIES.inc(endpoint=breaker.name, status=r.status_code)
+            logger.warning(f'{r.status_code} from {breaker.name} API. Retrying in {pause:.1f} seconds...')
+            TRACER.instant('retry', 'retry', endpoint=breaker.name, status=r.status_code)
+            with TRACER.span(f'retry {breaker.name}', 'sleep'):
+                await asyncio.sleep(pause)
+            attempt += 1
+
+    async def _send(self, breaker, method, url, **kwargs):
+        breaker.check()
+        started = time.monotonic()
+
+        try:
+            async with self.session.request(method, url, **kwargs) as r:
+                text = await r.text()
+        except Exception as err:
+            observe_request(method, url, 'error', started)
+            if isinstance(err, ASYNC_NETWORK_ERRORS):
+                breaker.failure()
+            raise
+
+        observe_request(method, url, r.status, started)
+        if r.status >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return AsyncResponse(r.status, text, r.headers)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request('DELETE', url, **kwargs)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+def get_async_client():
+    '''Return process-wide AsyncApiClient configured from [Network] section.'''
+    global _async_client
+
+    if _async_client is None:
+        _async_client = AsyncApiClient(
+            pool_size=config.pool_size,
+            connect_timeout=config.connect_timeout,
+            read_timeout=config.read_timeout,
+            policy=RetryPolicy.from_config()
+        )
+
+    return _async_client
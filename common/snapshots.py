@@ -0,0 +1,109 @@
+import bisect
+import asyncio
+import logging
+import threading
+
+from time import monotonic
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def parse_created_at(snapshot):
+    return datetime.strptime(snapshot['createdAt'], '%Y-%m-%dT%H:%M:%Sz')
+
+
+class SnapshotIndex:
+
+    '''
+    Snapshots of a run indexed by folder and source disk.
+
+    Every folder is listed once, on the first request for it, then all
+    Instance objects of the folder are served from memory. Snapshots of a
+    disk are kept sorted by creation time (oldest first) with createdAt
+    already parsed. An index kept between runs (snaps.py --daemon) lists
+    a folder again once it's older than max_age seconds.
+
+    Methods:
+      ensure() -> list folder with a sync snapshot iterator if not indexed yet
+      async_ensure() -> same for an async iterator
+      entries() -> return list of (created_at, snapshot) for disk
+      snapshots() -> return list of snapshots for disk
+      add() -> add created snapshot to the index
+      discard() -> remove deleted snapshot from the index
+    '''
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._folders = {}
+        self._loaded_at = {}
+        self._lock = threading.Lock()
+        self._folder_locks = {}
+        self._async_locks = {}
+
+    def __contains__(self, folder_id):
+        return folder_id in self._folders
+
+    def fresh(self, folder_id):
+        if folder_id not in self._folders:
+            return False
+
+        return not self.max_age or monotonic() - self._loaded_at[folder_id] < self.max_age
+
+    def load(self, folder_id, snapshots):
+        disks = {}
+        for snapshot in snapshots:
+            disks.setdefault(snapshot['sourceDiskId'], []).append((parse_created_at(snapshot), snapshot))
+
+        for entries in disks.values():
+            entries.sort(key=lambda x: x[0])
+
+        self._folders[folder_id] = disks
+        self._loaded_at[folder_id] = monotonic()
+        count = sum(len(x) for x in disks.values())
+        logger.info(f'Indexed {count} snapshots of {len(disks)} disks in folder {folder_id}')
+
+    def ensure(self, folder_id, lister):
+        '''lister is a callable returning an iterable of folder snapshots.'''
+        if self.fresh(folder_id):
+            return
+
+        with self._lock:
+            folder_lock = self._folder_locks.setdefault(folder_id, threading.Lock())
+
+        with folder_lock:
+            if not self.fresh(folder_id):
+                self.load(folder_id, lister())
+
+    async def async_ensure(self, folder_id, lister):
+        '''lister is a callable returning an async iterable of folder snapshots.'''
+        if self.fresh(folder_id):
+            return
+
+        folder_lock = self._async_locks.setdefault(folder_id, asyncio.Lock())
+        async with folder_lock:
+            if not self.fresh(folder_id):
+                self.load(folder_id, [x async for x in lister()])
+
+    def entries(self, folder_id, disk_id):
+        return self._folders.get(folder_id, {}).get(disk_id, [])
+
+    def snapshots(self, folder_id, disk_id):
+        return [snapshot for _, snapshot in self.entries(folder_id, disk_id)]
+
+    def add(self, snapshot):
+        disks = self._folders.get(snapshot['folderId'])
+        if disks is None:
+            return
+
+        entries = disks.setdefault(snapshot['sourceDiskId'], [])
+        keys = [x[0] for x in entries]
+        created_at = parse_created_at(snapshot)
+        entries.insert(bisect.bisect_right(keys, created_at), (created_at, snapshot))
+
+    def discard(self, snapshot):
+        disks = self._folders.get(snapshot.get('folderId'), {})
+        entries = disks.get(snapshot.get('sourceDiskId'))
+
+        if entries:
+            disks[snapshot['sourceDiskId']] = [x for x in entries if x[1]['id'] != snapshot['id']]
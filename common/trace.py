@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# Events kept per run, later events are dropped
+MAX_EVENTS = 1000000
+# Categories of the summary table: phases are measured by their extent, the rest is summed
+PHASES = ('search', 'delete', 'stop', 'snapshot', 'start')
+COSTS = ('queue', 'api', 'wait', 'sleep')
+
+_lane = contextvars.ContextVar('trace_lane', default=None)
+
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Lane:
+
+    '''Trace thread (pid, tid) used by one task at a time, so its spans nest.'''
+
+    def __init__(self, pid, tid, name):
+        self.pid = pid
+        self.tid = tid
+        self.name = name
+        self.busy = False
+
+
+class Span:
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.complete(self.name, self.cat, self.started, **self.args)
+
+
+class TrackSpan:
+
+    def __init__(self, tracer, process, name):
+        self.tracer = tracer
+        self.process = process
+        self.name = name
+
+    def __enter__(self):
+        self.lane = self.tracer.lane(self.process, self.name)
+        self.token = _lane.set(self.lane)
+        return self.lane
+
+    def __exit__(self, *args):
+        _lane.reset(self.token)
+        self.lane.busy = False
+
+
+class UseSpan:
+
+    def __init__(self, lane):
+        self.lane = lane
+
+    def __enter__(self):
+        self.token = _lane.set(self.lane)
+
+    def __exit__(self, *args):
+        _lane.reset(self.token)
+
+
+class Tracer:
+
+    '''
+    Timeline of a run in Chrome trace event format, opened by Perfetto
+    (ui.perfetto.dev) and chrome://tracing.
+
+    Every instance is a trace process, its tracks are lanes: main for the
+    stop -> snapshot -> start job, one per disk snapshotted concurrently
+    and one per delete. A lane is held by one task at a time and reused
+    afterwards, so spans of a lane are properly nested. Spans are recorded
+    on the lane of the current context (contextvars, so asyncio tasks keep
+    their own), spans outside of any track go to the run process.
+
+    Span categories: search, delete, stop, snapshot, start (phases of an
+    instance), queue (waiting for a scheduler slot), api (HTTP requests),
+    wait (waiting for an operation), sleep (polling and retry pauses) and
+    retry (instant events). A disabled tracer records nothing and costs
+    an attribute check per call.
+
+    Methods:
+      start() -> enable tracing and drop events of the previous run
+      stop() -> disable tracing
+      track() -> context manager putting spans on a lane of a process
+      current(), use() -> capture the lane and restore it in another task
+      span() -> context manager recording a span
+      complete() -> record a span that started at a monotonic time
+      instant() -> record an instant event
+      export() -> write trace JSON file
+      summary() -> return (slowest instances, phases) rows
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.processes = {}
+        self.lanes = {}
+        self.recorded = 0
+        self.dropped = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.reset()
+        self.enabled = True
+        self.lane('run', 'main')
+
+    def stop(self):
+        self.enabled = False
+
+    def process(self, name):
+        if name not in self.processes:
+            self.processes[name] = len(self.processes) + 1
+            self.meta('process_name', self.processes[name], 0, name)
+            self.meta('process_sort_index', self.processes[name], 0, sort_index=self.processes[name])
+
+        return self.processes[name]
+
+    def lane(self, process, name):
+        with self._lock:
+            pid = self.process(process)
+            lanes = self.lanes.setdefault(pid, [])
+
+            for lane in lanes:
+                if lane.name == name and not lane.busy:
+                    break
+            else:
+                lane = Lane(pid, len(lanes) + 1, name)
+                lanes.append(lane)
+                self.meta('thread_name', pid, lane.tid, name)
+
+            lane.busy = True
+            return lane
+
+    def meta(self, kind, pid, tid, name=None, **args):
+        self.events.append({'name': kind, 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name} if name else args})
+
+    def current(self):
+        return _lane.get()
+
+    def use(self, lane):
+        return UseSpan(lane) if self.enabled and lane is not None else NULL_SPAN
+
+    def track(self, process, name='main'):
+        return TrackSpan(self, process, name) if self.enabled else NULL_SPAN
+
+    def span(self, name, cat, **args):
+        return Span(self, name, cat, args) if self.enabled else NULL_SPAN
+
+    def add(self, event):
+        lane = _lane.get() or self.lanes[1][0]
+        event.update(pid=lane.pid, tid=lane.tid)
+
+        if self.recorded >= MAX_EVENTS:
+            self.dropped += 1
+            return
+
+        self.recorded += 1
+        self.events.append(event)
+
+    def complete(self, name, cat, started, **args):
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        self.add({
+            'name': name, 'cat': cat, 'ph': 'X', 'ts': round((started - self.started) * 1e6, 1),
+            'dur': round((now - started) * 1e6, 1), 'args': args
+        })
+
+    def instant(self, name, cat, **args):
+        if not self.enabled:
+            return
+
+        self.add({
+            'name': name, 'cat': cat, 'ph': 'i', 's': 't',
+            'ts': round((time.monotonic() - self.started) * 1e6, 1), 'args': args
+        })
+
+    def export(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+        if self.dropped:
+            logger.warning(f'Trace is cut, {self.dropped} events over {MAX_EVENTS} were dropped')
+        logger.info(f'Trace of the run with {len(self.events)} events is written to {path}')
+
+    def summary(self):
+        '''
+        Return (instances, phases). Instance rows are dicts, slowest first:
+        total is the time spent in any phase, every phase is measured from
+        its first span start to its last span end, costs are summed over
+        lanes. Phase rows are (category, count, total, max, slowest instance).
+        '''
+        names = {pid: name for name, pid in self.processes.items()}
+        instances = {}
+        phases = {}
+
+        for event in self.events:
+            name = names.get(event['pid'])
+            if event['ph'] not in ('X', 'i') or name in (None, 'run'):
+                continue
+
+            row = instances.setdefault(name, {'instance': name, 'retries': 0, 'spans': []})
+            cat = event.get('cat')
+            if event['ph'] == 'i':
+                row['retries'] += cat == 'retry'
+                continue
+
+            start = event['ts'] / 1e6
+            seconds = event['dur'] / 1e6
+            if cat in PHASES:
+                row['spans'].append((start, start + seconds))
+                first, last = row.get(cat, (start, start + seconds))
+                row[cat] = (min(first, start), max(last, start + seconds))
+            elif cat in COSTS:
+                row[cat] = row.get(cat, 0) + seconds
+            else:
+                continue
+
+            count, total, longest, where = phases.get(cat, (0, 0, 0, None))
+            phases[cat] = (count + 1, total + seconds, max(longest, seconds), name if seconds >= longest else where)
+
+        for row in instances.values():
+            for cat in PHASES:
+                if cat in row:
+                    row[cat] = row[cat][1] - row[cat][0]
+
+            # Union of phase spans: concurrent disks and deletes are counted once
+            row['total'] = 0
+            end = None
+            for start, stop in sorted(row.pop('spans')):
+                if end is None or start > end:
+                    row['total'] += stop - start
+                    end = stop
+                elif stop > end:
+                    row['total'] += stop - end
+                    end = stop
+
+        rows = sorted(instances.values(), key=lambda x: x['total'], reverse=True)
+        order = PHASES + COSTS
+        return rows, sorted([(cat,) + value for cat, value in phases.items()], key=lambda x: order.index(x[0]))
+
+    def log_summary(self, top=10):
+        instances, phases = self.summary()
+        if not instances:
+            return
+
+        columns = ('total',) + PHASES + COSTS
+        logger.info('Slowest instances (seconds, queue/api/wait/sleep summed over lanes):')
+        logger.info('  ' + f'{"instance":<24}' + ''.join(f'{x:>10}' for x in columns) + f'{"retries":>9}')
+
+        for row in instances[:top]:
+            values = ''.join(f'{row[x]:>10.1f}' if x in row else f'{"-":>10}' for x in columns)
+            logger.info(f'  {row["instance"][:24]:<24}{values}{row["retries"]:>9}')
+
+        logger.info('Phases (seconds):')
+        logger.info(f'  {"phase":<10}{"count":>8}{"total":>10}{"mean":>10}{"max":>10}  slowest instance')
+        for cat, count, total, longest, where in phases:
+            logger.info(f'  {cat:<10}{count:>8}{total:>10.1f}{total / count:>10.1f}{longest:>10.1f}  {where}')
+
+
+TRACER = Tracer()
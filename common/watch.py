@@ -0,0 +1,270 @@
+import time
+import random
+import asyncio
+import logging
+
+from functools import partial
+
+from common.async_compute import AsyncInstance, NETWORK_ERRORS
+from common.config import Config as config
+from common.discovery import AsyncInstanceLister
+from common.decorators import human_time
+from common.metrics import WATCHDOG_STARTS, WATCHDOG_PREEMPTIONS
+
+logger = logging.getLogger(__name__)
+
+START_OPERATIONS = ('StartInstanceMetadata', 'RestartInstanceMetadata')
+
+
+def is_start_operation(operation):
+    operation_type = (operation.get('metadata') or {}).get('@type', '')
+    return operation_type.endswith(START_OPERATIONS)
+
+
+class TargetState:
+
+    '''
+    Watchdog state of a target instance.
+
+    Attributes:
+      :instance: AsyncInstance
+      :event_at: monotonic time of the last stop seen or start sent
+      :started_at: monotonic time of the last start done by the watchdog
+      :failures: starts in a row after which the instance stopped again soon
+      :blocked_until: monotonic time before which the instance is not started
+      :task: running start task, new triggers are ignored until it's done
+      :operation_id: start operation in flight, sent by us or by another client
+    '''
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.last_status = instance.status
+        self.event_at = None
+        self.started_at = None
+        self.failures = 0
+        self.blocked_until = 0
+        self.task = None
+        self.operation_id = None
+        self.busy = False
+
+    @property
+    def starting(self):
+        return self.task is not None and not self.task.done()
+
+
+class Watchdog:
+
+    '''
+    Starts stopped (preempted) target instances.
+
+    Targets are checked by folder: a tick lists every due folder once, so
+    requests per tick depend on the number of folders, not targets. Each
+    folder is checked every delay seconds, or every fast_delay seconds for
+    fast_period seconds after a target of the folder was stopped or
+    started. Intervals are jittered, so folders and watchdog processes
+    don't poll in step.
+
+    An instance that stops again within fast_period after a start is
+    crash looping: its next start is delayed by backoff seconds, doubled
+    on every failure up to max_backoff. Staying up for fast_period
+    resets the backoff.
+
+    Before a start the running operations of the instance are checked: a
+    start in flight (sent before a restart of the watchdog or by another
+    client) is waited for instead of sending a new one, any other running
+    operation defers the start to a later tick. A start that outlives the
+    operation timeout is still tracked, not sent again.
+
+    Methods:
+      add() -> watch instance dict
+      remove() -> stop watching instance dict
+      tick() -> check due folders
+      run() -> check folders forever
+    '''
+
+    def __init__(self, scheduler, lister=None, delay=10, fast_delay=2, fast_period=120,
+                 jitter=0.1, backoff=30, max_backoff=1800, watch_status=('STOPPED',)):
+        self.scheduler = scheduler
+        self.lister = lister or AsyncInstanceLister()
+        self.delay = delay
+        self.fast_delay = fast_delay
+        self.fast_period = fast_period
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.watch_status = watch_status
+        self.targets = {}
+        self.due = {}
+
+    @classmethod
+    def from_config(cls, scheduler, **kwargs):
+        return cls(
+            scheduler,
+            delay=int(config.watchdog_delay),
+            fast_delay=config.watchdog_fast_delay,
+            fast_period=config.watchdog_fast_period,
+            jitter=config.watchdog_jitter,
+            backoff=config.watchdog_backoff,
+            max_backoff=config.watchdog_max_backoff,
+            **kwargs
+        )
+
+    def add(self, data):
+        self.targets[data['id']] = TargetState(AsyncInstance(data['id'], instance_data=data))
+        # First check of a new folder is spread over the jitter window
+        self.due.setdefault(data['folderId'], time.monotonic() + random.uniform(0, self.delay * self.jitter))
+
+    def remove(self, data):
+        state = self.targets.pop(data['id'], None)
+        if state is None:
+            return
+
+        if state.starting:
+            state.task.cancel()
+
+        # A folder without targets is not polled anymore
+        folder_id = state.instance.folder_id
+        if not self.folder_targets(folder_id):
+            self.due.pop(folder_id, None)
+
+    def folder_targets(self, folder_id):
+        return [x for x in self.targets.values() if x.instance.folder_id == folder_id]
+
+    def interval(self, folder_id, now):
+        recent = any(
+            x.event_at is not None and now - x.event_at < self.fast_period
+            for x in self.folder_targets(folder_id)
+        )
+        interval = min(self.fast_delay, self.delay) if recent else self.delay
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    async def check_folder(self, folder_id):
+        # A failed folder is checked again later, the other folders go on
+        try:
+            instances = {x['id']: x async for x in self.lister.list_folder(folder_id)}
+
+            now = time.monotonic()
+            for state in self.folder_targets(folder_id):
+                data = instances.get(state.instance.instance_id)
+                # Status of an instance being started is kept from the start operation
+                if data is not None and not state.starting:
+                    state.instance.set_data(data)
+                    self.check(state, now)
+        except NETWORK_ERRORS as err:
+            logger.error(f'Failed to list instances of folder {folder_id}: {err!r}')
+        except Exception:
+            logger.exception(f'Failed to check instances of folder {folder_id}')
+
+        now = time.monotonic()
+        self.due[folder_id] = now + self.interval(folder_id, now)
+
+    def check(self, state, now):
+        vm = state.instance
+        status, previous = vm.status, state.last_status
+        state.last_status = status
+
+        if status not in self.watch_status:
+            if state.started_at is not None and now - state.started_at >= self.fast_period:
+                # Stayed up long enough, the start was a success
+                state.started_at = None
+                state.failures = 0
+            return
+
+        if previous not in self.watch_status:
+            # Preempted or stopped since the last check
+            state.event_at = now
+            WATCHDOG_PREEMPTIONS.inc(instance=vm.name)
+
+        if state.started_at is not None:
+            # Stopped again soon after our start
+            state.started_at = None
+            self.failed(state, now)
+
+        if now < state.blocked_until:
+            return
+
+        logger.info(f'Instance {vm.name} is {status}. Working..')
+        state.task = asyncio.ensure_future(self.start(state))
+
+    def failed(self, state, now):
+        state.failures += 1
+        pause = min(self.backoff * 2 ** (state.failures - 1), self.max_backoff)
+        state.blocked_until = now + pause
+        logger.warning(f'Instance {state.instance.name} failed to stay up after {state.failures} starts in a row, next start in {human_time(int(pause), 2)}')
+
+    async def running_start(self, state):
+        vm = state.instance
+        pending = await vm.pending_operations()
+        starts = [x for x in pending if is_start_operation(x)]
+
+        if starts:
+            logger.info(f'Instance {vm.name} is already being started, waiting for operation {starts[0]["id"]}')
+            return starts[0]['id']
+
+        if pending:
+            state.busy = True
+            logger.info(f'Instance {vm.name} has running operation {pending[0].get("description")}, start deferred')
+
+    async def submit_start(self, state):
+        vm = state.instance
+        state.busy = False
+        operation_id = await self.running_start(state)
+
+        if operation_id is None and not state.busy:
+            operation_id = await vm.start()
+            # Rejected with 409, an operation was started by someone else meanwhile
+            if operation_id is None:
+                operation_id = await self.running_start(state)
+
+        state.operation_id = operation_id
+        return operation_id
+
+    async def wait_start(self, state, operation_id):
+        vm = state.instance
+
+        try:
+            while True:
+                operation = await vm.operation_complete(operation_id)
+                if operation:
+                    return operation
+
+                # Timed out or failed, a running operation is waited for again
+                current = await vm.operation_status(operation_id)
+                if not current or current.get('done'):
+                    return
+
+                logger.warning(f'Start of instance {vm.name} is still running, operation {operation_id}')
+        finally:
+            state.operation_id = None
+
+    async def start(self, state):
+        operation = await self.scheduler.run('start', partial(self.submit_start, state), partial(self.wait_start, state))
+        now = time.monotonic()
+        state.event_at = now
+
+        if operation:
+            state.started_at = now
+            WATCHDOG_STARTS.inc(instance=state.instance.name, result='ok')
+        elif not state.busy:
+            WATCHDOG_STARTS.inc(instance=state.instance.name, result='failed')
+            self.failed(state, now)
+
+    async def tick(self):
+        now = time.monotonic()
+        folders = {x.instance.folder_id for x in self.targets.values()}
+        due = [x for x in folders if self.due.get(x, now) <= now]
+
+        if due:
+            results = await asyncio.gather(*[self.check_folder(x) for x in due], return_exceptions=True)
+            for folder_id, result in zip(due, results):
+                if isinstance(result, Exception):
+                    logger.error(f'Check of folder {folder_id} failed: {result!r}')
+                    self.due[folder_id] = now + self.delay
+
+        # Sleep until the next folder is due, targets added meanwhile wait at most delay
+        next_at = min([self.due[x] for x in folders if x in self.due] + [time.monotonic() + self.delay])
+        return max(next_at - time.monotonic(), 0)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(await self.tick())
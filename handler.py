@@ -0,0 +1,173 @@
+'''
+Serverless entry point of the snapshotter (Yandex Cloud Functions),
+set the function entry point to handler.handler.
+
+Configuration comes from env: TOKEN, INSTANCES (comma separated config
+entries), FOLDERS, LIFETIME, RETENTION ("daily=7,weekly=4"), MODE
+(create, delete or full, full by default) and the other variables of
+the serverless branch of common/config.py. The invocation event can
+override them for one run: a timer trigger payload, an HTTP body or the
+event itself is a JSON object with optional keys mode, instances,
+folders, lifetime, all_disks, retention and async. Invalid options are
+answered with status 400.
+
+Importing the module does nothing: the tools are imported and the
+config is read on the first invocation. The IAM token, HTTP sessions
+and the event loop are kept in the process, so warm invocations skip
+the token exchange and TLS handshakes.
+'''
+
+import os
+import json
+import base64
+import asyncio
+import logging
+
+os.environ.setdefault('SERVERLESS', '1')
+
+MODES = ('create', 'delete', 'full')
+# Event keys -> Config attributes
+OPTIONS = {
+    'instances': 'instances_list',
+    'folders': 'folders_list',
+    'lifetime': 'lifetime',
+    'all_disks': 'all_disks',
+    'retention': 'retention'
+}
+
+logger = logging.getLogger(__name__)
+
+_loop = None
+_defaults = None
+
+
+def event_options(event):
+    '''Return run options from a timer trigger payload, HTTP body or the event itself.'''
+    if not isinstance(event, dict):
+        return {}
+
+    messages = event.get('messages')
+    if messages:
+        payload = (messages[0].get('details') or {}).get('payload')
+    elif 'body' in event:
+        payload = event['body']
+        if payload and event.get('isBase64Encoded'):
+            payload = base64.b64decode(payload).decode()
+    else:
+        return {key: value for key, value in event.items() if key in OPTIONS or key in ('mode', 'async')}
+
+    try:
+        options = json.loads(payload) if payload else {}
+    except ValueError:
+        logger.warning(f'Event payload is not JSON, ignored: {payload[:100]}')
+        return {}
+
+    return options if isinstance(options, dict) else {}
+
+
+def as_list(value):
+    '''Return list from "a,b" string or list of strings, raise ValueError otherwise.'''
+    if isinstance(value, str):
+        return [x for x in value.split(',') if x]
+    if not isinstance(value, list) or not all(isinstance(x, str) for x in value):
+        raise ValueError(f'Expected a comma separated string or a list of strings, got {value!r}')
+
+    return value
+
+
+def as_lifetime(value):
+    '''Return lifetime in days from an integer or a string of digits, raise ValueError otherwise.'''
+    # bool is an int too, "lifetime": true is a mistake
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+
+    raise ValueError(f'Lifetime must be a number of days, got {value!r}')
+
+
+def as_bool(value):
+    # Values from an HTTP body or env may be strings, "false" and "0" are false
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'yes', 'true', 'on')
+
+    return bool(value)
+
+
+def as_retention(value):
+    '''Return retention policy dict, raise ValueError for unknown keys and non-integer counts.'''
+    from common.config import RETENTION_KEYS
+
+    if isinstance(value, str):
+        value = {key.strip(): count for key, _, count in (item.partition('=') for item in value.split(',') if item)}
+    if not isinstance(value, dict):
+        raise ValueError('Retention must be an object or "daily=7,weekly=4" string')
+
+    unknown = set(value) - set(RETENTION_KEYS)
+    if unknown:
+        raise ValueError(f'Unknown retention keys {", ".join(sorted(map(str, unknown)))}, use {", ".join(RETENTION_KEYS)}')
+
+    try:
+        return {key: int(count) for key, count in value.items()}
+    except (TypeError, ValueError):
+        raise ValueError(f'Retention counts must be integers: {value}') from None
+
+
+def configure(config, options):
+    '''
+    Reset config to env values and apply options of the invocation,
+    raise ValueError for invalid options.
+    '''
+    global _defaults
+
+    if _defaults is None:
+        _defaults = {x: getattr(config, x) for x in OPTIONS.values()}
+
+    for attribute, value in _defaults.items():
+        setattr(config, attribute, value)
+
+    for key, attribute in OPTIONS.items():
+        value = options.get(key)
+        if value is None:
+            continue
+
+        if key in ('instances', 'folders'):
+            try:
+                value = as_list(value)
+            except ValueError as err:
+                raise ValueError(f'Invalid {key}: {err}') from None
+        elif key == 'lifetime':
+            value = as_lifetime(value)
+        elif key == 'all_disks':
+            value = as_bool(value)
+        elif key == 'retention':
+            value = {None: as_retention(value)}
+        setattr(config, attribute, value)
+
+
+def handler(event, context):
+    global _loop
+
+    if _loop is None:
+        logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
+        logging.getLogger().setLevel(logging.INFO)
+        # One loop for all invocations, the aiohttp session is bound to it
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+
+    # Imported on the first invocation, later invocations reuse the modules
+    import snaps
+    from common.config import Config as config
+
+    options = event_options(event)
+    try:
+        configure(config, options)
+    except ValueError as err:
+        return {'statusCode': 400, 'body': json.dumps({'error': str(err)})}
+
+    mode = options.get('mode') or os.getenv('MODE', 'full')
+    if mode not in MODES:
+        return {'statusCode': 400, 'body': json.dumps({'error': f'Unknown mode {mode}, use one of {", ".join(MODES)}'})}
+
+    summary = snaps.run(mode, run_async=as_bool(options.get('async', True)), keep_alive=True)
+    return {'statusCode': 200, 'body': json.dumps(summary)}
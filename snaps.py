@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 
 import os
+import time
+import signal
 import asyncio
 import argparse
 import logging
+import contextlib
 
 from datetime import datetime
+from collections import deque
+from functools import partial
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
-LOGDIR = os.path.join(BASEDIR, 'logs')
-STOPPED_INSTANCES = []
+# LOG_DIR env moves the logs out of the tree, e.g. for benchmarks
+LOGDIR = os.getenv('LOG_DIR') or os.path.join(BASEDIR, 'logs')
+# Instance name -> seconds between stop request and completed start
+DOWNTIME = {}
 
 '''Preparing'''
 
@@ -18,189 +25,685 @@ parser.add_argument('-v', '--version', action='version',  version='yc-snaps 0.4.
 parser.add_argument('-c', '--create', action='store_true', required=False, help='create snapshots for VMs')
 parser.add_argument('-d', '--delete', action='store_true', required=False, help='delete all old snapshots for instances')
 parser.add_argument('-f', '--full', action='store_true', required=False, help='create snapshots and delete old snapshots for instances')
-parser.add_argument('--run-async', '--async', action='store_true', required=False, help='use this arg only if disks count <= 15 (active-operations-count limit)')
-args = parser.parse_args()
+parser.add_argument('--all-disks', action='store_true', required=False, help='snapshot secondary disks too (same as all_disks = yes in [Snapshots])')
+parser.add_argument('--dry-run', action='store_true', required=False, help='print the retention plan: snapshots to keep and to delete, nothing is changed')
+parser.add_argument('--resume', action='store_true', required=False, help='continue the last interrupted run from the journal, the run mode is taken from the journal unless given')
+parser.add_argument('--run-async', '--async', action='store_true', required=False, help='process instances concurrently, operations in flight are limited by [Quota] config section')
+parser.add_argument('--daemon', action='store_true', required=False, help='keep running and snapshot instances on the cron schedules of [Schedule] config sections')
+parser.add_argument('--trace', metavar='FILE', required=False, help='write timeline of the run to FILE (Chrome trace format, open in ui.perfetto.dev) and log slowest instances, overrides [Trace] file')
 
-if not any(vars(args).values()):
-    print('Input Error. Use --help for more details.')
-    quit()
 
-if not os.path.exists(LOGDIR):
-    os.mkdir(LOGDIR)
+def setup_logging():
+    if not os.path.exists(LOGDIR):
+        os.mkdir(LOGDIR)
 
-logging.basicConfig(level=logging.INFO,
-    format='[%(asctime)s] [%(levelname)s] %(message)s',
-    datefmt='%d/%b/%y %H:%M:%S', 
-    handlers=[
-        logging.FileHandler(os.path.join(LOGDIR, 'snaps.log')),
-        logging.StreamHandler()
-    ]
-)
+    logging.basicConfig(level=logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] %(message)s',
+        datefmt='%d/%b/%y %H:%M:%S', 
+        handlers=[
+            logging.FileHandler(os.path.join(LOGDIR, 'snaps.log')),
+            logging.StreamHandler()
+        ]
+    )
+
+
+# Importing the module does no work, so it can be used by the serverless handler
+if __name__ == '__main__':
+    setup_logging()
 
 logger = logging.getLogger(__name__)
 
 from common.compute import Instance, NEGATIVE_STATES, POSITIVE_STATES
-from common.config import Config as config
+from common.async_compute import AsyncInstance
+from common.session import get_client, get_async_client
+from common.scheduler import OperationScheduler
+from common.snapshots import SnapshotIndex
+from common.discovery import TargetSet, resolve_instances
+from common.journal import RunJournal, RunLock, JOURNAL_FILE, LOCK_FILE
+from common.cron import Schedules
+from common.planner import RunPlanner
+from common.retention import RetentionPolicies
+from common.bulk import delete_snapshots, async_delete_snapshots
+from common.metrics import REGISTRY, DOWNTIME as DOWNTIME_GAUGE, RUN_DURATION, RUN_TIMESTAMP
+from common.config import Config as config, SERVERLESS
 from common.decorators import human_time
-
-logger.info(f'Snapshot lifetime is {config.lifetime} days')
-
-# Instances generator from config
-try:
-    INSTANCES = [inst for inst in config.instances_list if inst != '']
-except Exception as err:
-    logger.error(err)
-
-if not INSTANCES:
-    msg = 'Instances ID is empty. Please type instance_id into config file. If you have multiple VMs, separate them with a space'
-    logger.warning(msg)
-    quit()
-
-# Delete non-existent instances
-for instance_id in INSTANCES:
-    if Instance(instance_id).name is None:
-        INSTANCES.remove(instance_id)
+from common.exceptions import RetryableError
+from common.trace import TRACER
+
+# State of a run, created by setup()
+SCHEDULER = None
+RETENTION = None
+SNAPSHOT_INDEX = None
+JOURNAL = None
+INSTANCES = []
+# Instance ID -> rank in the run plan, operations of lower ranks get free slots first
+RANKS = {}
+# The aiohttp session is kept open after a run by warm serverless invocations
+KEEP_ALIVE = False
+
+
+def setup(all_disks=None, targets=None, snapshot_index=None):
+    '''
+    Create the state of a run and resolve instances from config, return
+    them. targets are instance dicts already resolved by the daemon, the
+    daemon's snapshot_index is kept between runs.
+    '''
+    global SCHEDULER, RETENTION, SNAPSHOT_INDEX, JOURNAL, INSTANCES, RANKS
+
+    logger.info(f'Snapshot lifetime is {config.lifetime} days')
+    SCHEDULER = OperationScheduler.from_config()
+    RETENTION = RetentionPolicies.from_config()
+    # Every folder is listed once per run and shared by all instances
+    SNAPSHOT_INDEX = SnapshotIndex() if snapshot_index is None else snapshot_index
+    # Operations of the run are journaled, so an interrupted run can be resumed
+    JOURNAL = RunJournal(JOURNAL_FILE if config.journal else None)
+    DOWNTIME.clear()
+    RANKS = {}
+
+    if targets is not None:
+        INSTANCES = [
+            Instance(data['id'], instance_data=data, snapshot_index=SNAPSHOT_INDEX, all_disks=all_disks, journal=JOURNAL)
+            for data in targets
+        ]
+        return INSTANCES
+
+    refs = [inst for inst in config.instances_list if inst != '']
+    if not refs:
+        msg = 'Instances ID is empty. Please type instance_id into config file. If you have multiple VMs, separate them with a space'
+        logger.warning(msg)
+        INSTANCES = []
+        return INSTANCES
+
+    # Resolve IDs, names and labels with one listing per folder, non-existent instances are skipped
+    INSTANCES = resolve_instances(refs, snapshot_index=SNAPSHOT_INDEX, all_disks=all_disks, journal=JOURNAL)
+    return INSTANCES
 
 
 '''Functions'''
 
 def delta_time(start, end):
     et = int((end - start).total_seconds())
-    m_et = human_time(et, 2)
+    m_et = human_time(et, 2) or '0 seconds'
     logger.info(f'Elapsed time: {m_et}')
 
 
-def snapshots_cleaner():
-    logger.info(f'Search and deleting snapshots older than {config.lifetime} days')
-    for instance in INSTANCES:
-        vm = Instance(instance)
-        snapshots = vm.get_old_snapshots()
+def log_downtime(vm, stopped):
+    DOWNTIME[vm.name] = time.monotonic() - stopped
+    DOWNTIME_GAUGE.set(DOWNTIME[vm.name], instance=vm.name)
+    logger.info(f'Instance {vm.name} is {vm.status}, downtime {human_time(int(DOWNTIME[vm.name]), 2) or "0 seconds"}')
 
-        if not snapshots:
-            logger.info(f'Snapshots older than {config.lifetime} days not found for instance {vm.name}')
-            continue
 
-        for snapshot in snapshots:
-            delete_snap = vm.delete_snapshot(data=snapshot)
-            if vm.operation_complete(delete_snap):
-                continue
+def downtime_report():
+    if not DOWNTIME:
+        return
 
+    logger.info('Downtime per instance:')
+    for name, seconds in sorted(DOWNTIME.items(), key=lambda x: x[1], reverse=True):
+        logger.info(f'  {name}: {human_time(int(seconds), 2) or "0 seconds"}')
 
-async def async_snapshots_cleaner(instance):
-    vm = Instance(instance)
-    logger.info(f'Search and deleting snapshots older than {config.lifetime} days for instance {vm.name}')
-    snapshots = vm.get_old_snapshots()
+    total = sum(DOWNTIME.values())
+    logger.info(f'Max downtime {human_time(int(max(DOWNTIME.values())), 2) or "0 seconds"}, '
+                f'average {human_time(int(total / len(DOWNTIME)), 2) or "0 seconds"}')
 
-    if not snapshots:
-        logger.info(f'Snapshots older than {config.lifetime} days not found for instance {vm.name}')
+
+def write_metrics(mode, started):
+    if not config.metrics_textfile:
         return
 
-    for snapshot in snapshots:
-        await vm.async_operation_complete(vm.delete_snapshot(data=snapshot))
+    RUN_DURATION.set((datetime.now() - started).total_seconds(), mode=mode)
+    RUN_TIMESTAMP.set(time.time(), mode=mode)
+
+    try:
+        REGISTRY.write(config.metrics_textfile)
+    except OSError as err:
+        logger.error(f'Failed to write metrics to {config.metrics_textfile}: {err}')
+
+
+@contextlib.contextmanager
+def tracing(path, started):
+    '''Trace the run when path is set, then write the trace and log slowest instances.'''
+    if not path:
+        yield
+        return
+
+    TRACER.start()
+    try:
+        yield
+    finally:
+        TRACER.stop()
+        # Skipped runs leave nothing to write
+        if TRACER.recorded:
+            try:
+                TRACER.export(started.strftime(path))
+            except OSError as err:
+                logger.error(f'Failed to write trace to {path}: {err}')
+            TRACER.log_summary(config.trace_top)
+
+
+def found_snapshots(vm, snapshots):
+    if not snapshots:
+        logger.info(f'Snapshots to delete not found for instance {vm.name}')
+    else:
+        logger.info(f'Found {len(snapshots)} snapshots to delete for instance {vm.name}')
+
+    return [(vm, snapshot) for snapshot in snapshots]
+
+
+def cleaned(instances, stats):
+    failed = stats.failed_instances()
+    for vm in instances:
+        if vm.instance_id not in failed:
+            JOURNAL.instance_done(vm.instance_id, 'delete')
+
+
+def snapshots_cleaner():
+    logger.info('Search and deleting snapshots not kept by retention policy')
+    instances = []
+    items = []
+
+    for vm in INSTANCES:
+        if JOURNAL.done(vm.instance_id, 'delete'):
+            logger.info(f'Old snapshots already deleted for instance {vm.name}')
+            continue
+
+        instances.append(vm)
+        with TRACER.track(vm.name), TRACER.span('search', 'search'):
+            items += found_snapshots(vm, list(vm.get_old_snapshots(policy=RETENTION.get(vm.instance_data))))
+
+    # Deletes of all instances are sent together, limit-sized batches
+    stats = delete_snapshots(items, SCHEDULER.limit('delete'))
+    cleaned(instances, stats)
+    return stats
+
+
+async def async_old_snapshots(instance):
+    vm = AsyncInstance.from_instance(instance)
+    if JOURNAL.done(vm.instance_id, 'delete'):
+        logger.info(f'Old snapshots already deleted for instance {vm.name}')
+        return vm, []
+
+    logger.info(f'Search snapshots to delete for instance {vm.name}, retention: {RETENTION.get(vm.instance_data)}')
+    with TRACER.track(vm.name), TRACER.span('search', 'search'):
+        snapshots = [x async for x in vm.get_old_snapshots(policy=RETENTION.get(vm.instance_data))]
+    return vm, found_snapshots(vm, snapshots)
+
+
+async def async_snapshots_cleaner():
+    found = await asyncio.gather(*[async_old_snapshots(instance) for instance in INSTANCES])
+    instances = [vm for vm, _ in found if not JOURNAL.done(vm.instance_id, 'delete')]
+    items = [x for _, vm_items in found for x in vm_items]
+
+    # Deletes of all instances share the scheduler slots
+    stats = await async_delete_snapshots(items, SCHEDULER)
+    cleaned(instances, stats)
+    return stats
+
+
+def pending_disks(vm):
+    # Disks snapshotted by the resumed run are skipped
+    return [disk for disk in vm.snapshot_disks if not JOURNAL.snapshotted(vm.instance_id, disk)]
+
+
+def stopped_by_run(vm):
+    # Instance stopped by the resumed run, it's started after the snapshots
+    return JOURNAL.stopped(vm.instance_id) and vm.status == 'STOPPED'
+
+
+def stop_time(vm):
+    # Monotonic time of the stop, taken from the journal if the interrupted run stopped the instance
+    stopped_at = JOURNAL.stopped_at(vm.instance_id) if stopped_by_run(vm) else None
+    if stopped_at is None:
+        return time.monotonic()
+
+    return time.monotonic() - max((datetime.utcnow() - stopped_at).total_seconds(), 0)
+
+
+def requeue(kind, attempt, hint):
+    # Pause before a request rejected with 429 or 5xx is sent again, False when out of attempts
+    if attempt >= SCHEDULER.max_requeue:
+        logger.error(f'{kind.capitalize()} operation was rejected {attempt + 1} times, giving up')
+        return False
+
+    pause = SCHEDULER.pause(attempt, hint)
+    logger.info(f'Requeue {kind} operation in {pause:.1f} seconds')
+    TRACER.instant('retry', 'retry', kind=kind)
+    with TRACER.span(f'{kind} requeue', 'sleep'):
+        time.sleep(pause)
+    return True
+
+
+def submit(kind, request):
+    '''Send operation request of the sync run, requeue it when rejected, return operation id.'''
+    attempt = 0
+    while True:
+        try:
+            return request()
+        except RetryableError as err:
+            logger.warning(f'{kind.capitalize()} operation rejected: {err}')
+            if not requeue(kind, attempt, err.retry_after):
+                return
+            attempt += 1
+
+
+def create_snapshots(vm):
+    # Disks of the instance are snapshotted together, bounded by the operations quota.
+    # Disks rejected with 429 or 5xx go to the next batch, sent once the current one is done
+    queue = deque(pending_disks(vm))
+    attempt = 0
+    hint = None
+
+    with TRACER.span('snapshot', 'snapshot', disks=len(queue)):
+        while queue:
+            operations = []
+            while queue and len(operations) < config.max_operations:
+                try:
+                    operation_id = vm.create_snapshot(disk_id=queue[0])
+                except RetryableError as err:
+                    logger.warning(f'Snapshot operation rejected: {err}')
+                    hint = err.retry_after
+                    # Quota is exhausted, the rest waits for the next batch
+                    break
+
+                queue.popleft()
+                if operation_id:
+                    operations.append(operation_id)
+
+            if operations:
+                vm.operations_complete(operations)
+                attempt = 0
+            elif queue:
+                if not requeue('snapshot', attempt, hint):
+                    break
+                attempt += 1
+
+    return not pending_disks(vm)
+
+
+def snapshot_instance(vm):
+    # Stop -> snapshots -> start of one instance, return True if all its disks are snapshotted
+    done = False
+    if stopped_by_run(vm) or vm.status not in NEGATIVE_STATES:
+        stopped = stop_time(vm)
+        try:
+            with TRACER.span('stop', 'stop'):
+                ready = stopped_by_run(vm) or vm.operation_complete(submit('stop', vm.stop))
+            if ready:
+                done = create_snapshots(vm)
+        finally:
+            # Start the instance even if the snapshot failed
+            if vm.status not in POSITIVE_STATES:
+                with TRACER.span('start', 'start'):
+                    vm.operation_complete(submit('start', vm.start))
+            log_downtime(vm, stopped)
+
+    else:
+        logger.info(f'Instance {vm.name} already stopped.')
+        done = create_snapshots(vm)
+
+    return done
 
 
 def snapshots_creater():
     logger.info('Preparing instances to create a snapshot')
-    for instance in INSTANCES:
-        vm = Instance(instance)
-
-        if vm.get_data():
-            if vm.status not in NEGATIVE_STATES:
-                stop_vm = vm.stop()
-                if vm.operation_complete(stop_vm):
-                    snap_create = vm.create_snapshot()
-                if vm.operation_complete(snap_create):
-                    if vm.status not in POSITIVE_STATES:
-                        start_vm = vm.start()
-                        if vm.operation_complete(start_vm):
-                            continue
+    for vm in INSTANCES:
+        if JOURNAL.done(vm.instance_id, 'create'):
+            logger.info(f'Snapshots already created for instance {vm.name}')
+            continue
+
+        if vm.instance_data:
+            # A failed instance doesn't keep the next ones from being snapshotted
+            try:
+                with TRACER.track(vm.name):
+                    done = snapshot_instance(vm)
+            except Exception:
+                logger.exception(f'Snapshots of instance {vm.name} failed')
+                continue
+
+            if done:
+                JOURNAL.instance_done(vm.instance_id, 'create')
 
-            else:
-                logger.info(f'Instance {vm.name} already stopped.')
-                create_snap = vm.create_snapshot()
-                if vm.operation_complete(create_snap):
-                    continue
+
+async def async_create_snapshot(vm, disk):
+    # Disks are snapshotted concurrently, each on its own lane of the trace
+    with TRACER.track(vm.name, disk), TRACER.span('snapshot', 'snapshot', disk=disk):
+        await SCHEDULER.run('snapshot', partial(vm.create_snapshot, disk_id=disk), vm.operation_complete, RANKS.get(vm.instance_id, 0))
+
+
+async def async_create_snapshots(vm):
+    # Every disk is done or failed before the instance is started
+    disks = pending_disks(vm)
+    results = await asyncio.gather(*[async_create_snapshot(vm, disk) for disk in disks], return_exceptions=True)
+    for disk, result in zip(disks, results):
+        if isinstance(result, Exception):
+            logger.error(f'Snapshot of disk {disk} on {vm.name} failed: {result!r}')
+
+    return not pending_disks(vm)
 
 
 async def async_snapshots_creater(instance):
-    vm = Instance(instance)
+    # Every instance goes stop -> snapshot -> start on its own,
+    # so it's started as soon as its own snapshots are done
+    vm = AsyncInstance.from_instance(instance)
+    if JOURNAL.done(vm.instance_id, 'create'):
+        logger.info(f'Snapshots already created for instance {vm.name}')
+        return
+
     logger.info(f'Preparing instance {vm.name} to create a snapshot')
-    if vm.get_data():
-        if vm.status not in NEGATIVE_STATES:
-            stop_vm = vm.operation_complete(vm.stop())
-            STOPPED_INSTANCES.append(instance)
-            if stop_vm:
-                await vm.async_operation_complete(vm.create_snapshot())
+    if vm.instance_data:
+        with TRACER.track(vm.name):
+            done = False
+            if stopped_by_run(vm) or vm.status not in NEGATIVE_STATES:
+                stopped = stop_time(vm)
+                try:
+                    with TRACER.span('stop', 'stop'):
+                        ready = stopped_by_run(vm) or await SCHEDULER.run('stop', vm.stop, vm.operation_complete, RANKS.get(vm.instance_id, 0))
+                    if ready:
+                        done = await async_create_snapshots(vm)
+                finally:
+                    # Start the instance even if the snapshot failed
+                    await instance_run(vm)
+                    log_downtime(vm, stopped)
 
-        else:
-            logger.info(f'Instance {vm.name} already stopped.')
-            await vm.async_operation_complete(vm.create_snapshot())
+            else:
+                logger.info(f'Instance {vm.name} already stopped.')
+                done = await async_create_snapshots(vm)
+
+        if done:
+            JOURNAL.instance_done(vm.instance_id, 'create')
 
 
-async def instance_run(instance):
-    vm = Instance(instance)
+async def instance_run(vm):
     if vm.status not in POSITIVE_STATES:
-        await vm.async_operation_complete(vm.start())
+        with TRACER.span('start', 'start'):
+            await SCHEDULER.run('start', vm.start, vm.operation_complete, RANKS.get(vm.instance_id, 0))
 
 
-def run_stopped_instances():
-    if not STOPPED_INSTANCES:
-        return
+def run_async(tasks, return_exceptions=False):
+    async def runner():
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+        finally:
+            if not KEEP_ALIVE:
+                await get_async_client().close()
 
-    vm_start_task = [instance_run(instance) for instance in STOPPED_INSTANCES if STOPPED_INSTANCES]
-    vm_loop = asyncio.get_event_loop()
-    vm_loop.run_until_complete(asyncio.wait(vm_start_task))
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(runner())
 
 
 def async_creater_run():
-    snapshot_tasks = [async_snapshots_creater(instance) for instance in INSTANCES]
-    create_snap_loop = asyncio.get_event_loop()
-    create_snap_loop.run_until_complete(asyncio.wait(snapshot_tasks))
-
-    run_stopped_instances()
+    # A failed instance doesn't cancel the pipelines of the others
+    results = run_async([async_snapshots_creater(instance) for instance in INSTANCES], return_exceptions=True)
+    for instance, result in zip(INSTANCES, results):
+        if isinstance(result, Exception):
+            logger.error(f'Snapshots of instance {instance.name} failed', exc_info=result)
     instance_status()
 
 
 def async_cleaner_run():
-    tasks = [async_snapshots_cleaner(instance) for instance in INSTANCES]
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.wait(tasks))
+    return run_async([async_snapshots_cleaner()])[0]
+
+
+def retention_plan():
+    logger.info('Retention plan (dry run), nothing is deleted')
+    total = 0
+
+    for vm in INSTANCES:
+        policy = RETENTION.get(vm.instance_data)
+        SNAPSHOT_INDEX.ensure(vm.folder_id, vm.iter_folder_snapshots)
+        logger.info(f'Instance {vm.name}, retention: {policy}')
+
+        for disk_id in vm.snapshot_disks:
+            plan = list(policy.plan(SNAPSHOT_INDEX.entries(vm.folder_id, disk_id)))
+            delete = [x for x in plan if not x[2]]
+            total += len(delete)
+            logger.info(f'  Disk {disk_id}: keep {len(plan) - len(delete)}, delete {len(delete)}')
+
+            for created_at, snapshot, reasons in plan:
+                action = f'keep ({", ".join(reasons)})' if reasons else 'delete'
+                logger.info(f'    {created_at:%Y-%m-%d %H:%M} {snapshot.get("name")} -> {action}')
+
+    logger.info(f'Snapshots to delete: {total}')
+
+
+def estimated(seconds):
+    return human_time(int(seconds), 2) or '0 seconds'
+
+
+def plan_jobs():
+    '''Order instances of an async create longest job first, by disk sizes.'''
+    global INSTANCES, RANKS
+
+    jobs, makespan, given = RunPlanner.from_config().plan(INSTANCES)
+    INSTANCES = [job.vm for job in jobs] + [vm for vm in INSTANCES if not vm.instance_data]
+    RANKS = {job.vm.instance_id: rank for rank, job in enumerate(jobs)}
+    logger.info(f'Snapshot jobs ordered longest first, estimated run time {estimated(makespan)} '
+                f'(in config order {estimated(given)})')
+
+
+def run_plan():
+    planner = RunPlanner.from_config()
+    jobs, makespan, given = planner.plan(INSTANCES)
+
+    if config.plan_order:
+        logger.info('Run plan (dry run), jobs longest first, times from the run start:')
+        order = f'{estimated(given)} in config order'
+    else:
+        ranks = {vm.instance_id: rank for rank, vm in enumerate(INSTANCES)}
+        jobs.sort(key=lambda x: ranks[x.vm.instance_id])
+        makespan = planner.simulate(jobs)
+        logger.info('Run plan (dry run), jobs in config order, times from the run start:')
+        order = 'order = no in [Planner]'
+
+    for job in jobs:
+        disks = ', '.join(
+            f'{disk["id"]} {int(disk.get("size") or 0) / 2 ** 30:.0f} GiB {disk.get("typeId", "")}'.rstrip()
+            for disk, _ in job.snapshots
+        )
+        downtime = f', downtime {estimated(job.end - job.begin)}' if job.stop_time else ''
+        logger.info(f'  {job.vm.name}: {estimated(job.begin)} -> {estimated(job.end)}{downtime}; {disks}')
+
+    logger.info(f'Estimated run time: {estimated(makespan)} with --async ({order}), '
+                f'{estimated(planner.sequential(jobs))} sequential')
+
+
+def reattach():
+    # Wait for operations that were in flight when the previous run was interrupted
+    pending = JOURNAL.pending()
+
+    for vm in INSTANCES:
+        operations = pending.pop(vm.instance_id, None)
+        if operations:
+            logger.info(f'Waiting for {len(operations)} operations of instance {vm.name} from the interrupted run')
+            vm.operations_complete(operations)
+
+    for instance_id in pending:
+        logger.warning(f'Instance {instance_id} from the interrupted run is not in config, skipped')
 
 
 def instance_status():
+    downtime_report()
     logger.info('Getting instances status')
-    for instance in INSTANCES:
-        vm = Instance(instance)
-        if vm.name is not None:
+    instances = [vm.instance_id for vm in INSTANCES]
+    folders = {vm.folder_id for vm in INSTANCES}
+
+    with TRACER.span('status', 'run'):
+        for vm in resolve_instances(instances, folders=folders):
             logger.info(vm)
 
 
-if __name__ == '__main__':
+def run(mode=None, run_async=False, resume=False, dry_run=False, all_disks=None, keep_alive=False,
+        targets=None, snapshot_index=None, trace=None):
+    '''
+    Run snapshotter in mode create, delete or full. Return summary dict,
+    or None when nothing was run. trace is the trace file, [Trace] file
+    by default.
+    '''
+    global KEEP_ALIVE
+    KEEP_ALIVE = keep_alive
     started = datetime.now()
 
-    if args.create:
-        if args.run_async:
-            async_creater_run()
-        else:
-            snapshots_creater()
-            instance_status()
-
-    elif args.delete:
-        if args.run_async:
-            async_cleaner_run()
-        else:
-            snapshots_cleaner()
-
-    elif args.full:
-        if args.run_async:
-            async_cleaner_run()
-            async_creater_run()
-        else:
-            snapshots_cleaner()
-            snapshots_creater()
-            instance_status()
+    if dry_run:
+        if setup(all_disks, targets, snapshot_index):
+            retention_plan()
+            run_plan()
+        return
 
-    else:
+    # Runs of the daemon, cron and by hand never overlap
+    with RunLock(None if SERVERLESS else LOCK_FILE) as locked, tracing(trace or config.trace_file, started):
+        if not locked:
+            logger.warning('Another snapshotter run is in progress, the run is skipped')
+            return
+
+        with TRACER.span('setup', 'run'):
+            if not setup(all_disks, targets, snapshot_index):
+                return
+
+        resumed = JOURNAL.resume() if resume else None
+
+        if resumed:
+            mode = mode or resumed
+            reattach()
+        elif resume:
+            logger.info('No interrupted run found in the journal')
+
+        if mode is None:
+            logger.error('Run mode is not set: create, delete or full')
+            return
+
+        if not resumed:
+            JOURNAL.begin(mode)
+
+        summary = {'mode': mode, 'instances': len(INSTANCES)}
+
+        if mode in ('delete', 'full'):
+            with TRACER.span('delete', 'run'):
+                stats = async_cleaner_run() if run_async else snapshots_cleaner()
+            summary.update(deleted=stats.deleted, delete_failed=len(stats.failed))
+
+        if mode in ('create', 'full'):
+            with TRACER.span('create', 'run'):
+                if run_async:
+                    if config.plan_order:
+                        with TRACER.span('plan', 'run'):
+                            plan_jobs()
+                    async_creater_run()
+                else:
+                    snapshots_creater()
+                    instance_status()
+            summary['downtime'] = {name: round(seconds, 1) for name, seconds in DOWNTIME.items()}
+
+        JOURNAL.end()
+
+    write_metrics(mode, started)
+    delta_time(started, datetime.now())
+    summary['elapsed'] = round((datetime.now() - started).total_seconds(), 1)
+    return summary
+
+
+def next_run(group, after):
+    # Fires missed while a run was busy are coalesced into one run
+    scheduled = group.cron.next_after(after)
+    now = datetime.now()
+    if scheduled < now:
+        logger.warning(f'Schedule {group.name} missed runs while busy, next run at {group.cron.next_after(now):%Y-%m-%d %H:%M}')
+        return group.cron.next_after(now)
+
+    return scheduled
+
+
+def daemon(run_async=False, all_disks=None):
+    '''
+    Run groups of instances in their modes on their cron schedules until
+    interrupted. The process keeps the IAM token, HTTP sessions and the
+    snapshot index between runs, and instances are resolved once: a run
+    lists again only the folders of its group to get current statuses.
+    Runs are sequential, a group due while another one runs starts after it.
+    '''
+    try:
+        schedules = Schedules.from_config()
+    except ValueError as err:
+        logger.error(f'Invalid schedule: {err}')
+        return
+
+    if not schedules.all:
+        logger.error('No schedules found, add cron to [Schedule] or [Schedule <instances>] config sections')
+        return
+
+    targets = TargetSet(config.instances_list, folders=config.folders_list)
+    if not targets.resolve():
+        logger.warning('No instances found in config, nothing to schedule')
+        return
+
+    # Snapshots created and deleted by the runs are kept in the index, folders are listed again after index_ttl
+    index = SnapshotIndex(max_age=config.index_ttl)
+    now = datetime.now()
+    due = {group.name: group.cron.next_after(now) for group in schedules.all}
+
+    for group in schedules.all:
+        count = sum(schedules.get(x) is group for x in targets.targets)
+        logger.info(f'Schedule {group}: {count} instances, next run at {due[group.name]:%Y-%m-%d %H:%M}')
+
+    while True:
+        group = min(schedules.all, key=lambda x: due[x.name])
+        wait = (due[group.name] - datetime.now()).total_seconds()
+        if wait > 0:
+            time.sleep(wait)
+
+        # A failed run is logged, the daemon goes on to the next due run
+        try:
+            folders = {x['folderId'] for x in targets.targets if schedules.get(x) is group}
+            targets.refresh(force=True, folders=folders)
+            members = [x for x in targets.targets if schedules.get(x) is group]
+
+            if members:
+                logger.info(f'Scheduled run of {group}, {len(members)} instances')
+                run(group.mode, run_async=run_async, all_disks=all_disks, keep_alive=True,
+                    targets=members, snapshot_index=index)
+            else:
+                logger.info(f'No instances in schedule {group.name}, run skipped')
+        except Exception:
+            logger.exception(f'Scheduled run of {group.name} failed')
+
+        due[group.name] = next_run(group, due[group.name])
+        logger.info(f'Next run of schedule {group.name} at {due[group.name]:%Y-%m-%d %H:%M}')
+
+
+def terminate(signum, frame):
+    raise KeyboardInterrupt
+
+
+def close_clients():
+    # HTTP sessions kept alive between daemon runs
+    asyncio.get_event_loop().run_until_complete(get_async_client().close())
+    get_client().close()
+
+
+def main():
+    args = parser.parse_args()
+
+    if not any(vars(args).values()):
+        print('Input Error. Use --help for more details.')
+        quit()
+
+    if args.daemon:
+        # systemd stops the service with SIGTERM
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            daemon(run_async=args.run_async, all_disks=args.all_disks or None)
+        except KeyboardInterrupt:
+            logger.info('Daemon stopped')
+        finally:
+            close_clients()
+        return
+
+    mode = 'full' if args.full else 'create' if args.create else 'delete' if args.delete else None
+    if mode is None and not (args.resume or args.dry_run):
         print('Input Error. Use --help for more details.')
+        quit()
 
-    delta_time(started, datetime.now())
+    run(mode, run_async=args.run_async, resume=args.resume, dry_run=args.dry_run, all_disks=args.all_disks or None,
+        trace=args.trace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import asyncio
+import tempfile
+
+import pytest
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOME = tempfile.mkdtemp(prefix='yc-tests-')
+
+sys.path.insert(0, BASEDIR)
+
+from bench.run import FakeCloudProcess
+
+# 4 instances with 2 expired snapshots per disk, at most 3 operations in flight
+CLOUD = FakeCloudProcess(4, op_latency=0.2, quota=3)
+
+# Config is read from env once common.config is imported, nothing is read from ~/.ya-tools
+os.environ.update(
+    SERVERLESS='1', HOME=HOME, LOG_DIR=os.path.join(HOME, 'logs'), TOKEN='test',
+    INSTANCES='folder:f0', LIFETIME='30', API_ENDPOINT=CLOUD.url,
+    RETRY_DELAY='0.1', RETRY_MAX_DELAY='0.5', POLL_MIN_INTERVAL='0.1', POLL_MAX_INTERVAL='0.3'
+)
+
+
+@pytest.fixture(scope='session')
+def cloud():
+    CLOUD.start()
+    yield CLOUD
+    CLOUD.stop()
+
+
+@pytest.fixture
+def fakecloud(cloud):
+    '''Fake cloud in its initial state.'''
+    cloud.post('/_reset')
+    return cloud
+
+
+@pytest.fixture
+def loop():
+    '''Event loop of the test, the shared aiohttp session is closed with it.'''
+    from common.session import get_async_client
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.run_until_complete(get_async_client().close())
+    loop.close()
+    asyncio.set_event_loop(None)
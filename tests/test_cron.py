@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pytest
+
+from common.cron import CronExpression, ScheduleGroup, parse_field, WEEKDAYS, MONTHS
+
+
+def test_parse_field():
+    assert parse_field('*', 0, 5) == {0, 1, 2, 3, 4, 5}
+    assert parse_field('1-3,7', 0, 10) == {1, 2, 3, 7}
+    assert parse_field('*/15', 0, 59) == {0, 15, 30, 45}
+    assert parse_field('0-30/10', 0, 59) == {0, 10, 20, 30}
+    # N/step runs to the end of the range
+    assert parse_field('50/5', 0, 59) == {50, 55}
+    assert parse_field('mon-fri', 0, 7, WEEKDAYS) == {1, 2, 3, 4, 5}
+    assert parse_field('JAN,dec', 1, 12, MONTHS) == {1, 12}
+
+
+@pytest.mark.parametrize('field', ['60', '5-1', '*/0', 'foo', '-1'])
+def test_parse_field_invalid(field):
+    with pytest.raises(ValueError):
+        parse_field(field, 0, 59, WEEKDAYS)
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '0 0 * * * *', '0 24 * * *', '0 0 30 2 *', '@often'])
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronExpression(expression).next_after(datetime(2024, 1, 1))
+
+
+def test_next_after():
+    cron = CronExpression('30 2 * * *')
+    assert cron.next_after(datetime(2024, 1, 1, 1, 0)) == datetime(2024, 1, 1, 2, 30)
+    assert cron.next_after(datetime(2024, 1, 1, 2, 30)) == datetime(2024, 1, 2, 2, 30)
+    # Seconds are dropped, the next minute is the earliest match
+    assert CronExpression('* * * * *').next_after(datetime(2024, 1, 1, 0, 0, 59)) == datetime(2024, 1, 1, 0, 1)
+
+
+def test_next_after_crosses_month_and_year():
+    assert CronExpression('0 0 1 * *').next_after(datetime(2024, 1, 31, 12)) == datetime(2024, 2, 1)
+    assert CronExpression('0 0 1 jan *').next_after(datetime(2024, 6, 1)) == datetime(2025, 1, 1)
+    # Feb 29 only exists in leap years
+    assert CronExpression('0 0 29 2 *').next_after(datetime(2024, 3, 1)) == datetime(2028, 2, 29)
+
+
+@pytest.mark.parametrize('macro, expression', [
+    ('@hourly', '0 * * * *'), ('@daily', '0 0 * * *'), ('@midnight', '0 0 * * *'),
+    ('@weekly', '0 0 * * 0'), ('@monthly', '0 0 1 * *'), ('@yearly', '0 0 1 1 *'), ('@ANNUALLY', '0 0 1 1 *')
+])
+def test_macros(macro, expression):
+    after = datetime(2024, 5, 17, 13, 45)
+    assert CronExpression(macro).next_after(after) == CronExpression(expression).next_after(after)
+
+
+def test_sunday_is_0_and_7():
+    # 2024-01-07 is a Sunday
+    after = datetime(2024, 1, 3)
+    assert CronExpression('0 0 * * 0').next_after(after) == datetime(2024, 1, 7)
+    assert CronExpression('0 0 * * 7').next_after(after) == datetime(2024, 1, 7)
+    assert CronExpression('0 0 * * sun').next_after(after) == datetime(2024, 1, 7)
+
+
+def test_day_or_weekday():
+    # Both restricted: the 15th or any Monday matches
+    cron = CronExpression('0 0 15 * mon')
+    assert cron.next_after(datetime(2024, 1, 1)) == datetime(2024, 1, 8)
+    assert cron.next_after(datetime(2024, 1, 13)) == datetime(2024, 1, 15)
+    assert cron.match(datetime(2024, 2, 15))
+
+    # Weekday is *, so only the 15th matches
+    cron = CronExpression('0 0 15 * *')
+    assert not cron.match(datetime(2024, 1, 8))
+    # Day is *, so only Mondays match
+    cron = CronExpression('0 0 * * mon')
+    assert not cron.match(datetime(2024, 2, 15))
+
+
+def test_schedule_group_mode():
+    assert ScheduleGroup(None, '@daily').name == 'default'
+    with pytest.raises(ValueError):
+        ScheduleGroup('web', '@daily', mode='backup')
@@ -0,0 +1,138 @@
+from collections import Counter
+
+import pytest
+
+from common.discovery import TargetSet, match_ref, parse_ref, resolve_data
+
+
+def instance(instance_id, folder_id='f0', name=None, **labels):
+    return {'id': instance_id, 'folderId': folder_id, 'name': name or f'name-{instance_id}', 'labels': labels}
+
+
+class FakeLister:
+
+    '''Instances by folder, counts listings and GETs.'''
+
+    def __init__(self, *instances):
+        self.instances = {x['id']: x for x in instances}
+        self.calls = Counter()
+
+    def list_folder(self, folder_id):
+        self.calls['list', folder_id] += 1
+        return [dict(x) for x in self.instances.values() if x['folderId'] == folder_id]
+
+    def get(self, instance_id):
+        self.calls['get', instance_id] += 1
+        data = self.instances.get(instance_id)
+        return dict(data) if data else None
+
+
+def test_resolve_lists_folders_once():
+    lister = FakeLister(*[instance(f'id{i}') for i in range(10)], instance('id10', 'f1'))
+    targets = resolve_data(['id3', 'name-id1', 'id10', 'id5'], folders=['f0'], lister=lister)
+
+    # Config order, names and IDs of known folders need no GET
+    assert [x['id'] for x in targets] == ['id3', 'id1', 'id10', 'id5']
+    assert lister.calls == {('list', 'f0'): 1, ('get', 'id10'): 1, ('list', 'f1'): 1}
+
+
+def test_resolve_without_folders():
+    lister = FakeLister(instance('id1'), instance('id2'), instance('id3', 'f1'))
+    targets = resolve_data(['id1', 'id2', 'id3'], lister=lister)
+
+    # The folder of the first GET is listed, the other instance of it is found there
+    assert [x['id'] for x in targets] == ['id1', 'id2', 'id3']
+    assert lister.calls == {('get', 'id1'): 1, ('list', 'f0'): 1, ('get', 'id3'): 1, ('list', 'f1'): 1}
+
+
+def test_missing_instances_are_skipped():
+    lister = FakeLister(instance('id1'))
+    targets = resolve_data(['id1', 'missing', 'id1'], folders=['f0'], lister=lister)
+
+    assert [x['id'] for x in targets] == ['id1']
+    assert lister.calls[('get', 'missing')] == 1
+
+
+def test_refresh_lists_given_folders_after_interval():
+    lister = FakeLister(instance('id1'))
+    targets = TargetSet(['id1'], folders=['f0'], interval=300, lister=lister)
+    targets.resolve()
+
+    assert targets.refresh() == ([], [])
+    assert lister.calls[('list', 'f0')] == 1
+
+    # IDs can't join or leave the set, their folder is listed only when asked for
+    lister.instances['id1']['status'] = 'STOPPED'
+    assert targets.refresh(force=True) == ([], [])
+    assert lister.calls[('list', 'f0')] == 1
+    assert targets.refresh(force=True, folders={'f0'}) == ([], [])
+    assert targets.targets[0]['status'] == 'STOPPED'
+
+
+def test_parse_ref():
+    assert parse_ref('id1') == ('ref', 'id1')
+    assert parse_ref('folder:f0') == ('folder', ('f0', None))
+    assert parse_ref('env=prod,tier!=*') == ('selector', (None, [('env', '=', 'prod'), ('tier', '!=', '*')]))
+    assert parse_ref('folder:f0/env!=dev') == ('selector', ('f0', [('env', '!=', 'dev')]))
+
+
+@pytest.mark.parametrize('ref, matched', [
+    ('id1', True),
+    ('web-1', True),
+    ('folder:f0', True),
+    ('folder:f1', False),
+    ('env=prod', True),
+    ('env=dev', False),
+    ('env!=dev', True),
+    ('env=prod,tier=web', True),
+    ('env=prod,tier=db', False),
+    ('tier=*', True),
+    ('backup!=*', True),
+    ('backup=*', False),
+    ('folder:f0/env=prod', True),
+    ('folder:f1/env=prod', False),
+])
+def test_match_ref(ref, matched):
+    assert match_ref(ref, instance('id1', name='web-1', env='prod', tier='web')) is matched
+
+
+def test_selectors():
+    lister = FakeLister(
+        instance('id1', env='prod'), instance('id2', env='dev'), instance('id3', 'f1', env='prod'), instance('id4', 'f2')
+    )
+    targets = resolve_data(['folder:f0/env=prod', 'folder:f1', 'id1'], lister=lister)
+
+    # An instance matched by several entries is a target once
+    assert [x['id'] for x in targets] == ['id1', 'id3']
+    assert ('list', 'f2') not in lister.calls
+
+
+def test_refresh_selectors():
+    lister = FakeLister(instance('id1', env='prod'), instance('id2', env='dev'), instance('id3', 'f1'))
+    targets = TargetSet(['folder:f0/env=prod', 'id3'], interval=0, lister=lister)
+    targets.resolve()
+    assert targets.ids == ['id1', 'id3']
+
+    lister.instances['id2']['labels']['env'] = 'prod'
+    del lister.instances['id1']
+    added, removed = targets.refresh()
+
+    assert [x['id'] for x in added] == ['id2']
+    assert [x['id'] for x in removed] == ['id1']
+    assert targets.ids == ['id2', 'id3']
+    # Only the folder of the selector is listed again
+    assert lister.calls[('list', 'f0')] == 2
+    assert lister.calls[('list', 'f1')] == 1
+
+
+def test_refresh_unscoped_selector_lists_known_folders():
+    lister = FakeLister(instance('id1', env='prod'), instance('id2', 'f1'))
+    targets = TargetSet(['env=prod'], folders=['f0', 'f1'], interval=0, lister=lister)
+    targets.resolve()
+
+    lister.instances['id2']['labels']['env'] = 'prod'
+    added, removed = targets.refresh()
+
+    assert [x['id'] for x in added] == ['id2']
+    assert removed == []
+    assert lister.calls == {('list', 'f0'): 2, ('list', 'f1'): 2}
@@ -0,0 +1,153 @@
+'''End-to-end checks against bench/fakecloud.py: 4 instances, 2 expired snapshots per disk, quota of 3 operations.'''
+
+import time
+
+import pytest
+import aiohttp
+import requests
+
+import snaps
+
+from common.async_compute import AsyncInstance
+from common.compute import Instance
+from common.bulk import delete_snapshots, async_delete_snapshots
+from common.config import Config as config
+from common.discovery import resolve_instances
+from common.journal import RunJournal
+from common.scheduler import OperationScheduler
+
+
+def snapshots(cloud):
+    return cloud.get('/compute/v1/snapshots?folderId=f0&pageSize=1000')['snapshots']
+
+
+def old_snapshots(instances):
+    return [(vm, snapshot) for vm in instances for snapshot in vm.get_old_snapshots()]
+
+
+def test_async_instance(fakecloud, loop):
+    scheduler = OperationScheduler(max_operations=3, retry_delay=0.05)
+
+    async def main():
+        vm = await AsyncInstance.create('vm0')
+        assert vm.status == 'RUNNING'
+
+        await scheduler.run('stop', vm.stop, vm.operation_complete)
+        stopped = fakecloud.get('/_status')
+        snapshot = await scheduler.run('snapshot', vm.create_snapshot, vm.operation_complete)
+        await scheduler.run('start', vm.start, vm.operation_complete)
+        return vm, stopped, snapshot
+
+    vm, stopped, snapshot = loop.run_until_complete(main())
+
+    assert stopped == {'RUNNING': 3, 'STOPPED': 1}
+    assert snapshot['response']['sourceDiskId'] == 'disk0'
+    assert vm.status == 'RUNNING'
+    assert fakecloud.get('/_status') == {'RUNNING': 4}
+    assert len(snapshots(fakecloud)) == 4 * 2 + 1
+
+
+def test_bulk_delete(fakecloud):
+    items = old_snapshots(resolve_instances(['folder:f0']))
+    assert len(items) == 8
+
+    # More deletes than the quota: rejected ones are requeued
+    stats = delete_snapshots(items, limit=8, retry_delay=0.05, max_delay=0.2)
+
+    assert (stats.deleted, stats.failed) == (8, [])
+    assert stats.requeued > 0
+    assert fakecloud.get('/_stats')['status 429'] > 0
+    assert snapshots(fakecloud) == []
+
+
+def test_async_bulk_delete(fakecloud, loop):
+    items = old_snapshots(resolve_instances(['folder:f0']))
+    items = [(AsyncInstance.from_instance(vm), snapshot) for vm, snapshot in items]
+    # The scheduler allows more operations than the cloud does
+    scheduler = OperationScheduler(max_operations=8, retry_delay=0.05, max_delay=0.2)
+
+    stats = loop.run_until_complete(async_delete_snapshots(items, scheduler))
+
+    assert (stats.deleted, stats.failed) == (8, [])
+    assert stats.requeued == fakecloud.get('/_stats')['status 429'] > 0
+    assert snapshots(fakecloud) == []
+
+
+@pytest.fixture
+def journal_file(tmp_path, monkeypatch):
+    path = tmp_path / 'snaps.journal'
+    monkeypatch.setattr(config, 'journal', True)
+    monkeypatch.setattr(snaps, 'JOURNAL_FILE', path)
+    return path
+
+
+def interrupt_run(path):
+    '''Journaled create run killed after vm0 is stopped and its snapshot is sent.'''
+    journal = RunJournal(path)
+    journal.begin('create')
+
+    vm = resolve_instances(['vm0'], folders=['f0'], journal=journal)[0]
+    vm.operation_complete(vm.stop())
+    vm.create_snapshot()
+    return journal
+
+
+@pytest.mark.parametrize('run_async', [False, True])
+def test_resume(fakecloud, journal_file, loop, run_async):
+    interrupt_run(journal_file)
+    assert fakecloud.get('/_status') == {'RUNNING': 3, 'STOPPED': 1}
+    time.sleep(1.5)
+
+    summary = snaps.run(resume=True, run_async=run_async)
+
+    assert summary['mode'] == 'create'
+    assert fakecloud.get('/_status') == {'RUNNING': 4}
+    # The snapshot in flight is waited for, not sent again
+    assert fakecloud.get('/_stats')['POST snapshots'] == 4
+    assert sorted(x['sourceDiskId'] for x in snapshots(fakecloud) if not x['id'].startswith('snap-')) == [f'disk{i}' for i in range(4)]
+    # Downtime of vm0 counts from the stop of the interrupted run
+    assert summary['downtime']['name0'] >= 1.5
+    assert RunJournal(journal_file).resume() is None
+
+
+def test_nothing_to_resume(fakecloud, journal_file):
+    assert snaps.run(resume=True) is None
+    assert fakecloud.get('/_stats').get('POST snapshots') is None
+
+
+@pytest.mark.parametrize('run_async', [False, True])
+def test_instances_started_when_snapshot_fails(fakecloud, loop, monkeypatch, run_async):
+    def failed(self, disk_id=None):
+        raise requests.ConnectionError('connection reset')
+
+    async def async_failed(self, disk_id=None):
+        raise aiohttp.ClientConnectionError('connection reset')
+
+    monkeypatch.setattr(Instance, 'create_snapshot', failed)
+    monkeypatch.setattr(AsyncInstance, 'create_snapshot', async_failed)
+
+    summary = snaps.run('create', run_async=run_async)
+
+    # Every instance is stopped and started again, none is left stopped
+    assert fakecloud.get('/_status') == {'RUNNING': 4}
+    assert sorted(summary['downtime']) == [f'name{i}' for i in range(4)]
+
+
+def test_daemon_survives_failed_run(fakecloud, monkeypatch):
+    calls = []
+
+    def run(mode, **kwargs):
+        calls.append((mode, len(kwargs['targets'])))
+        # The first run fails, the second one stops the daemon
+        if len(calls) == 1:
+            raise RuntimeError('network is down')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(config, 'schedules', {None: {'cron': '* * * * *', 'mode': 'create'}})
+    monkeypatch.setattr(snaps, 'run', run)
+    monkeypatch.setattr(snaps.time, 'sleep', lambda seconds: None)
+
+    with pytest.raises(KeyboardInterrupt):
+        snaps.daemon()
+
+    assert calls == [('create', 4), ('create', 4)]
@@ -0,0 +1,74 @@
+import json
+import base64
+
+import pytest
+
+import handler
+
+from common.config import Config as config
+
+
+@pytest.fixture(autouse=True)
+def env_config():
+    '''Options of an invocation don't leak into other tests.'''
+    yield
+    handler.configure(config, {})
+
+
+def invoke(options):
+    response = handler.handler({'body': json.dumps(options)}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def test_event_options():
+    options = {'mode': 'create', 'instances': 'vm0'}
+    body = json.dumps(options)
+
+    assert handler.event_options({'messages': [{'details': {'payload': body}}]}) == options
+    assert handler.event_options({'body': base64.b64encode(body.encode()).decode(), 'isBase64Encoded': True}) == options
+    assert handler.event_options(dict(options, unknown=1)) == options
+    assert handler.event_options({'body': 'not json'}) == {}
+    assert handler.event_options(None) == {}
+
+
+def test_configure():
+    handler.configure(config, {
+        'instances': 'vm0,vm1', 'folders': ['f0'], 'lifetime': '30', 'all_disks': 'false', 'retention': 'daily=7,weekly=4'
+    })
+
+    assert config.instances_list == ['vm0', 'vm1']
+    assert config.folders_list == ['f0']
+    assert config.lifetime == 30
+    assert config.all_disks is False
+    assert config.retention == {None: {'daily': 7, 'weekly': 4}}
+
+    # The next invocation starts from env values
+    handler.configure(config, {'lifetime': 7})
+    assert config.instances_list == ['folder:f0']
+    assert config.lifetime == 7
+
+
+@pytest.mark.parametrize('options', [
+    {'mode': 'backup'},
+    {'lifetime': 'abc'},
+    {'lifetime': -1},
+    {'lifetime': True},
+    {'instances': 5},
+    {'folders': ['f0', 1]},
+    {'retention': 'hourly=1'},
+    {'retention': {'daily': 'x'}},
+    {'retention': 7}
+])
+def test_invalid_options(options):
+    status, body = invoke(options)
+    assert status == 400
+    assert body['error']
+
+
+def test_run(fakecloud):
+    status, body = invoke({'mode': 'create', 'instances': ['vm0'], 'async': 'false'})
+
+    assert status == 200
+    assert body['mode'] == 'create'
+    assert body['instances'] == 1
+    assert fakecloud.get('/_stats')['POST snapshots'] == 1
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from common.async_compute import AsyncInstance
+from common.compute import Instance
+from common.exceptions import AuthError
+from common.iam import TokenProvider, get_token_provider, parse_expires_at
+
+
+def test_parse_expires_at():
+    assert parse_expires_at('2024-01-01T00:00:00.123456789Z') == 1704067200
+    assert parse_expires_at('2024-01-01T00:00:00Z') == 1704067200
+
+
+def test_token_is_exchanged_once(fakecloud):
+    provider = TokenProvider('oauth')
+    token = provider.get()
+
+    assert token == provider.get()
+    assert fakecloud.get('/_stats')['POST iam'] == 1
+
+    provider.invalidate()
+    assert provider.get() != token
+
+
+def test_rejected_exchange_raises(fakecloud):
+    fakecloud.post('/_fail?count=1&status=401')
+    with pytest.raises(AuthError):
+        TokenProvider('revoked').get()
+
+
+def test_cache_is_keyed_by_endpoint(fakecloud, tmp_path):
+    cache_file = tmp_path / 'iam.json'
+    token = TokenProvider('oauth', cache_file=cache_file).get()
+
+    assert TokenProvider('oauth', cache_file=cache_file).get() == token
+    assert fakecloud.get('/_stats')['POST iam'] == 1
+
+    # A token cached for another IAM endpoint is not reused
+    data = json.loads(cache_file.read_text())
+    data['fingerprint'] = 'other endpoint'
+    cache_file.write_text(json.dumps(data))
+    assert TokenProvider('oauth', cache_file=cache_file).get() != token
+
+
+def test_refresh():
+    provider = TokenProvider('oauth')
+    provider._token, provider._expires_at = 'old', float('inf')
+    provider._exchange = lambda: ('new', float('inf'))
+
+    assert provider.refresh('old') == 'new'
+    # Requests sent with the old token share the exchange
+    provider._exchange = lambda: pytest.fail('exchanged twice')
+    assert provider.refresh('old') == 'new'
+    assert provider.refresh('unknown') is None
+
+
+def test_request_rejected_with_401_is_sent_again(fakecloud):
+    vm = Instance('vm0', token_provider=get_token_provider())
+    token = vm.iam_token
+    before = fakecloud.get('/_stats')
+
+    fakecloud.post('/_fail?count=1&status=401')
+    assert vm.get_data()['id'] == 'vm0'
+
+    # A new token is exchanged and the request is sent once more
+    after = fakecloud.get('/_stats')
+    assert vm.iam_token != token
+    assert after['POST iam'] - before.get('POST iam', 0) == 1
+    assert after['GET instances'] - before['GET instances'] == 2
+
+
+def test_async_request_rejected_with_401_is_sent_again(fakecloud, loop):
+    vm = AsyncInstance('vm0', token_provider=get_token_provider())
+    token = get_token_provider().get()
+
+    fakecloud.post('/_fail?count=1&status=401')
+    assert loop.run_until_complete(vm.get_data())['id'] == 'vm0'
+    assert get_token_provider().get() != token
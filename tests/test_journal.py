@@ -0,0 +1,107 @@
+from datetime import datetime
+
+from common.journal import RunJournal, RunLock
+
+
+def interrupted_run(path):
+    journal = RunJournal(path)
+    journal.begin('full')
+    journal.operation('vm1', 'stop', 'op-stop')
+    journal.finished('op-stop', {'done': True})
+    journal.operation('vm1', 'snapshot', 'op-snap1', disk='disk1')
+    journal.finished('op-snap1', {'done': True})
+    journal.operation('vm1', 'snapshot', 'op-snap2', disk='disk2')
+    journal.operation('vm2', 'stop', 'op-stop2')
+    journal.finished('op-stop2', {'done': True, 'error': {'code': 9}})
+    journal.instance_done('vm2', 'delete')
+    return journal
+
+
+def test_resume(tmp_path):
+    path = tmp_path / 'snaps.journal'
+    written = interrupted_run(path)
+
+    journal = RunJournal(path)
+    assert journal.resume() == 'full'
+    assert journal.run_id == written.run_id
+    assert journal.pending() == {'vm1': ['op-snap2']}
+
+    assert journal.stopped('vm1')
+    # A failed stop didn't stop the instance
+    assert not journal.stopped('vm2')
+    assert journal.snapshotted('vm1', 'disk1')
+    assert not journal.snapshotted('vm1', 'disk2')
+    assert journal.done('vm2', 'delete')
+    assert not journal.done('vm2', 'create')
+
+
+def test_stopped_at(tmp_path):
+    path = tmp_path / 'snaps.journal'
+    before = datetime.utcnow()
+    interrupted_run(path)
+
+    journal = RunJournal(path)
+    journal.resume()
+    assert before <= journal.stopped_at('vm1') <= datetime.utcnow()
+    assert journal.stopped_at('vm2') is None
+
+    journal.operation('vm1', 'start', 'op-start')
+    journal.finished('op-start', {'done': True})
+    assert not journal.stopped('vm1')
+    assert journal.stopped_at('vm1') is None
+
+
+def test_end(tmp_path):
+    path = tmp_path / 'snaps.journal'
+    journal = interrupted_run(path)
+
+    # vm1 is still stopped, the run can't end
+    journal.end()
+    assert RunJournal(path).resume() == 'full'
+
+    journal.operation('vm1', 'start', 'op-start')
+    journal.finished('op-start', {'done': True})
+    journal.end()
+    assert RunJournal(path).resume() is None
+
+
+def test_begin_discards_previous_run(tmp_path):
+    path = tmp_path / 'snaps.journal'
+    interrupted_run(path)
+
+    journal = RunJournal(path)
+    journal.begin('create')
+    assert journal.mode == 'create'
+    assert not journal.operations
+    assert len(path.read_text().splitlines()) == 1
+
+
+def test_corrupted_line_is_skipped(tmp_path):
+    path = tmp_path / 'snaps.journal'
+    interrupted_run(path)
+    with open(path, 'a') as f:
+        f.write('{"event": "finished", "id": "op-sn')
+
+    journal = RunJournal(path)
+    assert journal.resume() == 'full'
+    assert journal.pending() == {'vm1': ['op-snap2']}
+
+
+def test_memory_journal():
+    journal = RunJournal()
+    journal.begin('create')
+    journal.operation('vm1', 'stop', 'op-stop')
+    assert journal.pending() == {'vm1': ['op-stop']}
+    # Nothing to resume without a file
+    assert RunJournal().resume() is None
+
+
+def test_lock(tmp_path):
+    path = tmp_path / 'snaps.lock'
+
+    with RunLock(path) as locked:
+        assert locked
+        assert not RunLock(path).acquire()
+
+    assert RunLock(path).acquire()
+    assert RunLock().acquire()
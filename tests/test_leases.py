@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+from common.leases import HashRing, LeaseStore, SQLiteLeaseStore, ShardMember, get_lease_store
+
+KEYS = [f'shard-{x}' for x in range(1000)]
+
+
+def settle(*members):
+    # Every member sees the others on the first round and takes its shards on the second
+    for _ in range(2):
+        for member in members:
+            member.sync()
+
+
+def test_hash_ring_is_stable():
+    ring = HashRing(['a', 'b', 'c'])
+    # Placement doesn't depend on the order of replicas or on the process
+    assert [ring.get(x) for x in KEYS] == [HashRing(['c', 'a', 'b']).get(x) for x in KEYS]
+    assert {ring.get(x) for x in KEYS} == {'a', 'b', 'c'}
+    assert HashRing([]).get('shard-1') is None
+
+
+def test_hash_ring_moves_only_keys_of_changed_replica():
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+    moved = [x for x in KEYS if before.get(x) != after.get(x)]
+
+    assert all(after.get(x) == 'd' for x in moved)
+    # About a quarter of the keys goes to the new replica
+    assert 100 < len(moved) < 450
+
+    after = HashRing(['a', 'c'])
+    assert all(after.get(x) == before.get(x) for x in KEYS if before.get(x) != 'b')
+
+
+def test_store_leases(tmp_path):
+    store = get_lease_store(f'sqlite:///{tmp_path}/leases.db')
+    assert isinstance(store, SQLiteLeaseStore)
+
+    store.heartbeat('a', 10)
+    store.heartbeat('b', 10)
+    store.heartbeat('c', -1)
+    assert store.members() == ['a', 'b']
+
+    assert store.acquire({1, 2, 3}, 'a', 10) == {1, 2, 3}
+    # Held by a live lease of another replica
+    assert store.acquire({3, 4}, 'b', 10) == {4}
+    # Renewing own leases
+    assert store.acquire({1, 2}, 'a', 10) == {1, 2}
+
+    store.release({3}, 'a')
+    assert store.acquire({3}, 'b', 10) == {3}
+    store.release({4}, 'a')
+    assert store.acquire({4}, 'a', 10) == set()
+
+    store.leave('a')
+    assert store.members() == ['b']
+    assert store.acquire({1, 2}, 'b', 10) == {1, 2}
+
+
+def test_expired_lease_is_taken(tmp_path):
+    store = SQLiteLeaseStore(tmp_path / 'leases.db')
+    assert store.acquire({1}, 'a', 0.1) == {1}
+    assert store.acquire({1}, 'b', 10) == set()
+
+    time.sleep(0.2)
+    assert store.acquire({1}, 'b', 10) == {1}
+
+
+def test_members_split_shards(tmp_path):
+    path = tmp_path / 'leases.db'
+    a = ShardMember(SQLiteLeaseStore(path), 'a', shards=32, ttl=0.5)
+    b = ShardMember(SQLiteLeaseStore(path), 'b', shards=32, ttl=0.5)
+
+    assert a.sync() == (set(range(32)), set())
+    b.sync()
+    # b waits until a releases the shards that moved to b
+    assert not b.owned
+    settle(a, b)
+
+    assert a.owned and b.owned
+    assert a.owned | b.owned == set(range(32))
+    assert not a.owned & b.owned
+    assert a.owns('vm1') != b.owns('vm1')
+
+
+def test_dead_member_is_taken_over(tmp_path):
+    path = tmp_path / 'leases.db'
+    a = ShardMember(SQLiteLeaseStore(path), 'a', shards=32, ttl=0.3)
+    b = ShardMember(SQLiteLeaseStore(path), 'b', shards=32, ttl=0.3)
+    settle(a, b)
+    held = set(a.owned)
+
+    # a stops renewing its heartbeat and leases
+    b.sync()
+    assert b.owned == set(range(32)) - held
+
+    time.sleep(0.4)
+    acquired, _ = b.sync()
+    assert acquired == held
+    assert b.owned == set(range(32))
+
+
+def test_leave_hands_shards_over(tmp_path):
+    path = tmp_path / 'leases.db'
+    a = ShardMember(SQLiteLeaseStore(path), 'a', shards=16, ttl=10)
+    b = ShardMember(SQLiteLeaseStore(path), 'b', shards=16, ttl=10)
+    settle(a, b)
+
+    a.leave()
+    assert not a.owned
+    b.sync()
+    assert b.owned == set(range(16))
+
+
+def test_store_backend_must_implement_all_methods():
+    class Incomplete(LeaseStore):
+        def heartbeat(self, replica_id, ttl):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
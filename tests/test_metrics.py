@@ -0,0 +1,57 @@
+import time
+
+from common.metrics import Registry, endpoint, format_labels, observe_request, REGISTRY
+
+
+def test_render():
+    registry = Registry()
+    requests = registry.counter('requests_total', 'Requests', ('endpoint', 'status'))
+    running = registry.gauge('running', 'Running instances')
+    latency = registry.histogram('latency_seconds', 'Latency', ('endpoint',), buckets=(0.1, 1))
+
+    requests.inc(endpoint='compute', status=200)
+    requests.inc(2, endpoint='compute', status=200)
+    # A request that raised has status "error"
+    requests.inc(endpoint='compute', status='error')
+    running.set(3)
+    latency.observe(0.05, endpoint='compute')
+    latency.observe(0.5, endpoint='compute')
+
+    assert registry.render().splitlines() == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{endpoint="compute",status="200"} 3',
+        'requests_total{endpoint="compute",status="error"} 1',
+        '# HELP running Running instances',
+        '# TYPE running gauge',
+        'running 3',
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{endpoint="compute",le="0.1"} 1',
+        'latency_seconds_bucket{endpoint="compute",le="1"} 2',
+        'latency_seconds_bucket{endpoint="compute",le="+Inf"} 2',
+        'latency_seconds_sum{endpoint="compute"} 0.55',
+        'latency_seconds_count{endpoint="compute"} 2',
+    ]
+
+
+def test_render_after_failed_request():
+    started = time.monotonic()
+    observe_request('GET', 'https://compute.api.cloud.yandex.net/compute/v1/instances/id1', 200, started)
+    observe_request('GET', 'https://compute.api.cloud.yandex.net/compute/v1/instances/id1', 'error', started)
+
+    assert 'yc_api_requests_total{endpoint="compute",method="GET",status="error"} 1' in REGISTRY.render()
+
+
+def test_format_labels():
+    assert format_labels((), ()) == ''
+    assert format_labels(('name',), ('a"b\\c\nd',)) == '{name="a\\"b\\\\c\\nd"}'
+
+
+def test_endpoint():
+    assert endpoint('https://iam.api.cloud.yandex.net/iam/v1/tokens') == 'iam'
+    assert endpoint('https://operation.api.cloud.yandex.net/operations/op1') == 'operations'
+    assert endpoint('http://127.0.0.1:8999/operations/op1') == 'operations'
+    assert endpoint('http://127.0.0.1:8999/compute/v1/snapshots/s1') == 'snapshots'
+    assert endpoint('http://127.0.0.1:8999/compute/v1/disks') == 'disks'
+    assert endpoint('http://127.0.0.1:8999/compute/v1/instances/id1:start') == 'compute'
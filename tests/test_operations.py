@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from common.exceptions import OperationError, OperationTimeout
+from common.operations import OperationTracker, check_operation, wait_operations
+
+
+def test_check_operation():
+    assert not check_operation(None)
+    assert not check_operation({'done': False})
+    assert check_operation({'done': True})
+
+    with pytest.raises(OperationError):
+        check_operation({'done': True, 'error': {'code': 9, 'message': 'failed'}})
+
+
+def test_tracker_polls_until_done(loop):
+    polls = {}
+
+    async def fetch(operation_id):
+        polls[operation_id] = polls.get(operation_id, 0) + 1
+        # op1 is done on the second poll, op2 on the fourth
+        return {'id': operation_id, 'done': polls[operation_id] >= int(operation_id[-1]) * 2}
+
+    tracker = OperationTracker(fetch, min_interval=0.01, max_interval=0.02)
+    result = loop.run_until_complete(asyncio.gather(tracker.wait('op1'), tracker.wait('op2')))
+
+    assert [x['id'] for x in result] == ['op1', 'op2']
+    assert polls == {'op1': 2, 'op2': 4}
+
+
+def test_tracker_deadlines(loop):
+    async def fetch(operation_id):
+        return {'id': operation_id, 'done': False}
+
+    async def failed(operation_id):
+        return {'id': operation_id, 'done': True, 'error': {'code': 13, 'message': 'internal'}}
+
+    tracker = OperationTracker(fetch, timeout=5, min_interval=0.01, max_interval=0.05)
+    started = loop.time()
+
+    # Every operation has its own deadline
+    with pytest.raises(OperationTimeout) as err:
+        loop.run_until_complete(tracker.wait('slow', timeout=0.1))
+    assert err.value.operation == {'id': 'slow', 'done': False}
+    assert loop.time() - started < 1
+
+    with pytest.raises(OperationError):
+        loop.run_until_complete(tracker.wait('failed', fetch=failed))
+
+
+def test_tracker_survives_fetch_errors(loop):
+    calls = []
+
+    async def fetch(operation_id):
+        calls.append(operation_id)
+        if len(calls) < 3:
+            raise ConnectionError('reset by peer')
+        return {'id': operation_id, 'done': True}
+
+    tracker = OperationTracker(fetch, min_interval=0.01, max_interval=0.01)
+    assert loop.run_until_complete(tracker.wait('op1')) == {'id': 'op1', 'done': True}
+    assert len(calls) == 3
+
+
+def test_wait_operations():
+    calls = []
+
+    def fetch(operation_id):
+        calls.append(operation_id)
+        if operation_id == 'flaky' and calls.count('flaky') < 3:
+            raise ConnectionError('reset by peer')
+        if operation_id == 'failed':
+            return {'id': operation_id, 'done': True, 'error': {'code': 9, 'message': 'failed'}}
+
+        return {'id': operation_id, 'done': operation_id != 'slow'}
+
+    result = wait_operations(['ok', 'flaky', 'failed', 'slow', None], fetch, timeout=0.2, min_interval=0.01, max_interval=0.02)
+
+    assert result['ok'] == {'id': 'ok', 'done': True}
+    # Fetch errors are polled again until the deadline
+    assert result['flaky'] == {'id': 'flaky', 'done': True}
+    # Failed operations are returned as is, unfinished ones as None
+    assert result['failed']['error']['code'] == 9
+    assert result['slow'] is None
+    assert calls.count('ok') == 1
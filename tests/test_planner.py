@@ -0,0 +1,93 @@
+from common.planner import RunPlanner, Job, MB
+
+
+class FakeVM:
+
+    def __init__(self, instance_id, disks, status='RUNNING'):
+        self.instance_id = instance_id
+        self.instance_data = {'id': instance_id, 'status': status}
+        self.snapshot_disks = disks
+        self.folder_id = 'f0'
+
+
+class FakeLister:
+
+    def __init__(self, disks):
+        self.disks = disks
+
+    def list_folder(self, folder_id):
+        return list(self.disks.values())
+
+    def get(self, disk_id):
+        return None
+
+
+def job(name, *snapshots, stop=10, start=10):
+    return Job(name, stop, start, [({'id': f'{name}-{i}'}, x) for i, x in enumerate(snapshots)])
+
+
+def test_estimate():
+    planner = RunPlanner(snapshot_time=10, snapshot_rate=100, rates={'network-ssd': 200})
+
+    assert planner.estimate({}) == 10
+    assert planner.estimate({'size': str(1000 * MB), 'typeId': 'network-hdd'}) == 20
+    assert planner.estimate({'size': str(1000 * MB), 'typeId': 'network-ssd'}) == 15
+
+
+def test_jobs():
+    planner = RunPlanner(stop_time=30, start_time=20, snapshot_time=0, snapshot_rate=100)
+    disks = {'d1': {'id': 'd1', 'size': str(500 * MB)}, 'd2': {'id': 'd2', 'size': str(1000 * MB)}}
+    running = FakeVM('vm1', ['d1', 'd2'])
+    stopped = FakeVM('vm2', ['d1'], status='STOPPED')
+    missing = FakeVM('vm3', ['d3'])
+    missing.instance_data = None
+
+    jobs = planner.jobs([running, stopped, missing], disks)
+
+    assert [x.vm for x in jobs] == [running, stopped]
+    assert (jobs[0].duration, jobs[0].work) == (30 + 10 + 20, 30 + 5 + 10 + 20)
+    # A stopped instance is neither stopped nor started by the run
+    assert jobs[1].duration == 5
+
+
+def test_simulate_respects_quota():
+    planner = RunPlanner(max_operations=2)
+    jobs = [job('a', 100), job('b', 100), job('c', 100)]
+
+    # Two stops at once, the third job waits until both starts are done
+    assert planner.simulate(jobs) == 120 + 120
+    assert [(x.begin, x.end) for x in jobs] == [(0, 120), (0, 120), (120, 240)]
+
+
+def test_simulate_kind_limit():
+    planner = RunPlanner(max_operations=10, limits={'snapshot': 1})
+    jobs = [job('a', 50, 50)]
+
+    # One snapshot at a time: disks of the instance are snapshotted in turn
+    assert planner.simulate(jobs) == 10 + 50 + 50 + 10
+    assert planner.sequential(jobs) == 10 + 50 + 10
+
+
+def test_longest_first_is_not_worse():
+    planner = RunPlanner(max_operations=3)
+    jobs = [job(f'short{i}', 20) for i in range(6)] + [job('long', 600)]
+
+    given = planner.simulate(jobs)
+    ordered = sorted(jobs, key=lambda x: (x.duration, x.work), reverse=True)
+    planned = planner.simulate(ordered)
+
+    assert ordered[0].vm == 'long'
+    assert planned < given
+    assert planned == 10 + 600 + 10
+
+
+def test_plan():
+    disks = {f'd{i}': {'id': f'd{i}', 'size': str(size * 1000 * MB)} for i, size in enumerate([1, 1, 50, 1])}
+    vms = [FakeVM(f'vm{i}', [f'd{i}']) for i in range(4)]
+    planner = RunPlanner(max_operations=1, snapshot_time=0, lister=FakeLister(disks))
+
+    jobs, makespan, given = planner.plan(vms)
+
+    assert [x.vm.instance_id for x in jobs][0] == 'vm2'
+    assert makespan <= given
+    assert all(x.end > x.begin for x in jobs)
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+from common.retention import RetentionPolicy, RetentionPolicies
+
+NOW = datetime(2024, 6, 30, 12)
+
+
+def daily_entries(days, hours=(1,)):
+    '''Snapshots at given hours of every day for the last days, oldest first.'''
+    entries = []
+    for day in range(days, 0, -1):
+        for hour in hours:
+            created_at = (NOW - timedelta(days=day)).replace(hour=hour)
+            entries.append((created_at, {'id': f'{created_at:%Y%m%d%H}'}))
+
+    return entries
+
+
+def kept(policy, entries):
+    return {snapshot['id']: reasons for _, snapshot, reasons in policy.plan(entries, now=NOW) if reasons}
+
+
+def test_last():
+    entries = daily_entries(10)
+    result = kept(RetentionPolicy(last=3), entries)
+
+    assert set(result) == {x[1]['id'] for x in entries[-3:]}
+    assert all(x == ['last'] for x in result.values())
+
+
+def test_days():
+    result = kept(RetentionPolicy(days=5), daily_entries(10))
+    assert len(result) == 4
+    assert all(x == ['days'] for x in result.values())
+
+
+def test_daily_keeps_newest_of_a_day():
+    result = kept(RetentionPolicy(daily=3), daily_entries(10, hours=(1, 2, 3)))
+    assert sorted(result) == ['2024062703', '2024062803', '2024062903']
+
+
+def test_gfs():
+    entries = daily_entries(120)
+    result = kept(RetentionPolicy(daily=7, weekly=4, monthly=3), entries)
+
+    assert sum('daily' in x for x in result.values()) == 7
+    assert sum('weekly' in x for x in result.values()) == 4
+    assert sum('monthly' in x for x in result.values()) == 3
+    # The newest snapshot is the newest of its day, week and month
+    assert result[entries[-1][1]['id']] == ['daily', 'weekly', 'monthly']
+
+    # Sunday snapshots close ISO weeks, last days of months close months
+    weekly = sorted(datetime.strptime(k, '%Y%m%d%H') for k, v in result.items() if v == ['weekly'])
+    assert all(x.isoweekday() == 7 for x in weekly)
+    monthly = [datetime.strptime(k, '%Y%m%d%H') for k, v in result.items() if 'monthly' in v]
+    assert sorted(x.date().isoformat() for x in monthly) == ['2024-04-30', '2024-05-31', '2024-06-29']
+
+
+def test_periods_without_snapshots_are_skipped():
+    # A gap of months: the monthly rule counts months that have snapshots
+    entries = [(datetime(2023, 1, 5), {'id': 'jan'}), (datetime(2023, 6, 5), {'id': 'jun'}), (datetime(2024, 6, 1), {'id': 'now'})]
+    assert set(kept(RetentionPolicy(monthly=3), entries)) == {'jan', 'jun', 'now'}
+
+
+def test_from_dict_falls_back_to_lifetime():
+    assert RetentionPolicy.from_dict({}, lifetime=30).days == 30
+    assert RetentionPolicy.from_dict({'last': 2}, lifetime=30).days == 30
+    assert RetentionPolicy.from_dict({'weekly': 4}, lifetime=30).days is None
+
+
+def test_overrides():
+    web = RetentionPolicy(daily=7)
+    policies = RetentionPolicies(RetentionPolicy(days=10), [('web-1', web)])
+
+    assert policies.get({'id': 'id1', 'name': 'web-1', 'folderId': 'f0'}) is web
+    assert policies.get({'id': 'id2', 'name': 'db-1', 'folderId': 'f0'}) is policies.default
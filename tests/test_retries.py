@@ -0,0 +1,134 @@
+import time
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+from common.decorators import retry
+from common.exceptions import CircuitOpenError
+from common.retries import CircuitBreaker, RetryPolicy, parse_retry_after
+from common.session import ApiClient
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after('-1') == 0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+
+    retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 < parse_retry_after(retry_at) <= 60
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+
+def test_policy_backoff():
+    policy = RetryPolicy(tries=10, delay=1, max_delay=5, deadline=0)
+    started = time.monotonic()
+
+    assert all(0 <= policy.pause(0, started) <= 1 for _ in range(100))
+    assert all(0 <= policy.pause(8, started) <= 5 for _ in range(100))
+    # Retry-After is honored when it is longer than the backoff
+    assert policy.pause(0, started, hint=20) == 20
+
+
+def test_policy_limits():
+    policy = RetryPolicy(tries=3, delay=0.01, deadline=10)
+    started = time.monotonic()
+
+    assert policy.pause(1, started) is not None
+    assert policy.pause(2, started) is None
+    # A pause ending after the deadline is not taken
+    assert policy.pause(0, started, hint=10) is None
+    assert policy.pause(0, started - 11) is None
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker('compute', threshold=2, reset_timeout=0.1)
+    breaker.failure()
+    breaker.check()
+    breaker.failure()
+
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    # Half-open: one trial request, the others fail fast
+    time.sleep(0.1)
+    breaker.check()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.success()
+    breaker.check()
+    assert breaker.failures == 0
+
+
+def test_circuit_breaker_trial_failure():
+    breaker = CircuitBreaker('compute', threshold=1, reset_timeout=0.1)
+    breaker.failure()
+    time.sleep(0.1)
+    breaker.check()
+    breaker.failure()
+
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_disabled_circuit_breaker():
+    breaker = CircuitBreaker('compute', threshold=0)
+    for _ in range(10):
+        breaker.failure()
+    breaker.check()
+
+
+def test_retry_decorator():
+    calls = []
+
+    @retry(requests.ConnectionError, policy=RetryPolicy(tries=3, delay=0.01))
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise requests.ConnectionError('reset')
+        return 'ok'
+
+    assert flaky() == 'ok'
+
+    @retry(requests.ConnectionError, policy=RetryPolicy(tries=2, delay=0.01))
+    def down():
+        raise requests.ConnectionError('reset')
+
+    with pytest.raises(requests.ConnectionError):
+        down()
+
+
+def test_client_retries_reads(fakecloud):
+    client = ApiClient(policy=RetryPolicy(tries=4, delay=0.01))
+    url = f'{fakecloud.url}/compute/v1/instances/vm0'
+
+    fakecloud.post('/_fail?count=2&status=503')
+    assert client.get(url).status_code == 200
+    assert fakecloud.get('/_stats')['GET instances'] == 3
+
+
+def test_client_honors_retry_after(fakecloud):
+    client = ApiClient(policy=RetryPolicy(tries=4, delay=0.01))
+    url = f'{fakecloud.url}/compute/v1/instances/vm0'
+
+    fakecloud.post('/_fail?count=1&status=429&retry_after=0.5')
+    started = time.monotonic()
+    assert client.get(url).status_code == 200
+    assert time.monotonic() - started >= 0.5
+
+
+def test_client_sends_writes_once(fakecloud):
+    client = ApiClient(policy=RetryPolicy(tries=4, delay=0.01))
+    url = f'{fakecloud.url}/compute/v1/instances/vm0:stop'
+
+    fakecloud.post('/_fail?count=1&status=503')
+    assert client.post(url).status_code == 503
+    assert fakecloud.get('/_stats')['POST instances'] == 1
+
+    # Statuses out of the policy are not retried
+    fakecloud.post('/_fail?count=1&status=500')
+    assert client.get(url.replace(':stop', '')).status_code == 500
@@ -0,0 +1,128 @@
+import asyncio
+
+from common.exceptions import QuotaError, ServerError
+from common.scheduler import PrioritySemaphore, OperationScheduler
+
+
+def test_priority_order(loop):
+    order = []
+
+    async def main():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+
+        async def waiter(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+            semaphore.release()
+
+        tasks = [loop.create_task(waiter(name, priority)) for name, priority in [('a', 2), ('b', 1), ('c', 2), ('d', 0)]]
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        return semaphore.value
+
+    # Lowest priority value first, arrival order within a priority
+    assert loop.run_until_complete(main()) == 1
+    assert order == ['d', 'b', 'a', 'c']
+
+
+def test_cancelled_waiter_passes_slot_on(loop):
+    async def main():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+
+        first = loop.create_task(semaphore.acquire(0))
+        second = loop.create_task(semaphore.acquire(1))
+        await asyncio.sleep(0)
+
+        # The slot is handed to first, which is cancelled before it runs
+        semaphore.release()
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+
+        third = loop.create_task(semaphore.acquire())
+        await asyncio.sleep(0)
+        assert not third.done()
+        semaphore.release()
+        await asyncio.wait_for(third, 1)
+        semaphore.release()
+        return first.cancelled(), semaphore.value
+
+    assert loop.run_until_complete(main()) == (True, 1)
+
+
+def test_run_limits_operations(loop):
+    scheduler = OperationScheduler(max_operations=3, limits={'snapshot': 2})
+    running = []
+    peak = {}
+
+    async def operation(kind):
+        async def submit():
+            running.append(kind)
+            peak[kind] = max(peak.get(kind, 0), running.count(kind))
+            peak['total'] = max(peak.get('total', 0), len(running))
+            return kind
+
+        async def wait(operation_id):
+            await asyncio.sleep(0.01)
+            running.remove(operation_id)
+            return {'id': operation_id, 'done': True}
+
+        return await scheduler.run(kind, submit, wait)
+
+    kinds = ['snapshot'] * 6 + ['stop'] * 6
+    result = loop.run_until_complete(asyncio.gather(*[operation(x) for x in kinds]))
+
+    assert [x['id'] for x in result] == kinds
+    assert peak['snapshot'] == 2
+    assert peak['total'] == 3
+
+
+def test_run_requeues_rejected(loop):
+    scheduler = OperationScheduler(retry_delay=0.01, max_delay=0.05)
+    errors = [QuotaError('quota'), ServerError('503', retry_after=0.1)]
+    calls = []
+
+    async def submit():
+        calls.append(loop.time())
+        if errors:
+            raise errors.pop(0)
+        return 'op1'
+
+    async def wait(operation_id):
+        return {'id': operation_id, 'done': True}
+
+    assert loop.run_until_complete(scheduler.run('stop', submit, wait)) == {'id': 'op1', 'done': True}
+    assert len(calls) == 3
+    # Retry-After of the server is honored
+    assert calls[2] - calls[1] >= 0.1
+
+
+def test_run_gives_up(loop):
+    scheduler = OperationScheduler(retry_delay=0.001, max_requeue=2)
+    calls = []
+
+    async def submit():
+        calls.append(1)
+        raise QuotaError('quota')
+
+    assert loop.run_until_complete(scheduler.run('delete', submit, None)) is None
+    assert len(calls) == 3
+
+
+def test_run_gives_up_without_sleeping(loop):
+    scheduler = OperationScheduler(max_requeue=0)
+
+    async def submit():
+        raise QuotaError('quota', retry_after=3)
+
+    started = loop.time()
+    assert loop.run_until_complete(scheduler.run('delete', submit, None)) is None
+    assert loop.time() - started < 1
+
+
+def test_pause():
+    scheduler = OperationScheduler(retry_delay=1, max_delay=4)
+    assert all(0 <= scheduler.pause(10) <= 4 for _ in range(100))
+    assert scheduler.pause(0, hint=30) == 30
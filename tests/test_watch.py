@@ -0,0 +1,221 @@
+import asyncio
+
+import aiohttp
+
+from common.async_compute import AsyncInstance
+from common.discovery import AsyncInstanceLister
+from common.scheduler import OperationScheduler
+from common.watch import Watchdog
+
+
+class FailingLister:
+
+    def __init__(self, failed, lister=None):
+        self.failed = failed
+        self.lister = lister or AsyncInstanceLister()
+
+    async def list_folder(self, folder_id):
+        if folder_id in self.failed:
+            raise self.failed[folder_id]
+
+        async for instance in self.lister.list_folder(folder_id):
+            yield instance
+
+
+class StaleLister:
+
+    '''Lists instances with the status they had before the start.'''
+
+    def __init__(self, status):
+        self.status = status
+        self.lister = AsyncInstanceLister()
+
+    async def list_folder(self, folder_id):
+        async for instance in self.lister.list_folder(folder_id):
+            yield dict(instance, status=self.status.get(instance['id'], instance['status']))
+
+
+def watchdog(**kwargs):
+    kwargs.setdefault('jitter', 0)
+    return Watchdog(OperationScheduler(max_operations=3, retry_delay=0.05, max_delay=0.2), **kwargs)
+
+
+def instance_data(instance_id, folder_id='f0', status='RUNNING'):
+    return {'id': instance_id, 'name': instance_id, 'folderId': folder_id, 'status': status}
+
+
+def watch_cloud(dog, loop):
+    async def main():
+        async for data in AsyncInstanceLister().list_folder('f0'):
+            dog.add(data)
+
+    loop.run_until_complete(main())
+    return {x.instance.name: x for x in dog.targets.values()}
+
+
+def run_tick(dog, loop):
+    async def main():
+        await dog.tick()
+        tasks = [x.task for x in dog.targets.values() if x.starting]
+        await asyncio.gather(*tasks)
+        return len(tasks)
+
+    return loop.run_until_complete(main())
+
+
+def test_interval(loop):
+    dog = watchdog(delay=10, fast_delay=2, fast_period=120)
+    dog.add(instance_data('vm0'))
+    state = dog.targets['vm0']
+
+    assert dog.interval('f0', 1000) == 10
+    # Polled fast for fast_period after a stop or a start
+    state.event_at = 1000
+    assert dog.interval('f0', 1000 + 119) == 2
+    assert dog.interval('f0', 1000 + 120) == 10
+
+    dog.jitter = 0.1
+    assert all(9 <= dog.interval('f0', 2000) <= 11 for _ in range(100))
+
+
+def test_preempted_instance_started(fakecloud, loop):
+    dog = watchdog()
+    targets = watch_cloud(dog, loop)
+    fakecloud.post('/_preempt/vm0')
+
+    assert run_tick(dog, loop) == 1
+    assert fakecloud.get('/_status') == {'RUNNING': 4}
+    assert targets['name0'].started_at is not None
+    # The folder is polled fast after the start
+    assert dog.due['f0'] - targets['name0'].event_at <= dog.fast_delay
+
+    # Running instances are left alone
+    assert run_tick(dog, loop) == 0
+    assert fakecloud.get('/_stats')['POST instances'] == 1
+
+
+def test_crash_loop_backoff(loop):
+    dog = watchdog(backoff=30, max_backoff=100, fast_period=120)
+    dog.add(instance_data('vm0'))
+    state = dog.targets['vm0']
+    vm = state.instance
+
+    # Stopped again soon after each start: the next start is put off longer every time
+    pauses = []
+    for now in [1000, 2000, 3000, 4000]:
+        state.started_at = now - 10
+        vm.set_data(instance_data('vm0', status='STOPPED'))
+        dog.check(state, now)
+        pauses.append(state.blocked_until - now)
+        vm.set_data(instance_data('vm0'))
+        dog.check(state, now)
+
+    assert pauses == [30, 60, 100, 100]
+    assert state.failures == 4
+    assert not state.starting
+
+    # Staying up for fast_period resets the backoff
+    state.started_at = 5000
+    dog.check(state, 5000 + 120)
+    assert (state.failures, state.started_at) == (0, None)
+
+
+def test_failed_folder_rescheduled(fakecloud, loop):
+    lister = FailingLister({
+        'f1': aiohttp.ClientConnectionError('connection reset'),
+        'f2': ValueError('unexpected payload')
+    })
+    dog = watchdog(lister=lister, delay=5)
+    targets = watch_cloud(dog, loop)
+    dog.add(instance_data('vm10', folder_id='f1'))
+    dog.add(instance_data('vm20', folder_id='f2'))
+    fakecloud.post('/_preempt/vm0')
+
+    started = loop.time()
+    assert run_tick(dog, loop) == 1
+
+    # Failed folders are checked again later, the other ones go on
+    assert fakecloud.get('/_status') == {'RUNNING': 4}
+    assert targets['name0'].started_at is not None
+    assert all(dog.due[x] >= started + 4 for x in ['f1', 'f2'])
+
+
+def test_start_in_flight_not_sent_again(fakecloud, loop):
+    dog = watchdog(lister=StaleLister({'vm0': 'STOPPED'}))
+    targets = watch_cloud(dog, loop)
+    fakecloud.post('/_preempt/vm0')
+
+    async def main():
+        await dog.tick()
+        task = targets['name0'].task
+        # Checks while the start is running don't send another one
+        for folder_id in dog.due:
+            dog.due[folder_id] = 0
+        await dog.tick()
+        assert targets['name0'].task is task
+        await task
+
+    loop.run_until_complete(main())
+    assert fakecloud.get('/_stats')['POST instances'] == 1
+
+
+def test_running_start_waited_for(fakecloud, loop):
+    dog = watchdog()
+    targets = watch_cloud(dog, loop)
+    state = targets['name0']
+    fakecloud.post('/_preempt/vm0')
+
+    async def main():
+        # Start sent by another client or before a restart of the watchdog
+        other = await AsyncInstance.create('vm0')
+        operation_id = await other.start()
+        await dog.start(state)
+        return operation_id
+
+    operation_id = loop.run_until_complete(main())
+
+    stats = fakecloud.get('/_stats')
+    assert stats['POST instances'] == 1
+    assert stats['GET operations'] > 0
+    assert state.started_at is not None and state.failures == 0
+    assert state.operation_id is None
+    assert fakecloud.get(f'/operations/{operation_id}')['done']
+    assert fakecloud.get('/_status') == {'RUNNING': 4}
+
+
+def test_busy_instance_deferred(loop, monkeypatch):
+    dog = watchdog()
+    dog.add(instance_data('vm0', status='STOPPED'))
+    state = dog.targets['vm0']
+    started = []
+
+    async def pending_operations():
+        return [{'id': 'op1', 'description': 'Create snapshot', 'done': False, 'metadata': {'@type': 'CreateSnapshotMetadata'}}]
+
+    async def start():
+        started.append(1)
+
+    monkeypatch.setattr(state.instance, 'pending_operations', pending_operations)
+    monkeypatch.setattr(state.instance, 'start', start)
+
+    loop.run_until_complete(dog.start(state))
+
+    # Deferred to a later tick, not counted as a failed start
+    assert started == []
+    assert state.busy
+    assert (state.failures, state.blocked_until, state.started_at) == (0, 0, None)
+
+
+def test_remove(loop):
+    dog = watchdog()
+    dog.add(instance_data('vm0'))
+    dog.add(instance_data('vm1'))
+    dog.add(instance_data('vm2', folder_id='f1'))
+
+    dog.remove(instance_data('vm0'))
+    dog.remove(instance_data('vm2', folder_id='f1'))
+    dog.remove(instance_data('vm3'))
+
+    # A folder is polled as long as it has targets
+    assert sorted(dog.targets) == ['vm1']
+    assert sorted(dog.due) == ['f0']
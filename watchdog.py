@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import signal
 import asyncio
 import logging
 import time
@@ -8,61 +9,152 @@ import time
 from datetime import datetime
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
-LOGDIR = os.path.join(BASEDIR, 'logs')
+# LOG_DIR env moves the logs out of the tree, e.g. for benchmarks
+LOGDIR = os.getenv('LOG_DIR') or os.path.join(BASEDIR, 'logs')
 WATCH_STATUS = ['STOPPED']
 
 '''Preparing'''
 
-if not os.path.exists(LOGDIR):
-    os.mkdir(LOGDIR)
+def setup_logging():
+    if not os.path.exists(LOGDIR):
+        os.mkdir(LOGDIR)
 
-logging.basicConfig(level=logging.INFO,
-    format='[%(asctime)s] [%(levelname)s] %(message)s',
-    datefmt='%d/%b/%y %H:%M:%S', 
-    handlers=[
-        logging.FileHandler(os.path.join(LOGDIR, 'watchdog.log')),
-        logging.StreamHandler()
-    ]
-)
+    logging.basicConfig(level=logging.INFO,
+        format='[%(asctime)s] [%(levelname)s] %(message)s',
+        datefmt='%d/%b/%y %H:%M:%S', 
+        handlers=[
+            logging.FileHandler(os.path.join(LOGDIR, 'watchdog.log')),
+            logging.StreamHandler()
+        ]
+    )
+
+
+if __name__ == '__main__':
+    setup_logging()
 
 logger = logging.getLogger(__name__)
 
-from common.compute import Instance, NEGATIVE_STATES, POSITIVE_STATES
+from common.compute import NEGATIVE_STATES, POSITIVE_STATES
+from common.watch import Watchdog
+from common.scheduler import OperationScheduler
+from common.discovery import TargetSet
+from common.leases import ShardMember
+from common.exceptions import LeaseStoreError
 from common.config import Config as config
+from common.metrics import start_server
+
+# Created by setup()
+SCHEDULER = None
+WATCHDOG = None
+TARGET_SET = None
+# Replica of a sharded watchdog group, None when one process watches all targets
+MEMBER = None
+
+
+def setup():
+    '''Resolve targets from config, return False if there are none.'''
+    global SCHEDULER, WATCHDOG, TARGET_SET, MEMBER
+
+    logger.info(f'Watchdog delay is {config.watchdog_delay} seconds')
+    SCHEDULER = OperationScheduler.from_config()
+    # Targets are checked with one listing per folder per tick
+    WATCHDOG = Watchdog.from_config(SCHEDULER, watch_status=WATCH_STATUS)
+
+    targets = [t for t in config.targets_list if t != '']
+    if not targets:
+        msg = 'Targets is empty. Please type targets into config file. If you have multiple targets, separate them with a space'
+        logger.warning(msg)
+        return False
+
+    # Resolve IDs, names and selectors with one listing per folder, non-existent instances are skipped
+    TARGET_SET = TargetSet(targets, folders=config.folders_list, interval=config.resolve_interval)
+    TARGET_SET.resolve()
+
+    if config.shard_store:
+        MEMBER = ShardMember.from_config()
+        logger.info(f'Watchdog replica {MEMBER.replica_id}, targets are split into {MEMBER.shards} shards')
+
+    return True
+
+
+def owned(data):
+    return MEMBER is None or MEMBER.owns(data['id'])
+
 
-logger.info(f'Watchdog delay is {config.watchdog_delay} seconds')
+def rebalance():
+    # Watch targets of the shards held by the replica only
+    for data in TARGET_SET.targets:
+        watched = data['id'] in WATCHDOG.targets
+        if owned(data) and not watched:
+            WATCHDOG.add(data)
+        elif watched and not owned(data):
+            WATCHDOG.remove(data)
 
-# Instances generator from config
-try:
-    TARGETS = [t for t in config.targets_list if t != '']
-except Exception as err:
-    logger.error(err)
 
-if not TARGETS:
-    msg = 'Targets is empty. Please type targets into config file. If you have multiple targets, separate them with a space'
-    logger.warning(msg)
-    quit()
+async def resolve_targets():
+    loop = asyncio.get_event_loop()
+
+    while True:
+        await asyncio.sleep(config.resolve_interval)
+        # Selectors are re-resolved in a thread, the listing must not block watchdogs
+        added, removed = await loop.run_in_executor(None, TARGET_SET.refresh)
+
+        for data in added:
+            if owned(data):
+                WATCHDOG.add(data)
 
-# Delete non-existent instances
-for instance_id in TARGETS:
-    if Instance(instance_id).name is None:
-        TARGETS.remove(instance_id)
+        for data in removed:
+            WATCHDOG.remove(data)
 
 
-async def watchdog(instance_id):
+async def keep_shards():
+    loop = asyncio.get_event_loop()
+
     while True:
-        await asyncio.sleep(int(config.watchdog_delay))
-        instance = Instance(instance_id)
+        # The lease store may block, it's called in a thread
+        acquired, released = await loop.run_in_executor(None, MEMBER.sync)
+        if acquired or released:
+            rebalance()
+            logger.info(f'Watching {len(WATCHDOG.targets)} of {len(TARGET_SET.targets)} targets')
+
+        await asyncio.sleep(MEMBER.heartbeat)
 
-        if instance.status in WATCH_STATUS:
-            logger.info(f'Instance {instance.name} is {instance.status}. Working..')
-            await instance.async_operation_complete(instance.start())
+
+async def watch_targets():
+    if config.metrics_port:
+        await start_server(config.metrics_host, config.metrics_port)
+
+    tasks = [WATCHDOG.run(), resolve_targets()]
+    if MEMBER is None:
+        rebalance()
+    else:
+        tasks.append(keep_shards())
+
+    await asyncio.gather(*tasks)
+
+
+def terminate(signum, frame):
+    raise KeyboardInterrupt
 
 
 def run():
-    tasks = [watchdog(instance) for instance in TARGETS]
+    if not setup():
+        quit()
+
+    # systemd stops the service with SIGTERM, the replica hands its shards over on exit
+    signal.signal(signal.SIGTERM, terminate)
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(asyncio.wait(tasks))
+
+    try:
+        loop.run_until_complete(watch_targets())
+    except KeyboardInterrupt:
+        logger.info('Watchdog stopped')
+    finally:
+        if MEMBER is not None:
+            try:
+                MEMBER.leave()
+            except LeaseStoreError as err:
+                logger.error(f'Failed to leave the watchdog group, shards are taken over after lease expiry: {err}')
 
 
 if __name__ == '__main__':